@@ -0,0 +1,54 @@
+"""
+Retention job for the hybrid service database: moves reviewed (approved or
+declined) translation_history rows older than the retention period into monthly
+archives, then hands the freed space back to the filesystem.
+
+Pending reviews and approved_translations (the training data) are never touched.
+Archived rows stay readable through GET /archived_translations.
+
+The first run on a database created before incremental auto_vacuum was enabled
+converts it with a one-off full VACUUM, which blocks writers while it runs; use
+--no-vacuum to skip that (and the incremental vacuum) until a quiet moment.
+
+Usage:
+    python archive_translation_history.py
+    python archive_translation_history.py --older-than-days 30 --format jsonl.gz
+    python archive_translation_history.py --db levantine_hybrid.db --archive-dir /backups/history
+"""
+import argparse
+import os
+import sys
+
+from hybrid_db import HISTORY_ARCHIVE_FORMAT, HISTORY_ARCHIVE_FORMATS, HISTORY_RETENTION_DAYS, LevantineHybridDB
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--db', default='levantine_hybrid.db', help='Path to the hybrid service database')
+    parser.add_argument('--older-than-days', type=float,
+                        help='Archive rows reviewed longer ago than this (default: HISTORY_RETENTION_DAYS, 90)')
+    parser.add_argument('--archive-dir', help='Where to write the archives (default: next to the database)')
+    parser.add_argument('--format', choices=HISTORY_ARCHIVE_FORMATS,
+                        help='Format for newly archived months (default: HISTORY_ARCHIVE_FORMAT, sqlite)')
+    parser.add_argument('--no-vacuum', action='store_true', help="Don't vacuum after archiving")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.db):
+        parser.error(f"Database not found: {args.db}")
+    # Brings the schema up to date, but starts none of the service's background threads
+    db = LevantineHybridDB(args.db, archive_dir=args.archive_dir, background=False)
+
+    older_than_days = args.older_than_days if args.older_than_days is not None else HISTORY_RETENTION_DAYS
+    moved = db.archive_reviewed_history(older_than_days, args.format or HISTORY_ARCHIVE_FORMAT)
+    for month, count in sorted(moved.items()):
+        print(f"{month}: {count} translations archived", file=sys.stderr)
+    print(f"Archived {sum(moved.values())} reviewed translations older than {older_than_days:g} days "
+          f"to {db.archive.directory}", file=sys.stderr)
+
+    if not args.no_vacuum:
+        if db.enable_incremental_vacuum():
+            print("Converted the database to incremental auto_vacuum", file=sys.stderr)
+        pages = db.incremental_vacuum()
+        print(f"Released {pages} free pages", file=sys.stderr)
+
+if __name__ == '__main__':
+    main()
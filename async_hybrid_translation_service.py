@@ -0,0 +1,261 @@
+"""
+Asyncio version of the hybrid translation service's /translate pipeline.
+
+Serves the same /translate endpoint (same request and response JSON) as
+hybrid_translation_service.py, but on aiohttp: a request waiting for Gemini is
+a suspended coroutine rather than a blocked thread, so one process can hold
+thousands of concurrent upstream calls. Everything else is shared with the
+Flask service: the database, Gemini response cache, word replacements, review
+queue, prompt and the retry/circuit breaker policy.
+
+SQLite has no non-blocking API, so database calls run on a small thread pool
+(like aiosqlite does) and never block the event loop. Word replacements and
+queueing for review are in-memory/write-behind, so those threads are rarely busy.
+
+The review and vocabulary endpoints stay on the Flask service; both can run
+against the same database (WAL mode), side by side: the Flask service on port
+5003, this one on ASYNC_HYBRID_PORT (default 5004). Point the frontend's
+/translate calls at the async service and everything else at the Flask one.
+
+Usage:
+    python async_hybrid_translation_service.py   (listens on ASYNC_HYBRID_PORT, default 5004)
+"""
+import asyncio
+import functools
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional, Tuple
+
+import aiohttp
+from aiohttp import web
+
+from hybrid_db import SQLITE_POOL_SIZE, normalize_translation_key
+from hybrid_translation_service import (
+    GEMINI_DEADLINE, GeminiError, GeminiTranslator, db, finish_translation, gemini_breaker, gemini_cache,
+    translation_memory_options, translation_memory_response
+)
+
+logger = logging.getLogger(__name__)
+
+# Its own port, so it can run next to the Flask service (port 5003)
+ASYNC_HYBRID_PORT = int(os.environ.get('ASYNC_HYBRID_PORT', '5004'))
+# Most simultaneous connections to Gemini; requests beyond it wait for a free connection
+GEMINI_ASYNC_MAX_CONNECTIONS = int(os.environ.get('GEMINI_ASYNC_MAX_CONNECTIONS', '2000'))
+# Threads running (blocking) SQLite calls
+ASYNC_DB_THREADS = int(os.environ.get('ASYNC_DB_THREADS', str(SQLITE_POOL_SIZE)))
+
+GEMINI_SESSION = web.AppKey('gemini_session', aiohttp.ClientSession)
+
+db_executor = ThreadPoolExecutor(max_workers=ASYNC_DB_THREADS, thread_name_prefix='hybrid-db')
+
+async def run_db(fn, *args, **kwargs):
+    """Run a blocking database call on the database threads"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(db_executor, functools.partial(fn, *args, **kwargs))
+
+class AsyncGeminiTranslator(GeminiTranslator):
+    """
+    GeminiTranslator on an aiohttp session: translate() and _generate() are
+    coroutines. Prompt, parsing, retries, deadline and circuit breaker are the
+    same as the blocking translator's.
+    """
+    def __init__(self, api_key: str, session: aiohttp.ClientSession):
+        super().__init__(api_key, session=session)
+
+    async def translate(self, text: str, context: str = "") -> Tuple[str, str]:
+        """Translate using Gemini API; raises GeminiError if the call fails"""
+        try:
+            response_text = await self._generate(self.build_prompt(text, context))
+        except GeminiError as e:
+            logger.error(f"Gemini API error: {e}")
+            raise
+        return self._parse_translation(response_text)
+
+    async def _generate(self, prompt: str) -> str:
+        """See GeminiTranslator._generate"""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.deadline
+        connect_timeout, read_timeout = self.timeout
+
+        for attempt in range(1, self.max_attempts + 1):
+            remaining = self._remaining(deadline, loop.time())
+            self._check_breaker()
+            timeout = aiohttp.ClientTimeout(total=remaining, sock_connect=min(connect_timeout, remaining),
+                                            sock_read=min(read_timeout, remaining))
+            try:
+                async with self.session.post(f"{self.base_url}?key={self.api_key}",
+                                             json=self._payload(prompt), timeout=timeout) as response:
+                    if response.status == 200:
+                        result = await response.json(content_type=None)
+                        self.breaker.record_success()
+                        return self._response_text(result)
+                    error = self._status_error(response.status, response.headers.get('Retry-After'))
+            except GeminiError:
+                raise
+            except ValueError as e:
+                self.breaker.record_success()
+                raise GeminiError(f"malformed response: {e!r}")
+            except Exception as e:
+                error = self._request_failed(e, isinstance(e, (aiohttp.ClientConnectionError, asyncio.TimeoutError)))
+
+            # _retry_delay works on time.monotonic(), which is also the event loop's clock
+            delay = self._retry_delay(error, attempt, deadline)
+            if delay is None:
+                raise error
+            await asyncio.sleep(delay)
+
+class AsyncSingleFlight:
+    """
+    SingleFlight for coroutines: concurrent calls with the same key share one
+    task. The task runs on its own, so a client disconnecting doesn't cancel the
+    Gemini call the other waiters are sharing.
+    """
+    def __init__(self):
+        self._tasks: Dict = {}
+        self.executed = 0
+        self.coalesced = 0
+
+    async def do(self, key, coroutine_fn):
+        """Returns (result, shared), like SingleFlight.do"""
+        task = self._tasks.get(key)
+        shared = task is not None
+        if shared:
+            self.coalesced += 1
+        else:
+            self.executed += 1
+            task = self._tasks[key] = asyncio.ensure_future(coroutine_fn())
+            task.add_done_callback(functools.partial(self._finished, key))
+        return await asyncio.shield(task), shared
+
+    def _finished(self, key, task: asyncio.Task):
+        if self._tasks.get(key) is task:
+            del self._tasks[key]
+        if not task.cancelled():
+            task.exception()  # Retrieved, even if every waiter went away
+
+    def metrics(self) -> Dict:
+        return {'in_flight': len(self._tasks), 'executed': self.executed, 'coalesced': self.coalesced}
+
+flights = AsyncSingleFlight()
+
+async def translate_cached(translator: AsyncGeminiTranslator, text: str,
+                           context: Optional[str]) -> Tuple[str, str, bool]:
+    """GeminiResponseCache.translate for coroutines; returns (arabic, transliteration, cache_hit)"""
+    cached = await run_db(gemini_cache.get, text, context, translator.PROMPT_VERSION)
+    if cached:
+        return cached[0], cached[1], True
+
+    async def call_gemini():
+        arabic, transliteration = await translator.translate(text, context)
+        if arabic:
+            await run_db(gemini_cache.put, text, context, arabic, transliteration, translator.PROMPT_VERSION)
+        return arabic, transliteration
+
+    # The API key is part of the key so an invalid key's error is never shared
+    flight_key = (translator.api_key, translator.PROMPT_VERSION) + normalize_translation_key(text, context)
+    (arabic, transliteration), _ = await flights.do(flight_key, call_gemini)
+    return arabic, transliteration, False
+
+def error_response(message: str, status: int) -> web.Response:
+    return web.json_response({'error': message}, status=status)
+
+def gemini_error_response(error: GeminiError) -> web.Response:
+    """See hybrid_translation_service.gemini_error_response"""
+    response = web.json_response({'error': f'Gemini unavailable: {error}', 'retryable': error.retryable},
+                                 status=503 if error.retryable else 502)
+    if error.retryable:
+        response.headers['Retry-After'] = str(max(1, int(error.retry_after or 1)))
+    return response
+
+async def index(request: web.Request) -> web.Response:
+    return web.Response(text="Hybrid Levantine Translation Service (Gemini + Custom DB, asyncio) is running!")
+
+async def translate_text(request: web.Request) -> web.Response:
+    try:
+        data = await request.json()
+    except ValueError:
+        data = None
+    if not data or not isinstance(data, dict):
+        return error_response("Invalid JSON payload", 400)
+
+    english_text = data.get('english_text')
+    context = data.get('context')
+    gemini_api_key = data.get('gemini_api_key')
+
+    if not english_text:
+        return error_response("Missing english_text to translate", 400)
+    if not gemini_api_key:
+        return error_response("Missing gemini_api_key", 400)
+    try:
+        memory_mode, memory_threshold = translation_memory_options(data)
+    except ValueError as e:
+        return error_response(str(e), 400)
+
+    try:
+        # Reviewed translations are returned as they are, without calling Gemini
+        memory = await run_db(db.lookup_translation_memory, english_text, context, memory_mode, memory_threshold)
+        if memory:
+            return web.json_response(translation_memory_response(english_text, context, memory))
+
+        # Step 1: Get translation from Gemini (or from the cache of earlier Gemini responses)
+        gemini = AsyncGeminiTranslator(gemini_api_key, request.app[GEMINI_SESSION])
+        gemini_arabic, gemini_transliteration, cache_hit = await translate_cached(gemini, english_text, context)
+
+        # Steps 2 and 3: word replacements, saving for review
+        response = await run_db(finish_translation, english_text, context, gemini_arabic,
+                                gemini_transliteration, cache_hit, data.get('save_for_review', True))
+        return web.json_response(response)
+
+    except GeminiError as e:
+        return gemini_error_response(e)
+    except Exception as e:
+        logger.error(f"Translation error: {e}")
+        return error_response(f'Translation failed: {str(e)}', 500)
+
+async def get_metrics(request: web.Request) -> web.Response:
+    """Get runtime metrics of the service"""
+    return web.json_response({
+        'history_writer': db.history_writer.metrics(),
+        'gemini_cache': gemini_cache.metrics(),
+        'gemini_coalescing': flights.metrics(),
+        'gemini_breaker': gemini_breaker.metrics(),
+        'translation_memory': dict(db.memory_lookups),
+        'gemini_connections': GEMINI_ASYNC_MAX_CONNECTIONS,
+        'sqlite': db.pool.metrics()
+    })
+
+@web.middleware
+async def cors_middleware(request: web.Request, handler):
+    """Allow cross-origin requests from any origin, like CORS(app) on the Flask service"""
+    if request.method == 'OPTIONS':
+        response = web.Response()
+        response.headers['Access-Control-Allow-Methods'] = 'GET, POST, OPTIONS'
+        response.headers['Access-Control-Allow-Headers'] = request.headers.get(
+            'Access-Control-Request-Headers', 'Content-Type')
+    else:
+        response = await handler(request)
+    response.headers['Access-Control-Allow-Origin'] = '*'
+    return response
+
+async def gemini_session_context(app: web.Application):
+    """One keep-alive connection pool to Gemini for the whole process"""
+    connector = aiohttp.TCPConnector(limit=GEMINI_ASYNC_MAX_CONNECTIONS, limit_per_host=GEMINI_ASYNC_MAX_CONNECTIONS)
+    async with aiohttp.ClientSession(connector=connector, headers={"Content-Type": "application/json"},
+                                     json_serialize=json.dumps) as session:
+        app[GEMINI_SESSION] = session
+        yield
+
+def create_app() -> web.Application:
+    app = web.Application(middlewares=[cors_middleware])
+    app.cleanup_ctx.append(gemini_session_context)
+    app.router.add_get('/', index)
+    app.router.add_post('/translate', translate_text)
+    app.router.add_get('/metrics', get_metrics)
+    return app
+
+if __name__ == '__main__':
+    print("Starting Hybrid Levantine Translation Service (asyncio)...")
+    print(f"- Gemini deadline {GEMINI_DEADLINE:.0f}s, up to {GEMINI_ASYNC_MAX_CONNECTIONS} concurrent Gemini calls")
+    web.run_app(create_app(), port=ASYNC_HYBRID_PORT)
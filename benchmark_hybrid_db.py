@@ -0,0 +1,88 @@
+"""
+Benchmark of the per-request database overhead of the hybrid translation service.
+
+Replays the database work of one /translate call (word replacements, usage count
+updates and saving the translation for review) against:
+  - connect-per-call: a new sqlite3 connection per method call in rollback-journal
+    mode, which is how LevantineHybridDB used to work
+  - pooled: the SQLiteConnectionPool (reused WAL connections, tuned pragmas and
+    prepared statement cache)
+
+Usage:
+    python benchmark_hybrid_db.py [--requests 500] [--replacements 200]
+"""
+import argparse
+import os
+import sqlite3
+import sys
+import time
+from contextlib import contextmanager
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from hybrid_db import LevantineHybridDB
+
+class ConnectPerCall:
+    """Stand-in for the pool that opens and closes a connection for every call"""
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+
+    @contextmanager
+    def connection(self):
+        conn = sqlite3.connect(self.db_path)
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    @contextmanager
+    def transaction(self):
+        with self.connection() as conn:
+            yield conn
+            conn.commit()
+
+    def close_all(self):
+        pass
+
+def make_db(db_path: str, replacements: int, pooled: bool) -> LevantineHybridDB:
+    db = LevantineHybridDB(db_path)
+    db.add_word_replacement("كُرة", "kura", "طابة", "taabeh", "sports")
+    for i in range(replacements):
+        db.add_word_replacement(f"كلمة{i}", f"kilme{i}", f"بديل{i}", f"badeel{i}")
+
+    if not pooled:
+        db.pool.close_all()
+        conn = sqlite3.connect(db_path)
+        conn.execute("PRAGMA journal_mode = DELETE")
+        conn.close()
+        db.pool = ConnectPerCall(db_path)
+    return db
+
+def run(db: LevantineHybridDB, requests: int) -> float:
+    """Average milliseconds of database work per simulated request"""
+    start = time.perf_counter()
+    for _ in range(requests):
+        arabic, transliteration, made = db.apply_word_replacements("بِدّي كُرة", "biddi kura")
+        db.save_translation_for_review("I want a ball", "sports", "بِدّي كُرة", "biddi kura",
+                                       arabic, transliteration, made)
+    return (time.perf_counter() - start) * 1000 / requests
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=500, help='Number of simulated requests')
+    parser.add_argument('--replacements', type=int, default=200, help='Extra word replacements in the table')
+    args = parser.parse_args()
+
+    results = {}
+    for name, pooled in (('connect-per-call', False), ('pooled', True)):
+        db = make_db(f"bench_{name}.db", args.replacements, pooled)
+        run(db, 10)  # Warm up
+        results[name] = run(db, args.requests)
+        db.pool.close_all()
+
+    print(f"Requests: {args.requests}, word replacements: {args.replacements + 1}")
+    for name, ms in results.items():
+        print(f"{name:18} {ms:8.3f} ms DB time per request")
+    print(f"Speedup: {results['connect-per-call'] / results['pooled']:.2f}x")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+"""
+Memory benchmark for the word replacement service vocabulary.
+
+Compares the resident set size of the old representation (one dict per entry)
+with VocabularyEntry (__slots__ records with interned context strings).
+Each measurement runs in a fresh subprocess so the numbers don't leak into
+each other.
+
+Usage:
+    python benchmark_vocabulary_memory.py [--entries 50000]
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+CONTEXTS = ["sports, games", "food", "greeting", "home", "family", "travel", "work", ""]
+
+def read_rss_kb() -> int:
+    """Current resident set size in KB"""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    # Fallback for platforms without /proc (reports peak, not current, RSS)
+    import resource
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss // 1024 if sys.platform == 'darwin' else rss
+
+def build_entries(count: int):
+    """Raw JSON-shaped entries, as they would be read from levantine_vocabulary.json"""
+    return {
+        f"كلمة{i}": {
+            "original_transliteration": f"kilme{i}",
+            "new_arabic": f"بديل{i}",
+            "new_transliteration": f"badeel{i}",
+            "context": CONTEXTS[i % len(CONTEXTS)],
+            "notes": "Imported from deck",
+            "usage_count": 0
+        }
+        for i in range(count)
+    }
+
+def measure(representation: str, count: int) -> int:
+    """Build the vocabulary in the given representation and return the RSS growth in KB"""
+    # Importing the service creates its vocabulary file in the working directory
+    os.chdir(tempfile.mkdtemp())
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from word_replacement_service import VocabularyEntry
+
+    # Serialize so the source strings are freed, like after json.load in load_vocabulary
+    raw = json.dumps(build_entries(count), ensure_ascii=False)
+    baseline = read_rss_kb()
+
+    if representation == 'dict':
+        vocabulary = json.loads(raw)
+    else:
+        vocabulary = json.loads(raw, object_hook=VocabularyEntry.json_object_hook)
+
+    used = read_rss_kb() - baseline
+    assert len(vocabulary) == count
+    return used
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--entries', type=int, default=50000, help='Number of vocabulary entries to build')
+    parser.add_argument('--measure', choices=['dict', 'slots'], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure:
+        print(measure(args.measure, args.entries))
+        return
+
+    results = {}
+    for representation in ('dict', 'slots'):
+        output = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), '--measure', representation, '--entries', str(args.entries)],
+            capture_output=True, text=True, check=True
+        ).stdout
+        results[representation] = int(output.strip().splitlines()[-1])
+
+    per_10k = {name: kb * 10000 / args.entries for name, kb in results.items()}
+    print(f"Vocabulary entries: {args.entries}")
+    print(f"dict entries:             {per_10k['dict'] / 1024:8.2f} MB RSS per 10k entries")
+    print(f"VocabularyEntry (slots):  {per_10k['slots'] / 1024:8.2f} MB RSS per 10k entries")
+    if per_10k['dict']:
+        print(f"Saving: {100 * (1 - per_10k['slots'] / per_10k['dict']):.1f}%")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,453 @@
+"""
+Training data and training jobs of the custom translation service.
+
+Everything here is independent of torch and transformers: the translation pair
+database, the model version directory layout and the runner that trains in a
+process of its own. The service (custom_translation_service.py) passes the
+runner what needs the model: the training process entry point, how to load a
+trained version and how to start serving it.
+"""
+import logging
+import math
+import multiprocessing
+import os
+import queue
+import shutil
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from datetime import datetime
+from typing import Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Fine-tuned model versions kept on disk (the served one is never removed)
+MODEL_VERSIONS_TO_KEEP = int(os.environ.get('MODEL_VERSIONS_TO_KEEP', '3'))
+# Finished training jobs kept for GET /retrain
+TRAINING_JOBS_TO_KEEP = 50
+# Incremental retraining mixes in this many older pairs per new pair, so the model
+# doesn't forget what it learned before
+TRAINING_REPLAY_RATIO = float(os.environ.get('TRAINING_REPLAY_RATIO', '0.5'))
+# Smallest incremental batch: a few new pairs are topped up with replayed ones to this
+# size, since fine-tuning on a handful of pairs overfits to them
+TRAINING_MIN_INCREMENTAL_PAIRS = int(os.environ.get('TRAINING_MIN_INCREMENTAL_PAIRS', '10'))
+
+class LevantineTranslationDB:
+    def __init__(self, db_path='levantine_translations.db'):
+        self.db_path = db_path
+        self.init_database()
+    
+    def init_database(self):
+        """Initialize the SQLite database with required tables"""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        
+        # Translation pairs table
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS translation_pairs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                english_text TEXT NOT NULL,
+                arabic_text TEXT NOT NULL,
+                transliteration TEXT,
+                context TEXT,
+                quality_score REAL DEFAULT 0.0,
+                user_feedback INTEGER DEFAULT 0,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        
+        # Model training history
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS training_history (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                model_version TEXT NOT NULL,
+                training_data_count INTEGER,
+                training_loss REAL,
+                validation_loss REAL,
+                training_time REAL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        
+        # User corrections and feedback
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS user_corrections (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                original_english TEXT NOT NULL,
+                original_arabic TEXT NOT NULL,
+                corrected_arabic TEXT NOT NULL,
+                corrected_transliteration TEXT,
+                correction_reason TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        
+        # Columns added for incremental training, on databases created before it
+        columns = {row[1] for row in cursor.execute('PRAGMA table_info(training_history)')}
+        for column, definition in [
+            ('base_version', 'TEXT'),  # Model version the training started from (NULL: base model)
+            ('training_mode', 'TEXT'),  # full, incremental
+            ('watermark_pair_id', 'INTEGER'),  # Highest translation_pairs id the model has seen
+            ('new_pairs', 'INTEGER'),
+            ('replay_pairs', 'INTEGER'),
+        ]:
+            if column not in columns:
+                cursor.execute(f'ALTER TABLE training_history ADD COLUMN {column} {definition}')
+        
+        conn.commit()
+        conn.close()
+        logger.info("Database initialized successfully")
+    
+    def add_translation_pair(self, english: str, arabic: str, transliteration: str = "", 
+                           context: str = "", quality_score: float = 0.0):
+        """Add a new translation pair to the database"""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+            INSERT INTO translation_pairs 
+            (english_text, arabic_text, transliteration, context, quality_score)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (english, arabic, transliteration, context, quality_score))
+        
+        conn.commit()
+        conn.close()
+        logger.info(f"Added translation pair: {english} -> {arabic}")
+    
+    def get_training_data(self, min_quality: float = 0.0) -> List[Dict]:
+        """Get training data above a certain quality threshold"""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+            SELECT id, english_text, arabic_text, transliteration, context, quality_score
+            FROM translation_pairs 
+            WHERE quality_score >= ?
+            ORDER BY quality_score DESC
+        ''', (min_quality,))
+        
+        rows = cursor.fetchall()
+        conn.close()
+        
+        return self._pairs_from_rows(rows)
+
+    def get_incremental_training_data(self, since_id: int, min_quality: float = 0.0,
+                                      replay_ratio: float = TRAINING_REPLAY_RATIO,
+                                      min_pairs: int = TRAINING_MIN_INCREMENTAL_PAIRS
+                                      ) -> Tuple[List[Dict], List[Dict], int]:
+        """
+        Pairs added after since_id, plus a random sample of replay_ratio times as many older
+        pairs (rounded up), topped up to min_pairs in total where enough older pairs exist;
+        replay_ratio 0 replays nothing. Returns (new_pairs, replay_pairs, watermark); watermark
+        is the highest id considered, to pass as since_id next time.
+        The watermark also passes pairs below min_quality, so later incremental runs never
+        pick them up, even with a lower min_quality or after their score is raised; only
+        full training considers them again.
+        """
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        
+        # Fixed first, so pairs added while we read aren't skipped next time
+        watermark = cursor.execute('SELECT COALESCE(MAX(id), 0) FROM translation_pairs').fetchone()[0]
+        cursor.execute('''
+            SELECT id, english_text, arabic_text, transliteration, context, quality_score
+            FROM translation_pairs
+            WHERE id > ? AND id <= ? AND quality_score >= ?
+            ORDER BY id
+        ''', (since_id, watermark, min_quality))
+        new_pairs = self._pairs_from_rows(cursor.fetchall())
+        
+        replay_pairs = []
+        replay_count = 0
+        if new_pairs and replay_ratio > 0:
+            replay_count = max(math.ceil(len(new_pairs) * replay_ratio), min_pairs - len(new_pairs))
+        if replay_count:
+            cursor.execute('''
+                SELECT id, english_text, arabic_text, transliteration, context, quality_score
+                FROM translation_pairs
+                WHERE id <= ? AND quality_score >= ?
+                ORDER BY random()
+                LIMIT ?
+            ''', (since_id, min_quality, replay_count))
+            replay_pairs = self._pairs_from_rows(cursor.fetchall())
+        
+        conn.close()
+        return new_pairs, replay_pairs, watermark
+
+    def count_training_pairs(self, min_quality: float = 0.0, since_id: int = 0) -> int:
+        """Number of pairs above a quality threshold, added after since_id"""
+        conn = sqlite3.connect(self.db_path)
+        count = conn.execute('SELECT COUNT(*) FROM translation_pairs WHERE id > ? AND quality_score >= ?',
+                             (since_id, min_quality)).fetchone()[0]
+        conn.close()
+        return count
+
+    def get_training_watermark(self, model_version: Optional[str]) -> Optional[int]:
+        """Highest pair id the given model version was trained on, or None if it wasn't trained here"""
+        if not model_version:
+            return None
+        conn = sqlite3.connect(self.db_path)
+        row = conn.execute('''
+            SELECT watermark_pair_id FROM training_history
+            WHERE model_version = ? ORDER BY id DESC LIMIT 1
+        ''', (model_version,)).fetchone()
+        conn.close()
+        return row[0] if row else None
+
+    def record_training(self, model_version: str, base_version: Optional[str], training_mode: str,
+                        watermark: int, new_pairs: int, replay_pairs: int, training_loss: float,
+                        training_time: float):
+        """Record a completed training run in training_history"""
+        conn = sqlite3.connect(self.db_path)
+        conn.execute('''
+            INSERT INTO training_history
+            (model_version, training_data_count, training_loss, training_time, base_version,
+             training_mode, watermark_pair_id, new_pairs, replay_pairs)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (model_version, new_pairs + replay_pairs, training_loss, training_time, base_version,
+              training_mode, watermark, new_pairs, replay_pairs))
+        conn.commit()
+        conn.close()
+
+    @staticmethod
+    def _pairs_from_rows(rows: List[Tuple]) -> List[Dict]:
+        return [
+            {
+                'id': row[0],
+                'english': row[1],
+                'arabic': row[2],
+                'transliteration': row[3],
+                'context': row[4],
+                'quality_score': row[5]
+            }
+            for row in rows
+        ]
+    
+    def add_user_correction(self, original_english: str, original_arabic: str, 
+                          corrected_arabic: str, corrected_transliteration: str = "",
+                          reason: str = ""):
+        """Add user correction to improve the model"""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+            INSERT INTO user_corrections 
+            (original_english, original_arabic, corrected_arabic, corrected_transliteration, correction_reason)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (original_english, original_arabic, corrected_arabic, corrected_transliteration, reason))
+        
+        # Also add the corrected version as a high-quality training pair
+        cursor.execute('''
+            INSERT INTO translation_pairs 
+            (english_text, arabic_text, transliteration, context, quality_score)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (original_english, corrected_arabic, corrected_transliteration, "user_corrected", 0.9))
+        
+        conn.commit()
+        conn.close()
+        logger.info(f"Added user correction: {original_arabic} -> {corrected_arabic}")
+
+def model_version_dir(model_path: str, version: str) -> str:
+    return os.path.join(model_path, 'versions', version)
+
+def read_current_version(model_path: str) -> Optional[str]:
+    """The fine-tuned version being served, or None for the model saved directly in model_path"""
+    try:
+        with open(os.path.join(model_path, 'CURRENT')) as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+def write_current_version(model_path: str, version: str):
+    """Point model_path/CURRENT at a version; atomic, so a restart never sees a partial write"""
+    pointer = os.path.join(model_path, 'CURRENT')
+    with open(pointer + '.tmp', 'w') as f:
+        f.write(version)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(pointer + '.tmp', pointer)
+
+class TrainingJobRunner:
+    """
+    Runs /retrain jobs one at a time, in order, each in a process of its own: training
+    neither blocks a request thread nor touches the model object /translate is using.
+    A job that succeeds is loaded next to the serving model, which is then swapped for
+    it; the old one keeps answering until that moment.
+
+    target(model_path, base_version, version, training_data, epochs, batch_size, events)
+    is the training process entry point: it saves the trained model in
+    model_version_dir(model_path, version) and ends with ('finished', result) on events.
+    load_model(version) loads a trained version, swap_model(model) starts serving it and
+    served_version() names the version being served.
+    """
+    def __init__(self, db: LevantineTranslationDB, model_path: str, target: Callable,
+                 load_model: Callable[[str], object], swap_model: Callable[[object], None],
+                 served_version: Callable[[], Optional[str]]):
+        self.db = db
+        self.model_path = model_path
+        self._target = target
+        self._load_model = load_model
+        self._swap_model = swap_model
+        self._served_version = served_version
+        # fork is unsafe once CUDA or request threads are running
+        self._context = multiprocessing.get_context('spawn')
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._jobs: Dict[str, Dict] = OrderedDict()
+        self._thread = threading.Thread(target=self._run, name='training-jobs', daemon=True)
+        self._thread.start()
+
+    def submit(self, mode: str = 'incremental', min_quality: float = 0.5, epochs: int = 3, batch_size: int = 4,
+               replay_ratio: float = TRAINING_REPLAY_RATIO) -> Dict:
+        """
+        Queue a fine-tuning job; returns its state (see get). The training data is chosen
+        when the job starts (see _plan), so jobs queued back to back don't repeat pairs.
+        """
+        job_id = uuid.uuid4().hex[:12]
+        job = {
+            'id': job_id,
+            'status': 'queued',  # queued, training, loading, completed, failed
+            'mode': mode,  # incremental, full
+            'training_data_count': None,
+            'new_pairs': None,
+            'replay_pairs': None,
+            'base_version': None,
+            'watermark': None,
+            'epochs': epochs,
+            'step': 0,
+            'total_steps': None,
+            'progress': 0.0,
+            'loss': None,
+            'eta_seconds': None,
+            'elapsed_seconds': None,
+            'model_version': None,
+            'error': None,
+            'created_at': datetime.now().isoformat(),
+            'finished_at': None
+        }
+        with self._lock:
+            self._jobs[job_id] = job
+            finished = [i for i, j in self._jobs.items() if j['status'] in ('completed', 'failed')]
+            for old_id in finished[:max(0, len(finished) - TRAINING_JOBS_TO_KEEP)]:
+                del self._jobs[old_id]
+            state = dict(job)
+        self._queue.put((job_id, mode, min_quality, epochs, batch_size, replay_ratio))
+        return state
+
+    def get(self, job_id: str) -> Optional[Dict]:
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job else None
+
+    def list(self) -> List[Dict]:
+        with self._lock:
+            return [dict(job) for job in reversed(self._jobs.values())]
+
+    def _update(self, job_id: str, **fields):
+        with self._lock:
+            self._jobs[job_id].update(fields)
+
+    def _run(self):
+        while True:
+            job_id, *options = self._queue.get()
+            try:
+                self._execute(job_id, *options)
+            except Exception as e:
+                logger.error(f"Training job {job_id} failed: {e}")
+                self._update(job_id, status='failed', error=str(e), finished_at=datetime.now().isoformat())
+
+    def _plan(self, mode: str, min_quality: float, replay_ratio: float) -> Tuple[Dict, List[Dict]]:
+        """
+        Choose the training data. Incremental training continues from the served version
+        on the pairs added since it was trained, plus a replay sample of older ones; it
+        falls back to full training if the served version wasn't trained here.
+        """
+        base_version = self._served_version()
+        watermark = self.db.get_training_watermark(base_version) if mode == 'incremental' else None
+        if watermark is None:
+            mode, since_id, replay_ratio = 'full', 0, 0.0
+        else:
+            since_id = watermark
+        new_pairs, replay_pairs, watermark = self.db.get_incremental_training_data(since_id, min_quality, replay_ratio)
+        plan = {
+            'mode': mode,
+            'base_version': base_version,
+            'watermark': watermark,
+            'new_pairs': len(new_pairs),
+            'replay_pairs': len(replay_pairs),
+            'training_data_count': len(new_pairs) + len(replay_pairs)
+        }
+        return plan, new_pairs + replay_pairs
+
+    def _execute(self, job_id: str, mode: str, min_quality: float, epochs: int, batch_size: int,
+                 replay_ratio: float):
+        plan, training_data = self._plan(mode, min_quality, replay_ratio)
+        self._update(job_id, **plan)
+        if not plan['new_pairs']:
+            raise RuntimeError('No new training pairs since the served model was trained')
+
+        version = f"{datetime.now():%Y%m%d-%H%M%S}-{job_id}"
+        events = self._context.Queue()
+        process = self._context.Process(
+            target=self._target, name=f'training-{job_id}', daemon=True,
+            args=(self.model_path, plan['base_version'], version, training_data, epochs, batch_size, events)
+        )
+        start = time.time()
+        self._update(job_id, status='training')
+        process.start()
+        logger.info(f"Training job {job_id} started (pid {process.pid}): {plan['mode']} training on "
+                    f"{plan['new_pairs']} new and {plan['replay_pairs']} replayed pairs")
+
+        result = None
+        while result is None:
+            try:
+                kind, payload = events.get(timeout=1)
+            except queue.Empty:
+                if not process.is_alive():
+                    result = {'error': f'Training process exited with code {process.exitcode}'}
+                continue
+            if kind == 'finished':
+                result = payload
+                continue
+            self._update(job_id, **self._progress_fields(payload, time.time() - start))
+        process.join()
+
+        if 'error' in result:
+            shutil.rmtree(model_version_dir(self.model_path, version), ignore_errors=True)
+            raise RuntimeError(result['error'])
+
+        # Load the new version while the old one keeps serving, then switch over.
+        # Recorded first: the next incremental job starts from this version's watermark
+        self._update(job_id, status='loading', progress=1.0, eta_seconds=0)
+        new_model = self._load_model(version)
+        self.db.record_training(version, plan['base_version'], plan['mode'], plan['watermark'], plan['new_pairs'],
+                                plan['replay_pairs'], result['training_loss'], result['training_time'])
+        self._swap_model(new_model)
+        self._update(job_id, status='completed', model_version=version, loss=result['training_loss'],
+                     elapsed_seconds=round(time.time() - start, 1), finished_at=datetime.now().isoformat())
+        logger.info(f"Training job {job_id} completed, serving model version {version}")
+        self._remove_old_versions(version)
+
+    @staticmethod
+    def _progress_fields(payload: Dict, elapsed: float) -> Dict:
+        """Job fields for a progress event, with the ETA extrapolated from the time per step so far"""
+        fields = {'step': payload['step'], 'total_steps': payload['total_steps'],
+                  'elapsed_seconds': round(elapsed, 1)}
+        if payload['total_steps']:
+            fields['progress'] = round(payload['step'] / payload['total_steps'], 4)
+            if payload['step']:
+                remaining = payload['total_steps'] - payload['step']
+                fields['eta_seconds'] = round(elapsed / payload['step'] * remaining, 1)
+        if 'loss' in payload:
+            fields['loss'] = payload['loss']
+        return fields
+
+    def _remove_old_versions(self, current: str):
+        versions_dir = os.path.join(self.model_path, 'versions')
+        # Version names start with their creation time, so they sort oldest first
+        versions = sorted(name for name in os.listdir(versions_dir) if name != current)
+        for name in versions[:max(0, len(versions) - (MODEL_VERSIONS_TO_KEEP - 1))]:
+            shutil.rmtree(os.path.join(versions_dir, name), ignore_errors=True)
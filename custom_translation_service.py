@@ -1,6 +1,5 @@
 from flask import Flask, request, jsonify
 from flask_cors import CORS
-import sqlite3
 import json
 import os
 import torch
@@ -9,6 +8,7 @@ from transformers import (
     AutoModelForSeq2SeqLM, 
     Trainer, 
     TrainingArguments,
+    TrainerCallback,
     DataCollatorForSeq2Seq
 )
 from datasets import Dataset
@@ -18,6 +18,13 @@ import logging
 from typing import List, Dict, Tuple, Optional
 import threading
 import time
+import multiprocessing
+
+from custom_training import (
+    TRAINING_REPLAY_RATIO, LevantineTranslationDB, TrainingJobRunner, model_version_dir, read_current_version,
+    write_current_version
+)
+from tokenized_pair_cache import TASK_PREFIX, TokenizedPairCache, tokenize_pairs
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
@@ -26,131 +33,12 @@ logger = logging.getLogger(__name__)
 app = Flask(__name__)
 CORS(app)
 
-class LevantineTranslationDB:
-    def __init__(self, db_path='levantine_translations.db'):
-        self.db_path = db_path
-        self.init_database()
-    
-    def init_database(self):
-        """Initialize the SQLite database with required tables"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        # Translation pairs table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS translation_pairs (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                english_text TEXT NOT NULL,
-                arabic_text TEXT NOT NULL,
-                transliteration TEXT,
-                context TEXT,
-                quality_score REAL DEFAULT 0.0,
-                user_feedback INTEGER DEFAULT 0,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        # Model training history
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS training_history (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                model_version TEXT NOT NULL,
-                training_data_count INTEGER,
-                training_loss REAL,
-                validation_loss REAL,
-                training_time REAL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        # User corrections and feedback
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS user_corrections (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                original_english TEXT NOT NULL,
-                original_arabic TEXT NOT NULL,
-                corrected_arabic TEXT NOT NULL,
-                corrected_transliteration TEXT,
-                correction_reason TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        conn.commit()
-        conn.close()
-        logger.info("Database initialized successfully")
-    
-    def add_translation_pair(self, english: str, arabic: str, transliteration: str = "", 
-                           context: str = "", quality_score: float = 0.0):
-        """Add a new translation pair to the database"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            INSERT INTO translation_pairs 
-            (english_text, arabic_text, transliteration, context, quality_score)
-            VALUES (?, ?, ?, ?, ?)
-        ''', (english, arabic, transliteration, context, quality_score))
-        
-        conn.commit()
-        conn.close()
-        logger.info(f"Added translation pair: {english} -> {arabic}")
-    
-    def get_training_data(self, min_quality: float = 0.0) -> List[Dict]:
-        """Get training data above a certain quality threshold"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            SELECT english_text, arabic_text, transliteration, context, quality_score
-            FROM translation_pairs 
-            WHERE quality_score >= ?
-            ORDER BY quality_score DESC
-        ''', (min_quality,))
-        
-        rows = cursor.fetchall()
-        conn.close()
-        
-        return [
-            {
-                'english': row[0],
-                'arabic': row[1],
-                'transliteration': row[2],
-                'context': row[3],
-                'quality_score': row[4]
-            }
-            for row in rows
-        ]
-    
-    def add_user_correction(self, original_english: str, original_arabic: str, 
-                          corrected_arabic: str, corrected_transliteration: str = "",
-                          reason: str = ""):
-        """Add user correction to improve the model"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            INSERT INTO user_corrections 
-            (original_english, original_arabic, corrected_arabic, corrected_transliteration, correction_reason)
-            VALUES (?, ?, ?, ?, ?)
-        ''', (original_english, original_arabic, corrected_arabic, corrected_transliteration, reason))
-        
-        # Also add the corrected version as a high-quality training pair
-        cursor.execute('''
-            INSERT INTO translation_pairs 
-            (english_text, arabic_text, transliteration, context, quality_score)
-            VALUES (?, ?, ?, ?, ?)
-        ''', (original_english, corrected_arabic, corrected_transliteration, "user_corrected", 0.9))
-        
-        conn.commit()
-        conn.close()
-        logger.info(f"Added user correction: {original_arabic} -> {corrected_arabic}")
-
 class LevantineTranslationModel:
-    def __init__(self, model_path='./levantine_model', base_model='t5-small'):
+    def __init__(self, model_path='./levantine_model', base_model='t5-small', version: Optional[str] = None):
         self.model_path = model_path
         self.base_model = base_model
+        # Fine-tuned versions are saved in model_path/versions/<version>; CURRENT names the served one
+        self.version = version if version is not None else read_current_version(model_path)
         self.tokenizer = None
         self.model = None
         self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
@@ -158,13 +46,18 @@ class LevantineTranslationModel:
         
         self.load_or_initialize_model()
     
+    @property
+    def model_dir(self) -> str:
+        """Directory the model is loaded from"""
+        return model_version_dir(self.model_path, self.version) if self.version else self.model_path
+
     def load_or_initialize_model(self):
         """Load existing fine-tuned model or initialize from base model"""
         try:
-            if os.path.exists(self.model_path):
-                logger.info(f"Loading existing model from {self.model_path}")
-                self.tokenizer = AutoTokenizer.from_pretrained(self.model_path)
-                self.model = AutoModelForSeq2SeqLM.from_pretrained(self.model_path).to(self.device)
+            if os.path.exists(self.model_dir):
+                logger.info(f"Loading existing model from {self.model_dir}")
+                self.tokenizer = AutoTokenizer.from_pretrained(self.model_dir)
+                self.model = AutoModelForSeq2SeqLM.from_pretrained(self.model_dir).to(self.device)
             else:
                 logger.info(f"Initializing new model from {self.base_model}")
                 self.tokenizer = AutoTokenizer.from_pretrained(self.base_model)
@@ -178,17 +71,18 @@ class LevantineTranslationModel:
             logger.error(f"Error loading model: {e}")
             raise
     
-    def save_model(self):
-        """Save the current model and tokenizer"""
-        self.model.save_pretrained(self.model_path)
-        self.tokenizer.save_pretrained(self.model_path)
-        logger.info(f"Model saved to {self.model_path}")
+    def save_model(self, output_dir: Optional[str] = None):
+        """Save the current model and tokenizer (by default where they were loaded from)"""
+        output_dir = output_dir or self.model_dir
+        self.model.save_pretrained(output_dir)
+        self.tokenizer.save_pretrained(output_dir)
+        logger.info(f"Model saved to {output_dir}")
     
     def translate(self, text: str, max_length: int = 128) -> Tuple[str, float]:
         """Translate English text to Levantine Arabic"""
         try:
             # Prepare input with task prefix for T5
-            input_text = f"translate English to Levantine Arabic: {text}"
+            input_text = f"{TASK_PREFIX}{text}"
             
             # Tokenize input
             inputs = self.tokenizer(
@@ -224,49 +118,18 @@ class LevantineTranslationModel:
             return f"Translation error: {str(e)}", 0.0
     
     def prepare_training_data(self, training_pairs: List[Dict]) -> Dataset:
-        """Prepare training data for fine-tuning"""
-        inputs = []
-        targets = []
-        
-        for pair in training_pairs:
-            # Create input with task instruction
-            input_text = f"translate English to Levantine Arabic: {pair['english']}"
-            
-            # Target is the Arabic translation
-            target_text = pair['arabic']
-            
-            inputs.append(input_text)
-            targets.append(target_text)
-        
-        # Tokenize the data
-        model_inputs = self.tokenizer(
-            inputs, 
-            max_length=128, 
-            truncation=True, 
-            padding=True
-        )
-        
-        # Tokenize targets
-        with self.tokenizer.as_target_tokenizer():
-            labels = self.tokenizer(
-                targets, 
-                max_length=128, 
-                truncation=True, 
-                padding=True
-            )
-        
-        # Replace padding token id's in labels with -100
-        labels["input_ids"] = [
-            [-100 if token == self.tokenizer.pad_token_id else token for token in label]
-            for label in labels["input_ids"]
-        ]
-        
-        model_inputs["labels"] = labels["input_ids"]
-        
-        return Dataset.from_dict(model_inputs)
+        """
+        Tokenized training data, unpadded (the collator pads each batch). Pairs from the
+        database come from the on-disk cache, so only pairs not seen before are tokenized.
+        """
+        if all(pair.get('id') is not None for pair in training_pairs):
+            cache = TokenizedPairCache(os.path.join(self.model_path, 'tokenized_cache'), self.tokenizer)
+            return cache.dataset(training_pairs)
+        return Dataset.from_dict(tokenize_pairs(self.tokenizer, training_pairs))
     
-    def fine_tune(self, training_data: List[Dict], epochs: int = 3, batch_size: int = 4):
-        """Fine-tune the model with new training data"""
+    def fine_tune(self, training_data: List[Dict], epochs: int = 3, batch_size: int = 4,
+                  output_dir: Optional[str] = None, callbacks: Optional[List[TrainerCallback]] = None):
+        """Fine-tune the model with new training data, and save it to output_dir (default: in place)"""
         logger.info(f"Starting fine-tuning with {len(training_data)} examples")
         
         try:
@@ -279,22 +142,26 @@ class LevantineTranslationModel:
                 num_train_epochs=epochs,
                 per_device_train_batch_size=batch_size,
                 per_device_eval_batch_size=batch_size,
-                warmup_steps=100,
+                # At most a tenth of the run, so short incremental runs aren't all warmup
+                warmup_steps=min(100, -(-len(dataset) // batch_size) * epochs // 10),
                 weight_decay=0.01,
                 logging_dir=f"{self.model_path}/logs",
                 logging_steps=10,
                 save_steps=500,
                 evaluation_strategy="no",  # No validation set for now
+                # Batches of similar lengths, so dynamic padding adds few pad tokens
+                group_by_length=True,
                 save_total_limit=2,
                 load_best_model_at_end=False,
                 dataloader_num_workers=0,  # Avoid multiprocessing issues
             )
             
-            # Data collator
+            # Data collator: pads each batch to its longest example, labels with -100 (ignored by the loss)
             data_collator = DataCollatorForSeq2Seq(
                 self.tokenizer,
                 model=self.model,
-                padding=True
+                padding=True,
+                pad_to_multiple_of=8 if self.device.type == 'cuda' else None
             )
             
             # Create trainer
@@ -304,6 +171,7 @@ class LevantineTranslationModel:
                 train_dataset=dataset,
                 data_collator=data_collator,
                 tokenizer=self.tokenizer,
+                callbacks=callbacks,
             )
             
             # Train
@@ -312,7 +180,7 @@ class LevantineTranslationModel:
             training_time = time.time() - start_time
             
             # Save the fine-tuned model
-            self.save_model()
+            self.save_model(output_dir)
             
             logger.info(f"Fine-tuning completed in {training_time:.2f} seconds")
             return {
@@ -326,9 +194,55 @@ class LevantineTranslationModel:
             logger.error(f"Fine-tuning error: {e}")
             return {'error': str(e)}
 
+class JobProgressCallback(TrainerCallback):
+    """Reports training progress from a training process to the TrainingJobRunner"""
+    def __init__(self, events):
+        self.events = events
+
+    def on_step_end(self, args, state, control, **kwargs):
+        self.events.put(('progress', {'step': state.global_step, 'total_steps': state.max_steps}))
+
+    def on_log(self, args, state, control, logs=None, **kwargs):
+        if logs and 'loss' in logs:
+            self.events.put(('progress', {'step': state.global_step, 'total_steps': state.max_steps,
+                                          'loss': logs['loss']}))
+
+def run_training_job(model_path: str, base_version: Optional[str], version: str, training_data: List[Dict],
+                     epochs: int, batch_size: int, events):
+    """
+    Entry point of a training process: fine-tune a copy of base_version (the served model)
+    and save it as a new version. The serving process is told the outcome through events.
+    """
+    try:
+        trainee = LevantineTranslationModel(model_path, version=base_version)
+        result = trainee.fine_tune(training_data, epochs=epochs, batch_size=batch_size,
+                                   output_dir=model_version_dir(model_path, version),
+                                   callbacks=[JobProgressCallback(events)])
+    except Exception as e:
+        result = {'error': str(e)}
+    events.put(('finished', result))
+
+_model_swap_lock = threading.Lock()
+
+def swap_model(new_model: LevantineTranslationModel):
+    """
+    Start serving new_model. Requests take the module-level model once and finish on
+    that object, so each one sees either the old model or the new one, never a mix.
+    """
+    global model
+    with _model_swap_lock:
+        write_current_version(new_model.model_path, new_model.version)
+        model = new_model
+
 # Initialize components
 db = LevantineTranslationDB()
-model = LevantineTranslationModel()
+# Training processes import this module too; they load the model they train themselves
+model = LevantineTranslationModel() if multiprocessing.parent_process() is None else None
+training_jobs = TrainingJobRunner(
+    db, model.model_path, target=run_training_job,
+    load_model=lambda version: LevantineTranslationModel(model.model_path, version=version),
+    swap_model=swap_model, served_version=lambda: model.version
+) if model is not None else None
 
 # Initialize with some basic Levantine translations
 def initialize_basic_vocabulary():
@@ -377,7 +291,7 @@ def translate():
         return jsonify({'error': 'Empty text provided'}), 400
     
     try:
-        # Translate using custom model
+        # Translate using custom model (the one being served now, see swap_model)
         arabic_translation, confidence = model.translate(text)
         
         # For now, generate a simple transliteration (you can enhance this)
@@ -431,38 +345,80 @@ def correct_translation():
 
 @app.route('/retrain', methods=['POST'])
 def retrain_model():
-    """Retrain the model with accumulated data"""
+    """
+    Queue a retraining job. Responds at once (202) with the job id; follow progress at
+    /retrain/<job_id>. The new model is served once it finishes.
+    Body: mode=incremental (default: continue from the served model on the pairs added
+    since it was trained, plus replay_ratio older pairs per new one and enough of them to
+    train on at least TRAINING_MIN_INCREMENTAL_PAIRS) or full, min_quality, epochs.
+    Pairs below min_quality are passed over for good by incremental training (see
+    get_incremental_training_data); the response counts them in below_min_quality.
+    """
     data = request.get_json() or {}
+    mode = data.get('mode', 'incremental')
     min_quality = data.get('min_quality', 0.5)
     epochs = data.get('epochs', 3)
+    replay_ratio = data.get('replay_ratio', TRAINING_REPLAY_RATIO)
+    
+    if mode not in ('incremental', 'full'):
+        return jsonify({'error': 'mode must be incremental or full'}), 400
+    if isinstance(replay_ratio, bool) or not isinstance(replay_ratio, (int, float)) or replay_ratio < 0:
+        return jsonify({'error': 'replay_ratio must be a number >= 0'}), 400
     
     try:
-        # Get training data
-        training_data = db.get_training_data(min_quality=min_quality)
-        
-        if len(training_data) < 10:
-            return jsonify({
-                'error': f'Insufficient training data. Need at least 10 pairs, have {len(training_data)}'
-            }), 400
+        # Check there is something to train on; the job picks the pairs when it starts
+        watermark = db.get_training_watermark(model.version) if mode == 'incremental' else None
+        if watermark is None:
+            available = db.count_training_pairs(min_quality)
+            if available < 10:
+                return jsonify({
+                    'error': f'Insufficient training data. Need at least 10 pairs, have {available}'
+                }), 400
+        else:
+            available = db.count_training_pairs(min_quality, since_id=watermark)
+            if available == 0:
+                return jsonify({
+                    'error': f'No new training pairs since model version {model.version} was trained'
+                }), 400
         
-        # Fine-tune the model
-        result = model.fine_tune(training_data, epochs=epochs)
+        below_min_quality = db.count_training_pairs(0.0, since_id=watermark or 0) - available
         
-        if 'error' in result:
-            return jsonify({'error': result['error']}), 500
+        # Fine-tune the model in a training process
+        job = training_jobs.submit(mode, min_quality, epochs=epochs, replay_ratio=replay_ratio)
         
-        return jsonify({
-            'message': 'Model retrained successfully',
-            'training_data_count': len(training_data),
-            'training_loss': result.get('training_loss'),
-            'training_time': result.get('training_time'),
-            'epochs': result.get('epochs')
-        })
+        response = {
+            'message': 'Retraining job queued',
+            'job_id': job['id'],
+            'status': job['status'],
+            'status_url': f"/retrain/{job['id']}",
+            'mode': 'full' if watermark is None else 'incremental',
+            'new_pairs': available,
+            'below_min_quality': below_min_quality,
+            'epochs': epochs
+        }
+        if below_min_quality:
+            response['note'] = (f'{below_min_quality} pairs below min_quality {min_quality} are skipped, and '
+                                'later incremental runs will not consider them either; use mode=full to include '
+                                'them once their quality is raised')
+        return jsonify(response), 202
         
     except Exception as e:
         logger.error(f"Retraining error: {e}")
         return jsonify({'error': f'Retraining failed: {str(e)}'}), 500
 
+@app.route('/retrain/<job_id>', methods=['GET'])
+def get_retrain_job(job_id):
+    """Status of a retraining job: progress, loss, ETA and, once completed, the model version served"""
+    job = training_jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': f'Unknown job: {job_id}'}), 404
+    return jsonify(job)
+
+@app.route('/retrain', methods=['GET'])
+def list_retrain_jobs():
+    """Recent retraining jobs, newest first, and the model version being served"""
+    return jsonify({'jobs': training_jobs.list(), 'model_version': model.version})
+
 @app.route('/training_data', methods=['GET'])
 def get_training_data():
     """Get current training data statistics"""
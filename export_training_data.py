@@ -0,0 +1,65 @@
+"""
+Export approved translations from the hybrid service database as training data.
+
+Streams rows straight from SQLite to the output file, so memory use doesn't
+grow with the corpus. For incremental exports, pass the watermark printed by
+the previous run (or keep it in a file with --watermark-file).
+
+Usage:
+    python export_training_data.py --output pairs.jsonl
+    python export_training_data.py --format csv --since-id 1200 --output delta.csv
+    python export_training_data.py --watermark-file .export_watermark --output delta.jsonl
+"""
+import argparse
+import os
+import sys
+
+from hybrid_db import LevantineHybridDB, format_export
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--db', default='levantine_hybrid.db', help='Path to the hybrid service database')
+    parser.add_argument('--format', choices=['jsonl', 'csv'], default='jsonl', help='Output format')
+    parser.add_argument('--output', help='Output file (default: stdout)')
+    parser.add_argument('--since-id', type=int, help='Only export rows with a higher id (incremental export)')
+    parser.add_argument('--watermark-file', help='Read --since-id from this file, and store the new watermark in it')
+    parser.add_argument('--no-dedup', action='store_true', help='Keep repeated english/arabic pairs')
+    args = parser.parse_args()
+
+    if not os.path.exists(args.db):
+        parser.error(f"Database not found: {args.db}")
+    # Reads the database as it is: no migrations, nothing written
+    db = LevantineHybridDB(args.db, read_only=True)
+
+    since_id = args.since_id
+    if since_id is None and args.watermark_file and os.path.exists(args.watermark_file):
+        with open(args.watermark_file) as f:
+            since_id = int(f.read().strip() or 0)
+    since_id = since_id or 0
+
+    watermark = max(db.get_export_watermark(), since_id)
+    rows = db.iter_approved_translations(since_id, watermark, dedup=not args.no_dedup)
+
+    count = 0
+    def counted(rows):
+        nonlocal count
+        for row in rows:
+            count += 1
+            yield row
+
+    output = open(args.output, 'w', encoding='utf-8', newline='') if args.output else sys.stdout
+    try:
+        for chunk in format_export(counted(rows), args.format):
+            output.write(chunk)
+    finally:
+        if args.output:
+            output.close()
+
+    if args.watermark_file:
+        with open(args.watermark_file, 'w') as f:
+            f.write(str(watermark))
+    print(f"Exported {count} approved translations (ids {since_id + 1}..{watermark}); "
+          f"next export: --since-id {watermark}", file=sys.stderr)
+
+if __name__ == '__main__':
+    main()
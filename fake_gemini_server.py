@@ -0,0 +1,204 @@
+"""
+Local stand-in for the Gemini generateContent API, for load testing the hybrid
+translation service without an API key or quota.
+
+Answers single and batch (numbered "Phrases:") translation prompts in the
+response shape of the real API, after a latency drawn from a configurable
+distribution. A configurable share of requests fails with an error status, or
+hangs past the client's read timeout.
+
+streamGenerateContent?alt=sse answers one line per server-sent event: the
+first after that latency, the rest a quarter of a latency sample apart.
+
+Usage:
+    python fake_gemini_server.py [--port 8089] [--latency-ms 800] [--latency-dist lognormal]
+                                 [--error-rate 0.02] [--error-statuses 429,500,503] [--hang-rate 0]
+
+Then start the service against it:
+    GEMINI_API_URL=http://127.0.0.1:8089/v1beta/models/fake:generateContent python hybrid_translation_service.py
+
+GET /stats on the fake server returns the number of calls and injected failures.
+"""
+import argparse
+import json
+import math
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# The phrase from a single-item prompt: Translate "ball" to colloquial Levantine Arabic ...
+SINGLE_PROMPT_PATTERN = re.compile(r'Translate "(.*?)" to colloquial')
+
+class LatencyModel:
+    """Samples response latencies (in seconds) around a median"""
+    DISTRIBUTIONS = ('fixed', 'uniform', 'exponential', 'lognormal')
+
+    def __init__(self, distribution: str = 'lognormal', median_ms: float = 800, sigma: float = 0.5):
+        if distribution not in self.DISTRIBUTIONS:
+            raise ValueError(f"Unknown latency distribution: {distribution}")
+        self.distribution = distribution
+        self.median = median_ms / 1000
+        self.sigma = sigma
+
+    def sample(self) -> float:
+        if self.median <= 0:
+            return 0.0
+        if self.distribution == 'fixed':
+            return self.median
+        if self.distribution == 'uniform':
+            return random.uniform(0, 2 * self.median)
+        if self.distribution == 'exponential':
+            return random.expovariate(math.log(2) / self.median)
+        # Long right tail, like real LLM latencies
+        return self.median * math.exp(random.gauss(0, self.sigma))
+
+def fake_response_text(prompt: str) -> str:
+    """A well-formed translation response for a single or batch prompt"""
+    if 'Phrases:\n' in prompt:
+        phrases = prompt.split('Phrases:\n', 1)[1].split('\n\n', 1)[0].split('\n')
+        return ''.join(
+            f"[{number}]\nArabic: بِدّي كُرة {number}\nTransliteration: biddi kura {number}\n"
+            for number in range(1, len(phrases) + 1)
+        )
+    match = SINGLE_PROMPT_PATTERN.search(prompt)
+    words = len(match.group(1).split()) if match else 1
+    # Contains a word that has a replacement by default (كُرة -> طابة)
+    return f"Arabic: بِدّي كُرة {words}\nTransliteration: biddi kura {words}"
+
+class FakeGeminiHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # Keep-alive, like the real API
+
+    def do_POST(self):
+        server = self.server
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        method = self.path.split('?', 1)[0].rsplit(':', 1)[-1]
+        if method not in ('generateContent', 'streamGenerateContent'):
+            self._send(404, {'error': {'code': 404, 'message': 'Not found'}})
+            return
+        try:
+            prompt = json.loads(body)['contents'][0]['parts'][0]['text']
+        except (ValueError, KeyError, IndexError, TypeError):
+            self._send(400, {'error': {'code': 400, 'message': 'Invalid request payload'}})
+            return
+
+        server.count('calls')
+        roll = random.random()
+        if roll < server.hang_rate:
+            server.count('hangs')
+            time.sleep(server.hang_seconds)
+        else:
+            time.sleep(server.latency.sample())
+
+        if server.hang_rate <= roll < server.hang_rate + server.error_rate:
+            status = random.choice(server.error_statuses)
+            server.count(f'status_{status}')
+            headers = {'Retry-After': '1'} if status == 429 else {}
+            self._send(status, {'error': {'code': status, 'message': 'Injected error'}}, headers)
+            return
+
+        text = fake_response_text(prompt)
+        if method == 'streamGenerateContent':
+            self._send_stream(text.splitlines(keepends=True))
+            return
+        self._send(200, {'candidates': [{'content': {'parts': [{'text': text}], 'role': 'model'},
+                                         'finishReason': 'STOP'}]})
+
+    def _send_stream(self, texts):
+        """One server-sent event per text, with chunked transfer encoding"""
+        try:
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            for number, text in enumerate(texts):
+                if number:
+                    time.sleep(self.server.latency.sample() / 4)
+                event = {'candidates': [{'content': {'parts': [{'text': text}], 'role': 'model'}}]}
+                data = f"data: {json.dumps(event, ensure_ascii=False)}\r\n\r\n".encode('utf-8')
+                self.wfile.write(f"{len(data):x}\r\n".encode('ascii') + data + b"\r\n")
+                self.wfile.flush()
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def do_GET(self):
+        if self.path == '/stats':
+            self._send(200, self.server.stats())
+        else:
+            self._send(404, {'error': {'code': 404, 'message': 'Not found'}})
+
+    def _send(self, status: int, payload: dict, headers: dict = None):
+        data = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        try:
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json; charset=UTF-8')
+            self.send_header('Content-Length', str(len(data)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(data)
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # The client gave up (read timeout)
+
+    def log_message(self, format, *args):
+        pass
+
+class FakeGeminiServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, latency: LatencyModel, error_rate: float = 0.0,
+                 error_statuses=(429, 500, 503), hang_rate: float = 0.0, hang_seconds: float = 60.0):
+        super().__init__(address, FakeGeminiHandler)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_statuses = list(error_statuses)
+        self.hang_rate = hang_rate
+        self.hang_seconds = hang_seconds
+        self._lock = threading.Lock()
+        self._counts = {}
+
+    def count(self, name: str):
+        with self._lock:
+            self._counts[name] = self._counts.get(name, 0) + 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(self._counts)
+
+    @property
+    def api_url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/v1beta/models/fake:generateContent"
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8089, help='Port to listen on (0 picks a free one)')
+    parser.add_argument('--latency-ms', type=float, default=800, help='Median response latency')
+    parser.add_argument('--latency-dist', choices=LatencyModel.DISTRIBUTIONS, default='lognormal')
+    parser.add_argument('--latency-sigma', type=float, default=0.5, help='Spread of the lognormal distribution')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Share of calls answered with an error status')
+    parser.add_argument('--error-statuses', default='429,500,503', help='Error statuses to pick from')
+    parser.add_argument('--hang-rate', type=float, default=0.0, help='Share of calls that hang for --hang-seconds')
+    parser.add_argument('--hang-seconds', type=float, default=60.0)
+    args = parser.parse_args()
+
+    server = FakeGeminiServer(
+        (args.host, args.port),
+        LatencyModel(args.latency_dist, args.latency_ms, args.latency_sigma),
+        error_rate=args.error_rate,
+        error_statuses=[int(status) for status in args.error_statuses.split(',') if status],
+        hang_rate=args.hang_rate,
+        hang_seconds=args.hang_seconds
+    )
+    # The load test reads the URL from this line
+    print(f"Fake Gemini listening on {server.api_url}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
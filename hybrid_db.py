@@ -0,0 +1,1665 @@
+"""
+Database layer of the hybrid translation service: the SQLite schema and its
+migrations, word replacements, the review queue, translation memory, the
+history archives and the training data export.
+
+Importing this module has no side effects; the service, the async service and
+the maintenance scripts each open the database with LevantineHybridDB.
+"""
+import sqlite3
+import json
+import os
+import logging
+from typing import List, Dict, Iterator, Tuple, Optional
+import unicodedata
+import re
+import time
+import csv
+import io
+import queue
+import threading
+import atexit
+import gzip
+import urllib.parse
+from collections import Counter
+from difflib import SequenceMatcher
+from itertools import combinations
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Pragmas applied to every pooled connection. WAL lets readers run alongside the
+# writer, and synchronous=NORMAL is safe in WAL mode (only the last transactions
+# can be lost on power failure, the database can't be corrupted).
+# These two are stored in the database file, so read-only connections skip them
+SQLITE_FILE_PRAGMAS = (
+    # Lets the retention job hand pages freed by archiving back to the filesystem.
+    # Only takes effect on a new database (see enable_incremental_vacuum)
+    "PRAGMA auto_vacuum = INCREMENTAL",
+    "PRAGMA journal_mode = WAL",
+)
+SQLITE_PRAGMAS = (
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA cache_size = -16000",  # 16MB page cache per connection
+    "PRAGMA mmap_size = 268435456",  # 256MB
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA busy_timeout = 5000",
+)
+SQLITE_POOL_SIZE = int(os.environ.get('SQLITE_POOL_SIZE', '8'))
+# Per-connection cache of prepared statements, reused across requests
+SQLITE_CACHED_STATEMENTS = 256
+# Usage count increments are buffered in memory and written in one transaction
+# every USAGE_FLUSH_INTERVAL seconds, or sooner once USAGE_FLUSH_THRESHOLD are pending
+USAGE_FLUSH_INTERVAL = float(os.environ.get('USAGE_FLUSH_INTERVAL', '5.0'))
+USAGE_FLUSH_THRESHOLD = int(os.environ.get('USAGE_FLUSH_THRESHOLD', '200'))
+# Translations saved for review are written by a background thread; rows are
+# dropped (and counted) once HISTORY_QUEUE_SIZE are waiting
+HISTORY_QUEUE_SIZE = int(os.environ.get('HISTORY_QUEUE_SIZE', '10000'))
+HISTORY_BATCH_SIZE = 500
+
+# Most translations one bulk review may change
+MAX_BULK_REVIEW_IDS = 10000
+
+# Translation memory: approved translations answer /translate before Gemini is called.
+# Mode 'exact' (same normalized english_text and context), 'fuzzy' (also near-identical
+# english_text, at least TRANSLATION_MEMORY_THRESHOLD similar) or 'off'
+TRANSLATION_MEMORY_MODES = ('exact', 'fuzzy', 'off')
+TRANSLATION_MEMORY_MODE = os.environ.get('TRANSLATION_MEMORY_MODE', 'exact')
+TRANSLATION_MEMORY_THRESHOLD = float(os.environ.get('TRANSLATION_MEMORY_THRESHOLD', '0.9'))
+# A fuzzy lookup splits the input into this many pieces, finds approved translations
+# containing all but two of them, and scores up to TRANSLATION_MEMORY_CANDIDATES
+TRANSLATION_MEMORY_QUERY_PIECES = 4
+TRANSLATION_MEMORY_CANDIDATES = 200
+
+# Reviewed (approved/declined) translation_history rows older than this are moved to
+# monthly archives by archive_translation_history.py
+HISTORY_RETENTION_DAYS = float(os.environ.get('HISTORY_RETENTION_DAYS', '90'))
+# Default: translation_history_archive/ next to the database
+HISTORY_ARCHIVE_DIR = os.environ.get('HISTORY_ARCHIVE_DIR')
+HISTORY_ARCHIVE_FORMATS = ('sqlite', 'jsonl.gz')
+HISTORY_ARCHIVE_FORMAT = os.environ.get('HISTORY_ARCHIVE_FORMAT', 'sqlite')
+# Rows moved per transaction, so reviewers and the history writer never wait long
+HISTORY_ARCHIVE_BATCH_SIZE = 1000
+# Free pages released per incremental_vacuum step
+INCREMENTAL_VACUUM_PAGES = 2000
+
+class SQLiteConnectionPool:
+    """
+    Pool of tuned SQLite connections shared by all request threads.
+    Connections are created on demand; at most max_idle are kept open between uses.
+    With read_only, connections can't write to (or change the settings of) the file.
+    """
+    def __init__(self, db_path: str, max_idle: int = SQLITE_POOL_SIZE, read_only: bool = False):
+        self.db_path = db_path
+        self.max_idle = max_idle
+        self.read_only = read_only
+        self._idle = queue.LifoQueue()
+        # Lock contention: "database is locked" errors (raised once busy_timeout runs
+        # out) and the time spent in transactions, which includes waiting for the lock
+        self._metrics_lock = threading.Lock()
+        self.lock_errors = 0
+        self.transactions = 0
+        self.transaction_seconds = 0.0
+        self.max_transaction_seconds = 0.0
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(
+            f"file:{urllib.parse.quote(self.db_path)}?mode=ro" if self.read_only else self.db_path,
+            uri=self.read_only,
+            check_same_thread=False,  # Connections move between request threads
+            cached_statements=SQLITE_CACHED_STATEMENTS
+        )
+        for pragma in SQLITE_PRAGMAS if self.read_only else SQLITE_FILE_PRAGMAS + SQLITE_PRAGMAS:
+            conn.execute(pragma)
+        # normalize_translation_key() in SQL, so keys can be computed in INSERT ... SELECT
+        conn.create_function('translation_key', 1, translation_key_text, deterministic=True)
+        return conn
+
+    @contextmanager
+    def connection(self):
+        """Borrow a connection from the pool"""
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            conn = self._connect()
+
+        try:
+            yield conn
+        except sqlite3.OperationalError as e:
+            if 'locked' in str(e) or 'busy' in str(e):
+                with self._metrics_lock:
+                    self.lock_errors += 1
+            raise
+        finally:
+            if conn.in_transaction:
+                # Don't hand a half-finished transaction to the next user
+                conn.rollback()
+            if self._idle.qsize() < self.max_idle:
+                self._idle.put(conn)
+            else:
+                conn.close()
+
+    @contextmanager
+    def transaction(self):
+        """Borrow a connection and commit on success, or roll back on error"""
+        start = time.perf_counter()
+        try:
+            with self.connection() as conn:
+                try:
+                    yield conn
+                    conn.commit()
+                except Exception:
+                    conn.rollback()
+                    raise
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._metrics_lock:
+                self.transactions += 1
+                self.transaction_seconds += elapsed
+                self.max_transaction_seconds = max(self.max_transaction_seconds, elapsed)
+
+    def metrics(self) -> Dict:
+        with self._metrics_lock:
+            return {
+                'idle_connections': self._idle.qsize(),
+                'lock_errors': self.lock_errors,
+                'transactions': self.transactions,
+                'transaction_seconds_total': round(self.transaction_seconds, 3),
+                'max_transaction_ms': round(self.max_transaction_seconds * 1000, 2)
+            }
+
+    def close_all(self):
+        """Close all idle connections"""
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+ARABIC_DIACRITICS_PATTERN = re.compile('[\u064b-\u0652]')
+# A word: letters/digits plus the combining marks that can sit on them
+# (tashkeel, madda/hamza above and below, superscript alef)
+ARABIC_WORD_PATTERN = re.compile('[\\w\u064b-\u0655\u0670]+')
+
+def strip_arabic_diacritics(text: str) -> str:
+    """Removes Arabic diacritics (tashkeel) from a string"""
+    # Normalize to NFD to decompose characters into base + diacritics
+    normalized_text = unicodedata.normalize('NFD', text)
+    # Filter out characters in the Arabic diacritic range (U+064B to U+0652)
+    return ARABIC_DIACRITICS_PATTERN.sub('', normalized_text)
+
+def replacement_match_key(arabic: str) -> str:
+    """Key word replacements are matched on: diacritics stripped, lowercased, single spaces"""
+    return ' '.join(strip_arabic_diacritics(arabic).lower().split())
+
+# Columns of word_replacements read by get_word_replacements, in order
+REPLACEMENT_COLUMNS = ('original_arabic', 'original_transliteration', 'replacement_arabic',
+                       'replacement_transliteration', 'context', 'reason', 'usage_count', 'match_key')
+
+class ReplacementRule:
+    """A word replacement, compiled for matching"""
+    __slots__ = ('replacement_arabic', 'replacement_transliteration_escaped', 'transliteration_pattern')
+
+    def __init__(self, data: Dict):
+        self.replacement_arabic = data['replacement_arabic']
+        # Escaped for use as a re.sub replacement template
+        self.replacement_transliteration_escaped = data['replacement_transliteration'].replace('\\', '\\\\')
+        self.transliteration_pattern = re.compile(
+            r'\b' + re.escape(data['original_transliteration'].lower()) + r'\b', re.IGNORECASE
+        )
+
+class WordReplacementIndex:
+    """
+    In-memory snapshot of the word_replacements table, compiled for matching.
+
+    Keys are the precomputed match_key column. Matching tokenizes the text into
+    words once and looks up each word (and each run of up to max_words words,
+    for phrase keys) in a dict, so its cost depends on the length of the text
+    rather than on the number of replacements.
+    """
+    def __init__(self, replacements: Dict[str, Dict], version: int):
+        self.version = version
+        self.rules: Dict[str, Tuple[str, ReplacementRule]] = {}
+        self.max_words = 1
+
+        # Sorted so the same key wins every time when several entries only differ in diacritics
+        # (only possible in tables from before duplicates were detected on insert)
+        for original_arabic, data in sorted(replacements.items()):
+            # NULL for rows written without it (by older code or by hand)
+            match_key = data['match_key'] or replacement_match_key(original_arabic)
+            if match_key and match_key not in self.rules:
+                self.rules[match_key] = (original_arabic, ReplacementRule(data))
+                self.max_words = max(self.max_words, match_key.count(' ') + 1)
+
+    def find_matches(self, text: str) -> List[Tuple[int, int, str, ReplacementRule]]:
+        """
+        Find replacements in the text, as (start, end, original_arabic, rule).
+        Longer phrases win over the words they contain, and each rule is applied
+        at most once (its first occurrence).
+        """
+        if not self.rules:
+            return []
+
+        words = [(m.start(), m.end(), strip_arabic_diacritics(m.group()).lower())
+                 for m in ARABIC_WORD_PATTERN.finditer(text)]
+        matches = []
+        used = set()
+        i = 0
+        while i < len(words):
+            matched = 0
+            for count in range(min(self.max_words, len(words) - i), 0, -1):
+                # Only words separated by whitespace form a phrase
+                if count > 1 and text[words[i + count - 2][1]:words[i + count - 1][0]].strip():
+                    continue
+                match_key = words[i][2] if count == 1 else ' '.join(w[2] for w in words[i:i + count])
+                found = self.rules.get(match_key)
+                if found and found[0] not in used:
+                    used.add(found[0])
+                    matches.append((words[i][0], words[i + count - 1][1], found[0], found[1]))
+                    matched = count
+                    break
+            i += matched or 1
+        return matches
+
+class TranslationHistoryWriter:
+    """
+    Write-behind queue for translation_history rows.
+
+    Requests enqueue rows and return immediately; a background thread writes
+    whatever has accumulated (up to HISTORY_BATCH_SIZE rows) in one transaction.
+    """
+    _STOP = object()
+
+    def __init__(self, db: 'LevantineHybridDB', max_queue: int = HISTORY_QUEUE_SIZE,
+                 batch_size: int = HISTORY_BATCH_SIZE):
+        self.db = db
+        self.batch_size = batch_size
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._lock = threading.Lock()
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        self.batches = 0
+        self._thread = threading.Thread(target=self._run, name='translation-history-writer', daemon=True)
+        self._thread.start()
+
+    def submit(self, row: Tuple) -> bool:
+        """Queue a row for writing; returns False (and counts a drop) if the queue is full"""
+        try:
+            self._queue.put_nowait(row)
+            return True
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+            logger.warning("Translation history queue is full, dropping translation for review")
+            return False
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            if item is self._STOP:
+                break
+            batch = [item]
+            while len(batch) < self.batch_size:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is self._STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+
+            try:
+                self.db.save_translations_for_review(batch)
+                with self._lock:
+                    self.written += len(batch)
+                    self.batches += 1
+            except Exception as e:
+                logger.error(f"Error writing {len(batch)} translations for review: {e}")
+                with self._lock:
+                    self.failed += len(batch)
+
+    def close(self, timeout: float = 10):
+        """Write out everything that is queued and stop the writer thread"""
+        if self._thread.is_alive():
+            self._queue.put(self._STOP)
+            self._thread.join(timeout)
+
+    def metrics(self) -> Dict:
+        with self._lock:
+            return {
+                'queue_depth': self._queue.qsize(),
+                'queue_capacity': self._queue.maxsize,
+                'written': self.written,
+                'batches': self.batches,
+                'dropped': self.dropped,
+                'failed': self.failed
+            }
+
+HISTORY_COLUMNS = ('id', 'english_text', 'context_text', 'gemini_arabic', 'gemini_transliteration',
+                   'final_arabic', 'final_transliteration', 'replacements_made', 'status',
+                   'reviewed_by', 'review_notes', 'created_at', 'reviewed_at')
+
+class TranslationHistoryArchive:
+    """
+    Monthly archives of reviewed translation_history rows, by the month they were
+    created in. Either a SQLite database per month (indexed, queried in place) or
+    compressed JSONL (smallest, scanned when queried).
+    Writes are idempotent on id, so a batch can be written again after a failed move.
+    """
+    def __init__(self, directory: str):
+        self.directory = directory
+
+    def path(self, month: str, archive_format: str) -> str:
+        extension = 'db' if archive_format == 'sqlite' else archive_format
+        return os.path.join(self.directory, f"translation_history_{month}.{extension}")
+
+    def write(self, month: str, archive_format: str, rows: List[Tuple]) -> str:
+        """Append rows (in HISTORY_COLUMNS order) to the month's archive, durably; returns its path"""
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.path(month, archive_format)
+        if archive_format == 'sqlite':
+            conn = sqlite3.connect(path)
+            try:
+                conn.execute('''
+                    CREATE TABLE IF NOT EXISTS translation_history (
+                        id INTEGER PRIMARY KEY,
+                        english_text TEXT NOT NULL,
+                        context_text TEXT,
+                        gemini_arabic TEXT NOT NULL,
+                        gemini_transliteration TEXT NOT NULL,
+                        final_arabic TEXT NOT NULL,
+                        final_transliteration TEXT NOT NULL,
+                        replacements_made TEXT,
+                        status TEXT,
+                        reviewed_by TEXT,
+                        review_notes TEXT,
+                        created_at TIMESTAMP,
+                        reviewed_at TIMESTAMP
+                    )
+                ''')
+                conn.execute('CREATE INDEX IF NOT EXISTS idx_archive_status ON translation_history (status, id)')
+                conn.executemany(f'''
+                    INSERT OR REPLACE INTO translation_history ({', '.join(HISTORY_COLUMNS)})
+                    VALUES ({', '.join('?' * len(HISTORY_COLUMNS))})
+                ''', rows)
+                conn.commit()
+            finally:
+                conn.close()
+        else:
+            # Each batch is a gzip member of its own; readers see the concatenation
+            with open(path, 'ab') as f:
+                with gzip.GzipFile(fileobj=f, mode='wb') as gz:
+                    for row in rows:
+                        line = json.dumps(dict(zip(HISTORY_COLUMNS, row)), ensure_ascii=False) + '\n'
+                        gz.write(line.encode('utf-8'))
+                f.flush()
+                os.fsync(f.fileno())
+        return path
+
+    def query(self, path: str, archive_format: str, status: Optional[str] = None, search: Optional[str] = None,
+              after_id: int = 0, limit: int = 50) -> List[Dict]:
+        """Archived rows with id > after_id in id order, optionally by status and english_text substring"""
+        if archive_format == 'sqlite':
+            conditions, params = ['id > ?'], [after_id]
+            if status:
+                conditions.append('status = ?')
+                params.append(status)
+            if search:
+                conditions.append("instr(lower(english_text), ?) > 0")
+                params.append(search.lower())
+            conn = sqlite3.connect(f"file:{urllib.parse.quote(path)}?mode=ro", uri=True)
+            try:
+                rows = conn.execute(f'''
+                    SELECT {', '.join(HISTORY_COLUMNS)} FROM translation_history
+                    WHERE {' AND '.join(conditions)} ORDER BY id LIMIT ?
+                ''', params + [limit]).fetchall()
+            finally:
+                conn.close()
+            records = [dict(zip(HISTORY_COLUMNS, row)) for row in rows]
+        else:
+            # A batch written again after a failed move appears twice; the last copy wins
+            matching = {}
+            with gzip.open(path, 'rt', encoding='utf-8') as f:
+                for line in f:
+                    record = json.loads(line)
+                    if (record['id'] > after_id and (not status or record['status'] == status)
+                            and (not search or search.lower() in record['english_text'].lower())):
+                        matching[record['id']] = record
+            records = [matching[row_id] for row_id in sorted(matching)[:limit]]
+
+        return [
+            {
+                'id': record['id'],
+                'english': record['english_text'],
+                'context': record['context_text'],
+                'gemini_arabic': record['gemini_arabic'],
+                'gemini_transliteration': record['gemini_transliteration'],
+                'final_arabic': record['final_arabic'],
+                'final_transliteration': record['final_transliteration'],
+                'replacements_made': json.loads(record['replacements_made']) if record['replacements_made'] else [],
+                'status': record['status'],
+                'reviewed_by': record['reviewed_by'],
+                'review_notes': record['review_notes'],
+                'created_at': record['created_at'],
+                'reviewed_at': record['reviewed_at']
+            }
+            for record in records
+        ]
+
+# hybrid_stats: the counter of each review status, and the triggers maintaining the counters
+STATS_REVIEW_COUNTS = {
+    'pending_reviews': 'pending',
+    'approved_reviews': 'approved',
+    'declined_reviews': 'declined',
+}
+STATS_TRIGGERS = ('hybrid_stats_history_replace', 'hybrid_stats_history_insert', 'hybrid_stats_history_status',
+                  'hybrid_stats_history_delete', 'hybrid_stats_approved_replace', 'hybrid_stats_approved_insert',
+                  'hybrid_stats_approved_delete', 'hybrid_stats_replacement_insert', 'hybrid_stats_replacement_key',
+                  'hybrid_stats_replacement_usage', 'hybrid_stats_replacement_delete')
+TOP_REPLACEMENT_QUERY = '''
+    (SELECT original_arabic FROM word_replacements ORDER BY usage_count DESC, id LIMIT 1)
+'''
+
+class LevantineHybridDB:
+    """
+    The hybrid service database. Opening it creates and migrates the schema, and
+    starts the background usage count flusher and history writer. Maintenance
+    scripts pass background=False (writes go straight to the database), or
+    read_only=True to only read an existing database as it is.
+    """
+    def __init__(self, db_path='levantine_hybrid.db', archive_dir: Optional[str] = None,
+                 background: bool = True, read_only: bool = False):
+        self.db_path = db_path
+        self.read_only = read_only
+        self.pool = SQLiteConnectionPool(db_path, read_only=read_only)
+        # Compiled replacement index; rebuilt when the version in replacements_version changes
+        self._replacement_index: Optional[WordReplacementIndex] = None
+        self._index_lock = threading.Lock()
+        # Pending usage count increments, by original_arabic
+        self._pending_usage = Counter()
+        self._pending_usage_total = 0
+        self._usage_lock = threading.Lock()
+        self._flush_requested = threading.Event()
+        self._closed = threading.Event()
+        self._memory_lock = threading.Lock()
+        self.memory_lookups = Counter()
+        self.archive = TranslationHistoryArchive(archive_dir or HISTORY_ARCHIVE_DIR or os.path.join(
+            os.path.dirname(os.path.abspath(db_path)), 'translation_history_archive'))
+        self._usage_flusher: Optional[threading.Thread] = None
+        self.history_writer: Optional[TranslationHistoryWriter] = None
+        if read_only:
+            return
+        self.init_database()
+
+        if background:
+            self._usage_flusher = threading.Thread(target=self._flush_usage_periodically,
+                                                   name='usage-count-flusher', daemon=True)
+            self._usage_flusher.start()
+            self.history_writer = TranslationHistoryWriter(self)
+            atexit.register(self.close)
+
+    def close(self):
+        """Flush pending usage counts and close idle connections"""
+        if self._closed.is_set():
+            return
+        self._closed.set()
+        if self.history_writer:
+            self.history_writer.close()
+        if self._usage_flusher:
+            self._flush_requested.set()
+            self._usage_flusher.join(timeout=5)
+        if not self.read_only:
+            self.flush_usage_counts()
+        self.pool.close_all()
+    
+    def init_database(self):
+        """Initialize the SQLite database with required tables"""
+        with self.pool.transaction() as conn:
+            self._create_tables(conn)
+            self._migrate(conn)
+        self._backfill_memory_keys()
+        logger.info("Hybrid database initialized successfully")
+
+    def _migrations(self) -> List:
+        """
+        Schema changes to databases created by earlier versions, in order.
+        PRAGMA user_version records how many have been applied. Only ever append.
+        """
+        return [
+            self._add_review_queue_index,
+            self._add_stats_table,
+            self._add_approved_pair_index,
+            self._add_translation_memory,
+            self._add_history_archive,
+            self._add_replacement_match_key,
+            self._rebuild_stats_triggers,
+            self._add_replacements_version,
+            self._add_translation_memory_keys,
+            self._add_approved_history_id,
+            self._add_review_queue_cursor_index,
+        ]
+
+    def _migrate(self, conn: sqlite3.Connection):
+        """Apply the migrations this database hasn't seen yet, each in its own transaction"""
+        migrations = self._migrations()
+        while True:
+            conn.execute('BEGIN IMMEDIATE')  # Another process may be migrating too
+            version = conn.execute('PRAGMA user_version').fetchone()[0]
+            if version >= len(migrations):
+                conn.rollback()
+                return
+            migrations[version](conn.cursor())
+            conn.execute(f'PRAGMA user_version = {version + 1}')
+            conn.commit()
+            logger.info(f"Applied database migration {version + 1}: {migrations[version].__name__}")
+
+    def _add_review_queue_index(self, cursor: sqlite3.Cursor):
+        # Serves the pending review queue: WHERE status = ? ORDER BY created_at DESC, id DESC
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_translation_history_status_created
+            ON translation_history (status, created_at, id)
+        ''')
+
+    def _create_tables(self, conn: sqlite3.Connection):
+        cursor = conn.cursor()
+        
+        # Word replacements table
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS word_replacements (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                original_arabic TEXT NOT NULL,
+                original_transliteration TEXT NOT NULL,
+                replacement_arabic TEXT NOT NULL,
+                replacement_transliteration TEXT NOT NULL,
+                context TEXT,
+                reason TEXT,
+                usage_count INTEGER DEFAULT 0,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                UNIQUE(original_arabic)
+            )
+        ''')
+        
+        # Translation history for review
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS translation_history (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                english_text TEXT NOT NULL,
+                context_text TEXT,
+                gemini_arabic TEXT NOT NULL,
+                gemini_transliteration TEXT NOT NULL,
+                final_arabic TEXT NOT NULL,
+                final_transliteration TEXT NOT NULL,
+                replacements_made TEXT, -- JSON string of replacements
+                status TEXT DEFAULT 'pending', -- pending, approved, declined
+                reviewed_by TEXT,
+                review_notes TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                reviewed_at TIMESTAMP
+            )
+        ''')
+        
+        # Training data for future model
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS approved_translations (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                english_text TEXT NOT NULL,
+                arabic_text TEXT NOT NULL,
+                transliteration TEXT NOT NULL,
+                context TEXT,
+                quality_score REAL DEFAULT 1.0,
+                source TEXT DEFAULT 'approved', -- approved, manual_addition
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+
+        # Raw Gemini responses, keyed on the normalized request (see GeminiResponseCache)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS gemini_cache (
+                english_key TEXT NOT NULL,
+                context_key TEXT NOT NULL,
+                prompt_version TEXT NOT NULL,
+                arabic TEXT NOT NULL,
+                transliteration TEXT NOT NULL,
+                created_at REAL NOT NULL, -- unix time
+                PRIMARY KEY (english_key, context_key, prompt_version)
+            )
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_gemini_cache_created_at ON gemini_cache (created_at)')
+    
+    def _add_stats_table(self, cursor: sqlite3.Cursor):
+        # Counters for /stats, kept up to date by triggers in the same transaction as each write
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS hybrid_stats (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                pending_reviews INTEGER NOT NULL,
+                approved_reviews INTEGER NOT NULL,
+                declined_reviews INTEGER NOT NULL,
+                approved_translations INTEGER NOT NULL,
+                word_replacements_count INTEGER NOT NULL,
+                total_usage INTEGER NOT NULL,
+                top_replacement TEXT -- original_arabic of the most used replacement
+            )
+        ''')
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_word_replacements_usage
+            ON word_replacements (usage_count DESC, id)
+        ''')
+        self._count_stats(cursor)
+        self._create_stats_triggers(cursor)
+
+    def _rebuild_stats_triggers(self, cursor: sqlite3.Cursor):
+        # The first triggers relied on PRAGMA recursive_triggers to see rows removed by
+        # INSERT OR REPLACE, so writes from other connections could skew the counters
+        for trigger in STATS_TRIGGERS:
+            cursor.execute(f'DROP TRIGGER IF EXISTS {trigger}')
+        self._create_stats_triggers(cursor)
+        self._count_stats(cursor)
+
+    def _count_stats(self, cursor: sqlite3.Cursor):
+        """(Re)compute the hybrid_stats counters from the tables"""
+        cursor.execute(f'''
+            INSERT OR REPLACE INTO hybrid_stats
+            SELECT 1,
+                   (SELECT COUNT(*) FROM translation_history WHERE status = 'pending'),
+                   (SELECT COUNT(*) FROM translation_history WHERE status = 'approved'),
+                   (SELECT COUNT(*) FROM translation_history WHERE status = 'declined'),
+                   (SELECT COUNT(*) FROM approved_translations),
+                   (SELECT COUNT(*) FROM word_replacements),
+                   (SELECT COALESCE(SUM(usage_count), 0) FROM word_replacements),
+                   {TOP_REPLACEMENT_QUERY}
+        ''')
+
+    def _create_stats_triggers(self, cursor: sqlite3.Cursor):
+        """
+        Triggers keeping hybrid_stats in step with every write, from any connection.
+        Statements one by one (not executescript, which would commit the migration early).
+
+        A row removed by INSERT OR REPLACE only fires delete triggers when PRAGMA
+        recursive_triggers is on, so the triggers don't depend on them seeing it:
+        translation_history and approved_translations delete a row whose id is being
+        inserted again first (through the delete triggers), and the word_replacements
+        counters, a small table, are recounted on every insert or change of key.
+        """
+        def adjust_reviews(row: str, sign: str) -> str:
+            return ', '.join(f"{column} = {column} {sign} ({row}.status = '{status}')"
+                             for column, status in STATS_REVIEW_COUNTS.items())
+
+        recount_replacements = f'''
+            UPDATE hybrid_stats SET word_replacements_count = (SELECT COUNT(*) FROM word_replacements),
+                                    total_usage = (SELECT COALESCE(SUM(usage_count), 0) FROM word_replacements),
+                                    top_replacement = {TOP_REPLACEMENT_QUERY}
+            WHERE id = 1;
+        '''
+        triggers = {
+            'hybrid_stats_history_replace': '''
+                BEFORE INSERT ON translation_history
+                WHEN NEW.id IS NOT NULL AND EXISTS (SELECT 1 FROM translation_history WHERE id = NEW.id)
+                BEGIN
+                    DELETE FROM translation_history WHERE id = NEW.id;
+                END
+            ''',
+            'hybrid_stats_history_insert': f'''
+                AFTER INSERT ON translation_history
+                BEGIN
+                    UPDATE hybrid_stats SET {adjust_reviews('NEW', '+')} WHERE id = 1;
+                END
+            ''',
+            'hybrid_stats_history_status': f'''
+                AFTER UPDATE OF status ON translation_history
+                BEGIN
+                    UPDATE hybrid_stats SET {adjust_reviews('OLD', '-')} WHERE id = 1;
+                    UPDATE hybrid_stats SET {adjust_reviews('NEW', '+')} WHERE id = 1;
+                END
+            ''',
+            'hybrid_stats_history_delete': f'''
+                AFTER DELETE ON translation_history
+                BEGIN
+                    UPDATE hybrid_stats SET {adjust_reviews('OLD', '-')} WHERE id = 1;
+                END
+            ''',
+            'hybrid_stats_approved_replace': '''
+                BEFORE INSERT ON approved_translations
+                WHEN NEW.id IS NOT NULL AND EXISTS (SELECT 1 FROM approved_translations WHERE id = NEW.id)
+                BEGIN
+                    DELETE FROM approved_translations WHERE id = NEW.id;
+                END
+            ''',
+            'hybrid_stats_approved_insert': '''
+                AFTER INSERT ON approved_translations
+                BEGIN
+                    UPDATE hybrid_stats SET approved_translations = approved_translations + 1 WHERE id = 1;
+                END
+            ''',
+            'hybrid_stats_approved_delete': '''
+                AFTER DELETE ON approved_translations
+                BEGIN
+                    UPDATE hybrid_stats SET approved_translations = approved_translations - 1 WHERE id = 1;
+                END
+            ''',
+            'hybrid_stats_replacement_insert': f'''
+                AFTER INSERT ON word_replacements
+                BEGIN
+                    {recount_replacements}
+                END
+            ''',
+            # UPDATE OR REPLACE of original_arabic can remove the row it collides with
+            'hybrid_stats_replacement_key': f'''
+                AFTER UPDATE OF original_arabic ON word_replacements
+                BEGIN
+                    {recount_replacements}
+                END
+            ''',
+            'hybrid_stats_replacement_usage': f'''
+                AFTER UPDATE OF usage_count ON word_replacements
+                BEGIN
+                    UPDATE hybrid_stats SET total_usage = total_usage + NEW.usage_count - OLD.usage_count,
+                                            top_replacement = {TOP_REPLACEMENT_QUERY}
+                    WHERE id = 1;
+                END
+            ''',
+            'hybrid_stats_replacement_delete': f'''
+                AFTER DELETE ON word_replacements
+                BEGIN
+                    {recount_replacements}
+                END
+            ''',
+        }
+        for name in STATS_TRIGGERS:
+            cursor.execute(f'CREATE TRIGGER IF NOT EXISTS {name} {triggers[name]}')
+
+    def _add_approved_pair_index(self, cursor: sqlite3.Cursor):
+        # Lets the training export find the first occurrence of each english/arabic pair
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_approved_translations_pair
+            ON approved_translations (english_text, arabic_text, id)
+        ''')
+
+    def _add_translation_memory(self, cursor: sqlite3.Cursor):
+        # Exact lookups: normalized english_text (see lookup_translation_memory)
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_approved_translations_english_key
+            ON approved_translations (lower(trim(english_text)))
+        ''')
+        # Fuzzy lookups: trigram full-text index over english_text, kept in sync by triggers.
+        # Statements one by one (not executescript, which would commit the migration early)
+        try:
+            cursor.execute('''
+                CREATE VIRTUAL TABLE translation_memory USING fts5(
+                    english_text, content='approved_translations', content_rowid='id', tokenize='trigram'
+                )
+            ''')
+        except sqlite3.OperationalError as e:
+            # SQLite older than 3.34 or built without FTS5: exact lookups still work
+            logger.warning(f"Fuzzy translation memory unavailable ({e}); only exact matches will be used")
+            return
+        cursor.execute('''
+            CREATE TRIGGER translation_memory_insert AFTER INSERT ON approved_translations
+            BEGIN
+                INSERT INTO translation_memory (rowid, english_text) VALUES (NEW.id, NEW.english_text);
+            END
+        ''')
+        cursor.execute('''
+            CREATE TRIGGER translation_memory_delete AFTER DELETE ON approved_translations
+            BEGIN
+                INSERT INTO translation_memory (translation_memory, rowid, english_text)
+                VALUES ('delete', OLD.id, OLD.english_text);
+            END
+        ''')
+        cursor.execute('''
+            CREATE TRIGGER translation_memory_update AFTER UPDATE OF english_text ON approved_translations
+            BEGIN
+                INSERT INTO translation_memory (translation_memory, rowid, english_text)
+                VALUES ('delete', OLD.id, OLD.english_text);
+                INSERT INTO translation_memory (rowid, english_text) VALUES (NEW.id, NEW.english_text);
+            END
+        ''')
+        cursor.execute("INSERT INTO translation_memory (translation_memory) VALUES ('rebuild')")
+
+    def _add_translation_memory_keys(self, cursor: sqlite3.Cursor):
+        # normalize_translation_key() of english_text and context, which lookups compare against.
+        # SQL's lower(trim()) neither collapses inner whitespace nor lowercases non-ASCII letters
+        cursor.execute('ALTER TABLE approved_translations ADD COLUMN english_key TEXT')
+        cursor.execute('ALTER TABLE approved_translations ADD COLUMN context_key TEXT')
+        rows = cursor.execute('SELECT id, english_text, context FROM approved_translations').fetchall()
+        cursor.executemany('UPDATE approved_translations SET english_key = ?, context_key = ? WHERE id = ?',
+                           [normalize_translation_key(english, context) + (row_id,)
+                            for row_id, english, context in rows])
+        cursor.execute('DROP INDEX IF EXISTS idx_approved_translations_english_key')
+        cursor.execute('''
+            CREATE INDEX idx_approved_translations_memory_key
+            ON approved_translations (english_key, context_key)
+        ''')
+        if not self._has_fuzzy_memory(cursor.connection):
+            return
+        # Fuzzy lookups match against the normalized key too
+        for trigger in ('translation_memory_insert', 'translation_memory_delete', 'translation_memory_update'):
+            cursor.execute(f'DROP TRIGGER {trigger}')
+        cursor.execute('DROP TABLE translation_memory')
+        cursor.execute('''
+            CREATE VIRTUAL TABLE translation_memory USING fts5(
+                english_key, content='approved_translations', content_rowid='id', tokenize='trigram'
+            )
+        ''')
+        cursor.execute('''
+            CREATE TRIGGER translation_memory_insert AFTER INSERT ON approved_translations
+            BEGIN
+                INSERT INTO translation_memory (rowid, english_key) VALUES (NEW.id, NEW.english_key);
+            END
+        ''')
+        cursor.execute('''
+            CREATE TRIGGER translation_memory_delete AFTER DELETE ON approved_translations
+            BEGIN
+                INSERT INTO translation_memory (translation_memory, rowid, english_key)
+                VALUES ('delete', OLD.id, OLD.english_key);
+            END
+        ''')
+        cursor.execute('''
+            CREATE TRIGGER translation_memory_update AFTER UPDATE OF english_key ON approved_translations
+            BEGIN
+                INSERT INTO translation_memory (translation_memory, rowid, english_key)
+                VALUES ('delete', OLD.id, OLD.english_key);
+                INSERT INTO translation_memory (rowid, english_key) VALUES (NEW.id, NEW.english_key);
+            END
+        ''')
+        cursor.execute("INSERT INTO translation_memory (translation_memory) VALUES ('rebuild')")
+
+    def _backfill_memory_keys(self):
+        """Fill in the translation memory keys of rows inserted without them (by older code or by hand)"""
+        with self.pool.transaction() as conn:
+            rows = conn.execute(
+                'SELECT id, english_text, context FROM approved_translations WHERE english_key IS NULL'
+            ).fetchall()
+            conn.executemany('UPDATE approved_translations SET english_key = ?, context_key = ? WHERE id = ?',
+                             [normalize_translation_key(english, context) + (row_id,)
+                              for row_id, english, context in rows])
+        if rows:
+            logger.info(f"Filled in translation memory keys for {len(rows)} approved translations")
+
+    def _add_approved_history_id(self, cursor: sqlite3.Cursor):
+        # The translation_history row an approved translation was copied from, so declining
+        # the row afterwards can take the copy out of the training data
+        cursor.execute('ALTER TABLE approved_translations ADD COLUMN history_id INTEGER')
+        # Link existing copies to the approved rows with the same content, oldest to oldest
+        sources = {}
+        for row in cursor.execute('''
+            SELECT id, english_text, final_arabic, final_transliteration, context_text
+            FROM translation_history WHERE status = 'approved' ORDER BY id
+        '''):
+            sources.setdefault(row[1:], []).append(row[0])
+        links = []
+        for row in cursor.execute('''
+            SELECT id, english_text, arabic_text, transliteration, context
+            FROM approved_translations WHERE source = 'approved' ORDER BY id
+        ''').fetchall():
+            history_ids = sources.get(row[1:])
+            if history_ids:
+                links.append((history_ids.pop(0), row[0]))
+        cursor.executemany('UPDATE approved_translations SET history_id = ? WHERE id = ?', links)
+        cursor.execute('''
+            CREATE INDEX idx_approved_translations_history_id
+            ON approved_translations (history_id) WHERE history_id IS NOT NULL
+        ''')
+
+    def _add_review_queue_cursor_index(self, cursor: sqlite3.Cursor):
+        # The review queue sorts NULL created_at (rows written by hand) as '', so cursors
+        # can point at them; this replaces the index on the bare column
+        cursor.execute('DROP INDEX IF EXISTS idx_translation_history_status_created')
+        cursor.execute('''
+            CREATE INDEX idx_translation_history_status_queue
+            ON translation_history (status, COALESCE(created_at, ''), id)
+        ''')
+
+    def _add_history_archive(self, cursor: sqlite3.Cursor):
+        # Serves the retention job: reviewed rows by age (see archive_reviewed_history)
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_translation_history_reviewed_at
+            ON translation_history (reviewed_at) WHERE status IN ('approved', 'declined')
+        ''')
+        # Archived months, where their rows are and how many of each status were moved
+        cursor.execute('''
+            CREATE TABLE history_archives (
+                month TEXT PRIMARY KEY, -- YYYY-MM of created_at
+                path TEXT NOT NULL,
+                format TEXT NOT NULL, -- sqlite, jsonl.gz
+                approved INTEGER NOT NULL DEFAULT 0,
+                declined INTEGER NOT NULL DEFAULT 0,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+
+    def _add_replacement_match_key(self, cursor: sqlite3.Cursor):
+        # replacement_match_key(original_arabic), for duplicate detection and point lookups.
+        # Computed in Python, so it is written along with original_arabic rather than by a trigger
+        cursor.execute('ALTER TABLE word_replacements ADD COLUMN match_key TEXT')
+        rows = cursor.execute('SELECT id, original_arabic FROM word_replacements').fetchall()
+        cursor.executemany('UPDATE word_replacements SET match_key = ? WHERE id = ?',
+                           [(replacement_match_key(original_arabic), row_id) for row_id, original_arabic in rows])
+        # Not unique: older tables can hold entries that only differ in diacritics
+        cursor.execute('CREATE INDEX idx_word_replacements_match_key ON word_replacements (match_key)')
+
+    def _add_replacements_version(self, cursor: sqlite3.Cursor):
+        # Lets every process (the Flask and async services, several workers) see that its
+        # compiled replacement index is stale. Usage count updates don't change the index
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS replacements_version (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                version INTEGER NOT NULL
+            )
+        ''')
+        cursor.execute('INSERT OR IGNORE INTO replacements_version VALUES (1, 0)')
+        bump = 'UPDATE replacements_version SET version = version + 1 WHERE id = 1;'
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS replacements_version_insert AFTER INSERT ON word_replacements
+            BEGIN {bump} END
+        ''')
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS replacements_version_update
+            AFTER UPDATE OF original_arabic, original_transliteration, replacement_arabic,
+                            replacement_transliteration, context, reason, match_key ON word_replacements
+            BEGIN {bump} END
+        ''')
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS replacements_version_delete AFTER DELETE ON word_replacements
+            BEGIN {bump} END
+        ''')
+
+    def add_word_replacement(self, original_arabic: str, original_transliteration: str,
+                           replacement_arabic: str, replacement_transliteration: str,
+                           context: str = "", reason: str = "") -> Optional[str]:
+        """
+        Add a word replacement. If there already is one for the same word ignoring diacritics
+        (كرة when كُرة exists), that entry is updated instead, keeping its spelling and usage
+        count. Returns the original_arabic of the updated entry, or None if one was added.
+        """
+        match_key = replacement_match_key(original_arabic)
+        if not match_key:
+            raise ValueError("original_arabic is empty")
+
+        with self.pool.transaction() as conn:
+            # Take the write lock before reading, so two adds of the same word can't both insert
+            conn.execute('BEGIN IMMEDIATE')
+            existing = conn.execute('''
+                SELECT id, original_arabic FROM word_replacements WHERE match_key = ?
+                ORDER BY original_arabic LIMIT 1
+            ''', (match_key,)).fetchone()
+            if existing:
+                conn.execute('''
+                    UPDATE word_replacements
+                    SET original_transliteration = ?, replacement_arabic = ?, replacement_transliteration = ?,
+                        context = ?, reason = ?
+                    WHERE id = ?
+                ''', (original_transliteration, replacement_arabic, replacement_transliteration, context, reason,
+                      existing[0]))
+            else:
+                conn.execute('''
+                    INSERT INTO word_replacements
+                    (original_arabic, original_transliteration, replacement_arabic, replacement_transliteration,
+                     context, reason, match_key)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                ''', (original_arabic, original_transliteration, replacement_arabic, replacement_transliteration,
+                      context, reason, match_key))
+        
+        if existing:
+            logger.info(f"Updated word replacement: {existing[1]} -> {replacement_arabic}")
+            return existing[1]
+        logger.info(f"Added word replacement: {original_arabic} -> {replacement_arabic}")
+        return None
+    
+    def get_word_replacements(self) -> Dict[str, Dict]:
+        """Get all word replacements"""
+        # Include increments that are still buffered
+        self.flush_usage_counts()
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+        
+            cursor.execute(f"SELECT {', '.join(REPLACEMENT_COLUMNS)} FROM word_replacements")
+        
+            rows = cursor.fetchall()
+
+        replacements = self._replacements_from_rows(rows)
+        missing = [original_arabic for original_arabic, data in replacements.items() if data['match_key'] is None]
+        if missing:
+            self._backfill_match_keys(missing)
+            for original_arabic in missing:
+                replacements[original_arabic]['match_key'] = replacement_match_key(original_arabic)
+        return replacements
+
+    def _backfill_match_keys(self, originals: List[str]):
+        """Fill in match_key for rows inserted without it, so point lookups find them"""
+        try:
+            with self.pool.transaction() as conn:
+                conn.executemany(
+                    'UPDATE word_replacements SET match_key = ? WHERE original_arabic = ? AND match_key IS NULL',
+                    [(replacement_match_key(original_arabic), original_arabic) for original_arabic in originals]
+                )
+            logger.info(f"Filled in match_key for {len(originals)} word replacements")
+        except sqlite3.Error as e:
+            logger.error(f"Error filling in match_key, will retry: {e}")
+
+    def find_word_replacements(self, arabic_text: str) -> Dict[str, Dict]:
+        """
+        The word replacements that match a word or phrase of arabic_text (see
+        apply_word_replacements), found by point lookups on match_key.
+        """
+        self.flush_usage_counts()
+        words = [replacement_match_key(m.group()) for m in ARABIC_WORD_PATTERN.finditer(arabic_text)]
+        # Phrase keys can't be longer than the longest one in the table
+        max_words = self.get_replacement_index().max_words
+        candidates = {' '.join(words[i:i + count])
+                      for i in range(len(words)) for count in range(1, min(max_words, len(words) - i) + 1)}
+        with self.pool.connection() as conn:
+            rows = conn.execute(f'''
+                SELECT {', '.join(REPLACEMENT_COLUMNS)} FROM word_replacements
+                WHERE match_key IN (SELECT value FROM json_each(?))
+            ''', (json.dumps(sorted(candidates), ensure_ascii=False),)).fetchall()
+        return self._replacements_from_rows(rows)
+
+    @staticmethod
+    def _replacements_from_rows(rows: List[Tuple]) -> Dict[str, Dict]:
+        replacements = {}
+        for row in rows:
+            replacements[row[0]] = {
+                'original_transliteration': row[1],
+                'replacement_arabic': row[2],
+                'replacement_transliteration': row[3],
+                'context': row[4],
+                'reason': row[5],
+                'usage_count': row[6],
+                'match_key': row[7]
+            }
+        
+        return replacements
+    
+    def _strip_arabic_diacritics(self, text: str) -> str:
+        """Removes Arabic diacritics (tashkeel) from a string"""
+        return strip_arabic_diacritics(text)
+
+    def get_replacements_version(self) -> int:
+        """Version of the word_replacements table, bumped by triggers on every change from any process"""
+        with self.pool.connection() as conn:
+            return conn.execute('SELECT version FROM replacements_version WHERE id = 1').fetchone()[0]
+
+    def get_replacement_index(self) -> 'WordReplacementIndex':
+        """Get the compiled replacement index, rebuilding it if the table changed"""
+        version = self.get_replacements_version()
+        index = self._replacement_index
+        if index is not None and index.version == version:
+            return index
+
+        with self._index_lock:
+            index = self._replacement_index
+            # Read before the rows: a change in between only causes one more rebuild
+            version = self.get_replacements_version()
+            if index is None or index.version != version:
+                index = WordReplacementIndex(self.get_word_replacements(), version)
+                self._replacement_index = index
+            return index
+
+    def apply_word_replacements(self, arabic_text: str, transliteration_text: str,
+                                count_usage: bool = True) -> Tuple[str, str, List[str]]:
+        """
+        Apply word replacements to Arabic and transliteration, ignoring diacritics for matching.
+        count_usage=False leaves usage counts alone, for a preview that is applied again later.
+        """
+        index = self.get_replacement_index()
+        replacements_made = []
+        new_transliteration = transliteration_text
+        pieces = []
+        position = 0
+
+        for start, end, original_arabic, rule in index.find_matches(arabic_text):
+            pieces.append(arabic_text[position:start])
+            pieces.append(rule.replacement_arabic)
+            position = end
+
+            # Replace corresponding transliteration, case-insensitive and as a whole word
+            new_transliteration = rule.transliteration_pattern.sub(
+                rule.replacement_transliteration_escaped, new_transliteration, count=1
+            )
+
+            replacements_made.append(f"{original_arabic} → {rule.replacement_arabic}")
+            if count_usage:
+                self.increment_usage_count(original_arabic)
+
+        pieces.append(arabic_text[position:])
+        return ''.join(pieces), new_transliteration, replacements_made
+    
+    def increment_usage_count(self, original_arabic: str):
+        """Increment usage count for a replacement (buffered, see flush_usage_counts)"""
+        with self._usage_lock:
+            self._pending_usage[original_arabic] += 1
+            self._pending_usage_total += 1
+            if self._pending_usage_total >= USAGE_FLUSH_THRESHOLD:
+                self._flush_requested.set()
+
+    def flush_usage_counts(self):
+        """Write all buffered usage count increments in a single transaction"""
+        with self._usage_lock:
+            if not self._pending_usage:
+                return
+            pending = self._pending_usage
+            self._pending_usage = Counter()
+            self._pending_usage_total = 0
+
+        try:
+            with self.pool.transaction() as conn:
+                conn.executemany('''
+                    UPDATE word_replacements 
+                    SET usage_count = usage_count + ? 
+                    WHERE original_arabic = ?
+                ''', [(count, original_arabic) for original_arabic, count in pending.items()])
+        except Exception as e:
+            logger.error(f"Error flushing usage counts, will retry: {e}")
+            with self._usage_lock:
+                self._pending_usage.update(pending)
+                self._pending_usage_total += sum(pending.values())
+
+    def _flush_usage_periodically(self):
+        while not self._closed.is_set():
+            self._flush_requested.wait(USAGE_FLUSH_INTERVAL)
+            self._flush_requested.clear()
+            self.flush_usage_counts()
+    
+    def save_translation_for_review(self, english: str, context: str, gemini_arabic: str, 
+                                  gemini_transliteration: str, final_arabic: str, 
+                                  final_transliteration: str, replacements_made: List[str]):
+        """Save translation for manual review"""
+        self.save_translations_for_review([
+            self._review_row(english, context, gemini_arabic, gemini_transliteration,
+                             final_arabic, final_transliteration, replacements_made)
+        ])
+
+    def queue_translation_for_review(self, english: str, context: str, gemini_arabic: str, 
+                                     gemini_transliteration: str, final_arabic: str, 
+                                     final_transliteration: str, replacements_made: List[str]) -> bool:
+        """Save translation for manual review in the background; returns False if it was dropped"""
+        row = self._review_row(english, context, gemini_arabic, gemini_transliteration,
+                               final_arabic, final_transliteration, replacements_made)
+        if self.history_writer is None:
+            self.save_translations_for_review([row])
+            return True
+        return self.history_writer.submit(row)
+
+    def save_translations_for_review(self, rows: List[Tuple]):
+        """Insert several translation_history rows (built by _review_row) in one transaction"""
+        with self.pool.transaction() as conn:
+            conn.executemany('''
+                INSERT INTO translation_history 
+                (english_text, context_text, gemini_arabic, gemini_transliteration, 
+                 final_arabic, final_transliteration, replacements_made)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', rows)
+
+    def _review_row(self, english: str, context: str, gemini_arabic: str, 
+                    gemini_transliteration: str, final_arabic: str, 
+                    final_transliteration: str, replacements_made: List[str]) -> Tuple:
+        return (english, context, gemini_arabic, gemini_transliteration, 
+                final_arabic, final_transliteration, json.dumps(replacements_made))
+    
+    def get_pending_reviews(self, limit: int = 50, before: Optional[Tuple[str, int]] = None) -> List[Dict]:
+        """
+        Get translations pending review, newest first (rows without created_at last).
+        Pass the (created_at or '', id) of the last row of a page as before to get the next page.
+        """
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+        
+            if before is None:
+                cursor.execute('''
+                    SELECT id, english_text, context_text, gemini_arabic, gemini_transliteration,
+                           final_arabic, final_transliteration, replacements_made, created_at
+                    FROM translation_history 
+                    WHERE status = 'pending'
+                    ORDER BY COALESCE(created_at, '') DESC, id DESC
+                    LIMIT ?
+                ''', (limit,))
+            else:
+                cursor.execute('''
+                    SELECT id, english_text, context_text, gemini_arabic, gemini_transliteration,
+                           final_arabic, final_transliteration, replacements_made, created_at
+                    FROM translation_history 
+                    WHERE status = 'pending' AND COALESCE(created_at, '') <= ?
+                      AND (COALESCE(created_at, ''), id) < (?, ?)
+                    ORDER BY COALESCE(created_at, '') DESC, id DESC
+                    LIMIT ?
+                ''', (before[0], before[0], before[1], limit))
+        
+            rows = cursor.fetchall()
+        
+        return [
+            {
+                'id': row[0],
+                'english': row[1],
+                'context': row[2],
+                'gemini_arabic': row[3],
+                'gemini_transliteration': row[4],
+                'final_arabic': row[5],
+                'final_transliteration': row[6],
+                'replacements_made': json.loads(row[7]) if row[7] else [],
+                'created_at': row[8]
+            }
+            for row in rows
+        ]
+    
+    def approve_translation(self, translation_id: int, reviewer: str = "admin", notes: str = ""):
+        """Approve a translation and add to training data"""
+        self.review_translations('approved', [translation_id], reviewer=reviewer, notes=notes)
+        logger.info(f"Approved translation ID: {translation_id}")
+
+    def decline_translation(self, translation_id: int, reviewer: str = "admin", notes: str = ""):
+        """Decline a translation, taking it out of the training data if it was approved"""
+        self.review_translations('declined', [translation_id], reviewer=reviewer, notes=notes)
+        logger.info(f"Declined translation ID: {translation_id}")
+
+    @staticmethod
+    def _insert_approved_translations(conn: sqlite3.Connection, history_ids_json: str):
+        """
+        Copy the translation_history rows with the given ids (a JSON list) into
+        approved_translations, with their memory keys
+        """
+        conn.execute('''
+            INSERT INTO approved_translations
+            (english_text, arabic_text, transliteration, context, history_id, english_key, context_key)
+            SELECT english_text, final_arabic, final_transliteration, context_text, id,
+                   translation_key(english_text), translation_key(context_text)
+            FROM translation_history
+            WHERE id IN (SELECT value FROM json_each(?))
+            ORDER BY id
+        ''', (history_ids_json,))
+
+    def review_translations(self, status: str, ids: Optional[List[int]] = None, filters: Optional[Dict] = None,
+                            reviewer: str = "admin", notes: str = "",
+                            limit: int = MAX_BULK_REVIEW_IDS) -> List[Dict]:
+        """
+        Approve or decline many translations in one transaction.
+
+        Targets are either explicit ids, or the rows matching filters:
+          status          - current status (default 'pending')
+          no_replacements - only rows where no word replacement was applied
+          created_before  - only rows created before this timestamp ('YYYY-MM-DD HH:MM:SS')
+        With filters, at most limit rows are reviewed (the oldest first); the status
+        filter can't be the target status, since those rows would be unchanged.
+        Approved rows are copied into approved_translations; declining a row that was
+        approved removes its copy.
+        Returns [{'id': ..., 'outcome': ...}] with outcome one of status ('approved' /
+        'declined'), 'unchanged' (already had that status) or 'not_found'.
+        """
+        if status not in ('approved', 'declined'):
+            raise ValueError(f"Invalid review status: {status}")
+        if ids is None and (filters or {}).get('status', 'pending') == status:
+            raise ValueError(f"Filter status is already {status}")
+
+        with self.pool.transaction() as conn:
+            # Take the write lock before reading, so the targets can't change under us
+            conn.execute('BEGIN IMMEDIATE')
+            if ids is not None:
+                rows = conn.execute('''
+                    SELECT id, status FROM translation_history
+                    WHERE id IN (SELECT value FROM json_each(?))
+                ''', (json.dumps(ids),)).fetchall()
+            else:
+                filters = filters or {}
+                conditions = ['status = ?']
+                params = [filters.get('status', 'pending')]
+                if filters.get('no_replacements'):
+                    conditions.append("(replacements_made IS NULL OR replacements_made IN ('', '[]'))")
+                if filters.get('created_before'):
+                    conditions.append('created_at < ?')
+                    params.append(filters['created_before'])
+                rows = conn.execute(f'''
+                    SELECT id, status FROM translation_history WHERE {' AND '.join(conditions)}
+                    ORDER BY id LIMIT ?
+                ''', params + [limit]).fetchall()
+
+            current = dict(rows)
+            targets = [row_id for row_id, row_status in rows if row_status != status]
+            if targets:
+                target_json = json.dumps(targets)
+                if status == 'approved':
+                    self._insert_approved_translations(conn, target_json)
+                else:
+                    conn.execute('''
+                        DELETE FROM approved_translations WHERE history_id IN (SELECT value FROM json_each(?))
+                    ''', (json.dumps([row_id for row_id in targets if current[row_id] == 'approved']),))
+                conn.execute('''
+                    UPDATE translation_history 
+                    SET status = ?, reviewed_by = ?, review_notes = ?, reviewed_at = CURRENT_TIMESTAMP
+                    WHERE id IN (SELECT value FROM json_each(?))
+                ''', (status, reviewer, notes, target_json))
+
+        outcomes = []
+        for row_id in (ids if ids is not None else current):
+            if row_id not in current:
+                outcome = 'not_found'
+            elif current[row_id] == status:
+                outcome = 'unchanged'
+            else:
+                outcome = status
+            outcomes.append({'id': row_id, 'outcome': outcome})
+        logger.info(f"Bulk review: {len(targets)} translations {status}")
+        return outcomes
+
+    def get_stats(self) -> Dict:
+        """Read the counters maintained in hybrid_stats, plus the most used replacement"""
+        # Buffered usage counts aren't in the table yet
+        self.flush_usage_counts()
+        with self.pool.connection() as conn:
+            row = conn.execute('''
+                SELECT pending_reviews, approved_reviews, declined_reviews, approved_translations,
+                       word_replacements_count, total_usage, top_replacement
+                FROM hybrid_stats WHERE id = 1
+            ''').fetchone()
+            # Reviews moved to the archives aren't in hybrid_stats any more
+            archived = conn.execute(
+                'SELECT COALESCE(SUM(approved), 0), COALESCE(SUM(declined), 0) FROM history_archives'
+            ).fetchone()
+            top = None
+            if row[6] is not None:
+                top = conn.execute('''
+                    SELECT original_transliteration, replacement_arabic, replacement_transliteration,
+                           context, reason, usage_count
+                    FROM word_replacements WHERE original_arabic = ?
+                ''', (row[6],)).fetchone()
+
+        return {
+            'pending_reviews': row[0],
+            'approved_reviews': row[1] + archived[0],
+            'declined_reviews': row[2] + archived[1],
+            'archived_reviews': archived[0] + archived[1],
+            'approved_translations': row[3],
+            'word_replacements_count': row[4],
+            'total_usage': row[5],
+            'most_used_replacement': (row[6], {
+                'original_transliteration': top[0],
+                'replacement_arabic': top[1],
+                'replacement_transliteration': top[2],
+                'context': top[3],
+                'reason': top[4],
+                'usage_count': top[5]
+            }) if top else (None, {'usage_count': 0})
+        }
+
+    def get_export_watermark(self) -> int:
+        """Highest approved_translations id, to pass as since_id to the next incremental export"""
+        with self.pool.connection() as conn:
+            return conn.execute('SELECT COALESCE(MAX(id), 0) FROM approved_translations').fetchone()[0]
+
+    def iter_approved_translations(self, since_id: int = 0, until_id: Optional[int] = None,
+                                   dedup: bool = True) -> Iterator[Dict]:
+        """
+        Stream approved translations with since_id < id <= until_id, in id order,
+        reading rows from the cursor as they are consumed (constant memory).
+        With dedup, a pair is skipped if the same english/arabic pair has a lower id,
+        including pairs exported by earlier incremental exports.
+        """
+        if until_id is None:
+            until_id = self.get_export_watermark()
+        query = '''
+            SELECT id, english_text, arabic_text, transliteration, context, quality_score, source, created_at
+            FROM approved_translations a
+            WHERE id > ? AND id <= ?
+        '''
+        if dedup:
+            query += '''
+              AND NOT EXISTS (
+                  SELECT 1 FROM approved_translations b
+                  WHERE b.english_text = a.english_text AND b.arabic_text = a.arabic_text AND b.id < a.id
+              )
+            '''
+        query += ' ORDER BY id'
+
+        with self.pool.connection() as conn:
+            cursor = conn.execute(query, (since_id, until_id))
+            for row in cursor:
+                yield {
+                    'id': row[0],
+                    'english': row[1],
+                    'arabic': row[2],
+                    'transliteration': row[3],
+                    'context': row[4],
+                    'quality_score': row[5],
+                    'source': row[6],
+                    'created_at': row[7]
+                }
+
+    def lookup_translation_memory(self, english_text: str, context: Optional[str],
+                                  mode: str = TRANSLATION_MEMORY_MODE,
+                                  threshold: float = TRANSLATION_MEMORY_THRESHOLD) -> Optional[Dict]:
+        """
+        Find an approved translation of the same english_text (or, in 'fuzzy' mode, a
+        near-identical one) with the same context. Returns the match with its
+        similarity (1.0 for exact matches), or None.
+        """
+        if mode == 'off':
+            return None
+        english_key, context_key = normalize_translation_key(english_text, context)
+        columns = 'a.id, a.english_text, a.arabic_text, a.transliteration, a.english_key'
+        match_type = None
+
+        with self.pool.connection() as conn:
+            # Highest quality first, then the most recent review
+            match = conn.execute(f'''
+                SELECT {columns} FROM approved_translations a
+                WHERE a.english_key = ? AND a.context_key = ?
+                ORDER BY a.quality_score DESC, a.id DESC LIMIT 1
+            ''', (english_key, context_key)).fetchone()
+            if match:
+                match_type, similarity = 'exact', 1.0
+
+            elif mode == 'fuzzy' and len(english_key) >= 3 and self._has_fuzzy_memory(conn):
+                # A string up to two edits away from the input still contains all but two
+                # of its pieces verbatim; with the trigram tokenizer a quoted piece is a
+                # substring match. Closest in length to the input first: ranking by bm25
+                # would score every row that matches.
+                size = max(3, -(-len(english_key) // TRANSLATION_MEMORY_QUERY_PIECES))
+                pieces = [english_key[i:i + size] for i in range(0, len(english_key), size)]
+                pieces = ['"' + piece.replace('"', '""') + '"' for piece in pieces if len(piece) >= 3]
+                query = ' OR '.join('(' + ' AND '.join(combination) + ')'
+                                    for combination in combinations(pieces, max(1, len(pieces) - 2)))
+                # SequenceMatcher's ratio is at most 2 * shorter / (sum of lengths)
+                min_length = int(len(english_key) * threshold / (2 - threshold))
+                max_length = int(len(english_key) * (2 - threshold) / threshold) + 1
+                candidates = conn.execute(f'''
+                    SELECT {columns} FROM translation_memory
+                    JOIN approved_translations a ON a.id = translation_memory.rowid
+                    WHERE translation_memory MATCH ? AND a.context_key = ?
+                      AND length(a.english_key) BETWEEN ? AND ?
+                    ORDER BY abs(length(a.english_key) - ?), a.id DESC
+                    LIMIT ?
+                ''', (query, context_key, min_length, max_length, len(english_key),
+                      TRANSLATION_MEMORY_CANDIDATES)).fetchall()
+                similarity = 0.0
+                for candidate in candidates:
+                    ratio = SequenceMatcher(None, english_key, candidate[4]).ratio()
+                    if ratio > similarity:
+                        match, similarity = candidate, ratio
+                if match and similarity >= threshold:
+                    match_type = 'fuzzy'
+
+        with self._memory_lock:
+            self.memory_lookups[f'{match_type}_hits' if match_type else 'misses'] += 1
+        if match_type is None:
+            return None
+        return {
+            'id': match[0],
+            'english': match[1],
+            'arabic': match[2],
+            'transliteration': match[3],
+            'match': match_type,
+            'similarity': round(similarity, 3)
+        }
+
+    def _has_fuzzy_memory(self, conn: sqlite3.Connection) -> bool:
+        return conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'translation_memory'"
+        ).fetchone() is not None
+
+    def archive_reviewed_history(self, older_than_days: float = HISTORY_RETENTION_DAYS,
+                                 archive_format: str = HISTORY_ARCHIVE_FORMAT,
+                                 batch_size: int = HISTORY_ARCHIVE_BATCH_SIZE) -> Dict[str, int]:
+        """
+        Move approved/declined translation_history rows reviewed more than older_than_days
+        ago to the monthly archives (by created_at, or reviewed_at where that is NULL),
+        batch_size rows at a time. Rows are written to the archive first, then deleted
+        here in a short write transaction; months archived earlier keep their format.
+        Returns the number of rows moved per month.
+        """
+        if archive_format not in HISTORY_ARCHIVE_FORMATS:
+            raise ValueError(f"Invalid archive format: {archive_format}")
+        created_at = HISTORY_COLUMNS.index('created_at')
+        reviewed_at = HISTORY_COLUMNS.index('reviewed_at')
+        status = HISTORY_COLUMNS.index('status')
+        moved = Counter()
+        while True:
+            # The archive files are written without holding the write lock
+            with self.pool.connection() as conn:
+                rows = conn.execute(f'''
+                    SELECT {', '.join(HISTORY_COLUMNS)} FROM translation_history
+                    WHERE status IN ('approved', 'declined') AND reviewed_at < datetime('now', ?)
+                    LIMIT ?
+                ''', (f'-{older_than_days} days', batch_size)).fetchall()
+                if not rows:
+                    break
+                by_month = {}
+                for row in rows:
+                    # created_at can be NULL in rows written by hand
+                    by_month.setdefault((row[created_at] or row[reviewed_at])[:7], []).append(row)
+                formats = dict(conn.execute(
+                    'SELECT month, format FROM history_archives WHERE month IN (SELECT value FROM json_each(?))',
+                    (json.dumps(list(by_month)),)
+                ).fetchall())
+            paths = {}
+            for month, month_rows in by_month.items():
+                formats.setdefault(month, archive_format)
+                paths[month] = self.archive.write(month, formats[month], month_rows)
+
+            with self.pool.transaction() as conn:
+                conn.execute('BEGIN IMMEDIATE')
+                # Only delete rows that weren't reviewed again while the archives were written;
+                # the others are archived again (their new state overwriting the old) by a later run
+                unchanged = {row_id for row_id, in conn.execute('''
+                    SELECT h.id FROM translation_history h
+                    JOIN json_each(?) archived ON h.id = json_extract(archived.value, '$[0]')
+                    WHERE h.status = json_extract(archived.value, '$[1]')
+                      AND h.reviewed_at = json_extract(archived.value, '$[2]')
+                ''', (json.dumps([(row[0], row[status], row[reviewed_at]) for row in rows]),))}
+                for month, month_rows in by_month.items():
+                    statuses = Counter(row[status] for row in month_rows if row[0] in unchanged)
+                    conn.execute('''
+                        INSERT INTO history_archives (month, path, format, approved, declined)
+                        VALUES (?, ?, ?, ?, ?)
+                        ON CONFLICT (month) DO UPDATE SET approved = approved + excluded.approved,
+                                                          declined = declined + excluded.declined,
+                                                          updated_at = CURRENT_TIMESTAMP
+                    ''', (month, paths[month], formats[month], statuses['approved'], statuses['declined']))
+                    moved[month] += sum(statuses.values())
+                # The hybrid_stats triggers take the rows out of the review counters
+                conn.execute('DELETE FROM translation_history WHERE id IN (SELECT value FROM json_each(?))',
+                             (json.dumps(sorted(unchanged)),))
+            logger.info(f"Archived {len(unchanged)} reviewed translations")
+        return dict(moved)
+
+    def enable_incremental_vacuum(self) -> bool:
+        """
+        Switch a database created before auto_vacuum was set to incremental mode.
+        This needs a one-off full VACUUM, which rewrites the file and blocks writers
+        while it runs. Returns True if the database was converted.
+        """
+        with self.pool.connection() as conn:
+            if conn.execute('PRAGMA auto_vacuum').fetchone()[0] == 2:
+                return False
+            conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+            conn.execute('VACUUM')
+        logger.info("Database converted to incremental auto_vacuum")
+        return True
+
+    def incremental_vacuum(self, pages: int = INCREMENTAL_VACUUM_PAGES) -> int:
+        """
+        Return free pages to the filesystem, a few at a time so each step holds the
+        write lock only briefly, then truncate the WAL. Returns the number of pages released.
+        """
+        released = 0
+        with self.pool.connection() as conn:
+            if conn.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+                return 0
+            free = conn.execute('PRAGMA freelist_count').fetchone()[0]
+            while free:
+                # The pragma only runs to completion once its result is fetched
+                conn.execute(f'PRAGMA incremental_vacuum({int(pages)})').fetchall()
+                remaining = conn.execute('PRAGMA freelist_count').fetchone()[0]
+                if remaining >= free:
+                    break
+                released += free - remaining
+                free = remaining
+            conn.execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchall()
+        return released
+
+    def get_history_archives(self) -> List[Dict]:
+        """Archived months, oldest first"""
+        with self.pool.connection() as conn:
+            rows = conn.execute('''
+                SELECT month, path, format, approved, declined, updated_at FROM history_archives ORDER BY month
+            ''').fetchall()
+        return [
+            {
+                'month': row[0],
+                'path': row[1],
+                'format': row[2],
+                'approved': row[3],
+                'declined': row[4],
+                'updated_at': row[5]
+            }
+            for row in rows
+        ]
+
+    def query_history_archive(self, month: str, status: Optional[str] = None, search: Optional[str] = None,
+                              after_id: int = 0, limit: int = 50) -> Optional[List[Dict]]:
+        """Archived rows of one month (see TranslationHistoryArchive.query), or None if it isn't archived"""
+        with self.pool.connection() as conn:
+            row = conn.execute('SELECT path, format FROM history_archives WHERE month = ?', (month,)).fetchone()
+        if row is None:
+            return None
+        return self.archive.query(row[0], row[1], status, search, after_id, limit)
+
+    def get_approved_translations_count(self) -> int:
+        """Get count of approved translations for training"""
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+        
+            cursor.execute('SELECT COUNT(*) FROM approved_translations')
+            count = cursor.fetchone()[0]
+        return count
+
+# Shared by the single and batch prompts
+def translation_key_text(text: Optional[str]) -> str:
+    """Lowercase text and collapse its whitespace (Unicode-aware, unlike SQLite's lower())"""
+    return ' '.join((text or '').lower().split())
+
+def normalize_translation_key(text: str, context: Optional[str]) -> Tuple[str, str]:
+    """Normalize an (english_text, context) request so trivially different requests share a key"""
+    return translation_key_text(text), translation_key_text(context)
+
+
+EXPORT_FIELDS = ('id', 'english', 'arabic', 'transliteration', 'context', 'quality_score', 'source', 'created_at')
+
+def format_export(rows: Iterator[Dict], export_format: str) -> Iterator[str]:
+    """Encode exported rows one line at a time as 'jsonl' or 'csv' (with a header row)"""
+    if export_format == 'jsonl':
+        for row in rows:
+            yield json.dumps(row, ensure_ascii=False) + '\n'
+    elif export_format == 'csv':
+        buffer = io.StringIO()
+        writer = csv.DictWriter(buffer, fieldnames=EXPORT_FIELDS)
+        writer.writeheader()
+        for row in rows:
+            writer.writerow(row)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        # The header, if there were no rows
+        yield buffer.getvalue()
+    else:
+        raise ValueError(f"Unknown export format: {export_format}")
@@ -1,14 +1,25 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response, stream_with_context
 from flask_cors import CORS
-import sqlite3
 import json
 import os
 import requests
 from datetime import datetime
 import logging
-from typing import List, Dict, Tuple, Optional
-import unicodedata
+from typing import List, Dict, Iterator, Tuple, Optional, Union
 import re
+import time
+import random
+import base64
+import binascii
+import threading
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+
+from hybrid_db import (
+    MAX_BULK_REVIEW_IDS, TRANSLATION_MEMORY_MODE, TRANSLATION_MEMORY_MODES, TRANSLATION_MEMORY_THRESHOLD,
+    LevantineHybridDB, format_export, normalize_translation_key
+)
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
@@ -17,351 +28,47 @@ logger = logging.getLogger(__name__)
 app = Flask(__name__)
 CORS(app)
 
-class LevantineHybridDB:
-    def __init__(self, db_path='levantine_hybrid.db'):
-        self.db_path = db_path
-        self.init_database()
-    
-    def init_database(self):
-        """Initialize the SQLite database with required tables"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        # Word replacements table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS word_replacements (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                original_arabic TEXT NOT NULL,
-                original_transliteration TEXT NOT NULL,
-                replacement_arabic TEXT NOT NULL,
-                replacement_transliteration TEXT NOT NULL,
-                context TEXT,
-                reason TEXT,
-                usage_count INTEGER DEFAULT 0,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                UNIQUE(original_arabic)
-            )
-        ''')
-        
-        # Translation history for review
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS translation_history (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                english_text TEXT NOT NULL,
-                context_text TEXT,
-                gemini_arabic TEXT NOT NULL,
-                gemini_transliteration TEXT NOT NULL,
-                final_arabic TEXT NOT NULL,
-                final_transliteration TEXT NOT NULL,
-                replacements_made TEXT, -- JSON string of replacements
-                status TEXT DEFAULT 'pending', -- pending, approved, declined
-                reviewed_by TEXT,
-                review_notes TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                reviewed_at TIMESTAMP
-            )
-        ''')
-        
-        # Training data for future model
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS approved_translations (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                english_text TEXT NOT NULL,
-                arabic_text TEXT NOT NULL,
-                transliteration TEXT NOT NULL,
-                context TEXT,
-                quality_score REAL DEFAULT 1.0,
-                source TEXT DEFAULT 'approved', -- approved, manual_addition
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        conn.commit()
-        conn.close()
-        logger.info("Hybrid database initialized successfully")
-    
-    def add_word_replacement(self, original_arabic: str, original_transliteration: str,
-                           replacement_arabic: str, replacement_transliteration: str,
-                           context: str = "", reason: str = ""):
-        """Add or update a word replacement"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            INSERT OR REPLACE INTO word_replacements 
-            (original_arabic, original_transliteration, replacement_arabic, replacement_transliteration, context, reason)
-            VALUES (?, ?, ?, ?, ?, ?)
-        ''', (original_arabic, original_transliteration, replacement_arabic, replacement_transliteration, context, reason))
-        
-        conn.commit()
-        conn.close()
-        logger.info(f"Added word replacement: {original_arabic} -> {replacement_arabic}")
-    
-    def get_word_replacements(self) -> Dict[str, Dict]:
-        """Get all word replacements"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            SELECT original_arabic, original_transliteration, replacement_arabic, 
-                   replacement_transliteration, context, reason, usage_count
-            FROM word_replacements
-        ''')
-        
-        rows = cursor.fetchall()
-        conn.close()
-        
-        replacements = {}
-        for row in rows:
-            replacements[row[0]] = {
-                'original_transliteration': row[1],
-                'replacement_arabic': row[2],
-                'replacement_transliteration': row[3],
-                'context': row[4],
-                'reason': row[5],
-                'usage_count': row[6]
-            }
-        
-        return replacements
-    
-    def _strip_arabic_diacritics(self, text: str) -> str:
-        """Removes Arabic diacritics (tashkeel) from a string"""
-        # Normalize to NFD to decompose characters into base + diacritics
-        normalized_text = unicodedata.normalize('NFD', text)
-        # Filter out characters in the Arabic diacritic range (U+064B to U+0652)
-        stripped_text = ''.join(char for char in normalized_text if not '\u064b' <= char <= '\u0652')
-        return stripped_text
-
-    def apply_word_replacements(self, arabic_text: str, transliteration_text: str) -> Tuple[str, str, List[str]]:
-        """Apply word replacements to Arabic and transliteration, ignoring diacritics for matching"""
-        replacements = self.get_word_replacements()
-        replacements_made = []
-        new_arabic = arabic_text # Work with a mutable copy
-        new_transliteration = transliteration_text # Work with a mutable copy
-        
-        # Sort replacements by length in descending order to handle longer phrases first
-        sorted_replacements = sorted(replacements.items(), key=lambda item: len(item[0]), reverse=True)
-
-        for original_arabic, replacement_data in sorted_replacements:
-            # Create a regex pattern that matches original_arabic characters with optional diacritics in between
-            # Escape special regex characters in the original_arabic word
-            escaped_original_arabic = ''.join(re.escape(char) + '[\u064b-\u0652]*' for char in original_arabic)
-            
-            # Use regex to find the word in the new_arabic text, ignoring diacritics in the text
-            # This pattern looks for the sequence of non-diacritic characters from original_arabic,
-            # allowing any diacritics in between.
-            # Add word boundaries (\b) to ensure full word match, but be cautious with Arabic
-            # word boundaries can be tricky due to ligatures and connected letters.
-            # A simpler, possibly more reliable approach for basic words is to just check presence
-            # and replace, but let's try with a more robust regex for exact words.
-
-            # Alternative regex pattern: Match the exact characters of original_arabic, allowing diacritics after each.
-            # This might be too strict if the original_arabic in DB is missing diacritics that Gemini adds.
-            # Let's try stripping diacritics from both for comparison and use regex on the original string.
-
-            stripped_original_arabic = self._strip_arabic_diacritics(original_arabic)
-            stripped_new_arabic_lower = self._strip_arabic_diacritics(new_arabic).lower()
-            stripped_original_arabic_lower = stripped_original_arabic.lower()
-
-            # Check if the stripped original word exists within the stripped current translation
-            if stripped_original_arabic_lower in stripped_new_arabic_lower:
-                # If found, construct a regex to replace the word in the original text (with diacritics)
-                # This regex will match the original_arabic characters with any diacritics following them.
-                pattern = ''.join(re.escape(char) + '[\u064b-\u0652]*' for char in original_arabic)
-                
-                # Perform replacement using the compiled regex
-                # We use a function in sub to preserve case in the rest of the string if needed, but for Arabic it's less relevant.
-                # We need to be careful not to replace partial words incorrectly.
-                # Let's refine the regex to ensure it matches word boundaries more safely.
-                # Using lookarounds might be too complex. A simpler approach is needed.
-
-                # Revert to a simpler check and replace, but after stripping diacritics for comparison.
-                # We already did the stripped check. Now replace in the original string.
-                # This naive replace might replace parts of words if not careful, but it's a starting point.
-                # For more accuracy, we would need a more sophisticated Arabic word tokenization.
-
-                # Let's try replacing the *stripped* version in the *stripped* text first, 
-                # then find the index in the original and replace there.
-                # This is also complex. The simplest is a regex that matches the characters but ignores diacritics in the source string.
-
-                # Refined regex pattern: Match the sequence of characters from original_arabic, allowing any diacritics in the source string.
-                # This requires building the regex character by character.
-                
-                # Let's rebuild the pattern to match original_arabic characters but allow diacritics in the input string.
-                regex_pattern = ''.join(
-                    f'{re.escape(char)}[\u064b-\u0652]*' 
-                    for char in original_arabic 
-                    if '\u0600' <= char <= '\u06FF' # Only process Arabic letters/numbers
-                )
-                # Add word boundaries for more safety, though imperfect for Arabic.
-                # If original_arabic is a phrase, don't use boundaries.
-                if len(original_arabic.split()) == 1:
-                    regex_pattern = r'\b' + regex_pattern + r'\b'
-
-                # Check if the pattern exists in the *original* new_arabic text
-                if re.search(regex_pattern, new_arabic):
-                    # Perform the replacement using regex
-                    new_arabic = re.sub(
-                        regex_pattern, 
-                        replacement_data['replacement_arabic'], 
-                        new_arabic, 
-                        count=1 # Replace only the first occurrence per replacement rule
-                    )
-                    
-                    # Replace corresponding transliteration (simpler string replace is usually sufficient here)
-                    # Ensure case-insensitivity for transliteration replacement
-                    original_translit_lower = replacement_data['original_transliteration'].lower()
-                    replacement_translit = replacement_data['replacement_transliteration']
-                    
-                    # Use regex for transliteration replacement with word boundaries and case insensitivity
-                    translit_pattern = r'\b' + re.escape(original_translit_lower) + r'\b'
-                    new_transliteration = re.sub(
-                        translit_pattern, 
-                        replacement_translit, 
-                        new_transliteration, 
-                        flags=re.IGNORECASE, 
-                        count=1
-                    )
-                    
-                    replacements_made.append(f"{original_arabic} → {replacement_data['replacement_arabic']}")
-                    
-                    # Increment usage count (assuming the replacement happened)
-                    self.increment_usage_count(original_arabic)
+GEMINI_API_URL = os.environ.get(
+    'GEMINI_API_URL',
+    "https://generativelanguage.googleapis.com/v1beta/models/gemini-1.5-flash:generateContent"
+)
+# Keep-alive connections kept open to the Gemini API, shared by all request threads
+GEMINI_POOL_SIZE = int(os.environ.get('GEMINI_POOL_SIZE', '20'))
+# Streaming variant of the API, used by /translate_stream
+GEMINI_STREAM_API_URL = os.environ.get(
+    'GEMINI_STREAM_API_URL', GEMINI_API_URL.replace(':generateContent', ':streamGenerateContent')
+)
+GEMINI_CONNECT_TIMEOUT = float(os.environ.get('GEMINI_CONNECT_TIMEOUT', '5'))
+GEMINI_READ_TIMEOUT = float(os.environ.get('GEMINI_READ_TIMEOUT', '30'))
+# Total time one Gemini call may take, retries included; keep it below the
+# frontend's 30s request timeout so callers get an answer before they give up
+GEMINI_DEADLINE = float(os.environ.get('GEMINI_DEADLINE', '25'))
+# Attempts per call for retryable failures, with jittered exponential backoff between them
+GEMINI_MAX_ATTEMPTS = int(os.environ.get('GEMINI_MAX_ATTEMPTS', '3'))
+GEMINI_BACKOFF_BASE = 0.5
+GEMINI_BACKOFF_MAX = 8.0
+GEMINI_RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+# The circuit breaker opens after this many consecutive upstream failures, and lets
+# a trial call through once GEMINI_BREAKER_RESET_TIMEOUT seconds have passed
+GEMINI_BREAKER_FAILURE_THRESHOLD = int(os.environ.get('GEMINI_BREAKER_FAILURE_THRESHOLD', '5'))
+GEMINI_BREAKER_RESET_TIMEOUT = float(os.environ.get('GEMINI_BREAKER_RESET_TIMEOUT', '30'))
+# Phrases packed into one batch prompt, and the most a /translate_batch request may send
+GEMINI_BATCH_SIZE = int(os.environ.get('GEMINI_BATCH_SIZE', '25'))
+MAX_BATCH_REQUEST_ITEMS = 500
+# Batch prompts of one request sent at the same time, so the MAX_BATCH_REQUEST_ITEMS / GEMINI_BATCH_SIZE
+# prompts of a full request take a few rounds of Gemini latency rather than fill GEMINI_DEADLINE
+GEMINI_BATCH_CONCURRENCY = int(os.environ.get('GEMINI_BATCH_CONCURRENCY', '5'))
+MAX_REVIEW_PAGE_SIZE = 500
+# Number of API keys whose GeminiTranslator is kept for reuse
+GEMINI_TRANSLATOR_CACHE_SIZE = 128
+# Raw Gemini translations are cached in the database for GEMINI_CACHE_TTL seconds,
+# keeping at most GEMINI_CACHE_MAX_ENTRIES (oldest evicted first)
+GEMINI_CACHE_TTL = float(os.environ.get('GEMINI_CACHE_TTL', str(30 * 24 * 3600)))
+GEMINI_CACHE_MAX_ENTRIES = int(os.environ.get('GEMINI_CACHE_MAX_ENTRIES', '50000'))
+# Eviction runs once every this many cache writes
+GEMINI_CACHE_EVICT_EVERY = 100
 
-        return new_arabic, new_transliteration, replacements_made
-    
-    def increment_usage_count(self, original_arabic: str):
-        """Increment usage count for a replacement"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            UPDATE word_replacements 
-            SET usage_count = usage_count + 1 
-            WHERE original_arabic = ?
-        ''', (original_arabic,))
-        
-        conn.commit()
-        conn.close()
-    
-    def save_translation_for_review(self, english: str, context: str, gemini_arabic: str, 
-                                  gemini_transliteration: str, final_arabic: str, 
-                                  final_transliteration: str, replacements_made: List[str]):
-        """Save translation for manual review"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            INSERT INTO translation_history 
-            (english_text, context_text, gemini_arabic, gemini_transliteration, 
-             final_arabic, final_transliteration, replacements_made)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-        ''', (english, context, gemini_arabic, gemini_transliteration, 
-              final_arabic, final_transliteration, json.dumps(replacements_made)))
-        
-        conn.commit()
-        conn.close()
-    
-    def get_pending_reviews(self, limit: int = 50) -> List[Dict]:
-        """Get translations pending review"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            SELECT id, english_text, context_text, gemini_arabic, gemini_transliteration,
-                   final_arabic, final_transliteration, replacements_made, created_at
-            FROM translation_history 
-            WHERE status = 'pending'
-            ORDER BY created_at DESC
-            LIMIT ?
-        ''', (limit,))
-        
-        rows = cursor.fetchall()
-        conn.close()
-        
-        return [
-            {
-                'id': row[0],
-                'english': row[1],
-                'context': row[2],
-                'gemini_arabic': row[3],
-                'gemini_transliteration': row[4],
-                'final_arabic': row[5],
-                'final_transliteration': row[6],
-                'replacements_made': json.loads(row[7]) if row[7] else [],
-                'created_at': row[8]
-            }
-            for row in rows
-        ]
-    
-    def approve_translation(self, translation_id: int, reviewer: str = "admin", notes: str = ""):
-        """Approve a translation and add to training data"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        # Get the translation
-        cursor.execute('''
-            SELECT english_text, final_arabic, final_transliteration, context_text
-            FROM translation_history WHERE id = ?
-        ''', (translation_id,))
-        
-        row = cursor.fetchone()
-        if row:
-            # Update status
-            cursor.execute('''
-                UPDATE translation_history 
-                SET status = 'approved', reviewed_by = ?, review_notes = ?, reviewed_at = CURRENT_TIMESTAMP
-                WHERE id = ?
-            ''', (reviewer, notes, translation_id))
-            
-            # Add to approved translations
-            cursor.execute('''
-                INSERT INTO approved_translations 
-                (english_text, arabic_text, transliteration, context)
-                VALUES (?, ?, ?, ?)
-            ''', (row[0], row[1], row[2], row[3]))
-        
-        conn.commit()
-        conn.close()
-        logger.info(f"Approved translation ID: {translation_id}")
-    
-    def decline_translation(self, translation_id: int, reviewer: str = "admin", notes: str = ""):
-        """Decline a translation"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            UPDATE translation_history 
-            SET status = 'declined', reviewed_by = ?, review_notes = ?, reviewed_at = CURRENT_TIMESTAMP
-            WHERE id = ?
-        ''', (reviewer, notes, translation_id))
-        
-        conn.commit()
-        conn.close()
-        logger.info(f"Declined translation ID: {translation_id}")
-    
-    def get_approved_translations_count(self) -> int:
-        """Get count of approved translations for training"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('SELECT COUNT(*) FROM approved_translations')
-        count = cursor.fetchone()[0]
-        
-        conn.close()
-        return count
-
-class GeminiTranslator:
-    def __init__(self, api_key: str):
-        self.api_key = api_key
-        self.base_url = "https://generativelanguage.googleapis.com/v1beta/models/gemini-1.5-flash:generateContent"
-    
-    def translate(self, text: str, context: str = "") -> Tuple[str, str]:
-        """Translate using Gemini API"""
-        prompt = f"""
-Translate "{text}" to colloquial Levantine Arabic (Lebanese/Syrian/Palestinian/Jordanian), not MSA{f', context: "{context}"' if context else ''}.
-
-CRITICAL: Use NATURAL DAILY SPEECH as actually spoken on the street, NOT formal or literary Arabic.
+LEVANTINE_GUIDELINES = """CRITICAL: Use NATURAL DAILY SPEECH as actually spoken on the street, NOT formal or literary Arabic.
 
 DIACRITICS REQUIREMENT: **ALL Arabic text MUST include FULL diacritics (tashkeel)** - fatha (َ), damma (ُ), kasra (ِ), sukun (ْ), shadda (ّ), tanween, etc.
 
@@ -373,7 +80,201 @@ Essential Levantine patterns:
 • Question words: "شو" (shu) for "what", "وين" (wen) for "where", "كيف" (kif) for "how", "ليش" (lesh) for "why", "إيمتى" (emta) for "when", "أديش" (adesh) for "how much/many"
 • Pronouns: "إنت" (inta/i) for "you", "إحنا" (ehna) for "we", "إنتوا" (entoo) for "you plural", "هنن" (hennen) for "they"
 • Negation: Use "مش" (mish) or "مو" (mo) - avoid formal "لا" or "لم"
+"""
+# Block headers in batch responses: "[3]" (or "3." / "3)")
+BATCH_HEADER_PATTERN = re.compile(r'^\[?(\d+)(?:\]|[.)])$')
+
+class TranslationLineParser:
+    """
+    Incremental parser for the Arabic:/Transliteration: response format. Feed it
+    text as it streams in; each field is returned as soon as its line is complete.
+    """
+    FIELDS = ('arabic', 'transliteration')
+
+    def __init__(self):
+        self._buffer = ''
+        self.fields: Dict[str, str] = {}
+
+    def feed(self, chunk: str) -> List[Tuple[str, str]]:
+        """Add streamed text; returns the (field, value) pairs completed by it"""
+        self._buffer += chunk
+        *lines, self._buffer = self._buffer.split('\n')
+        return self._parse_lines(lines)
+
+    def close(self) -> List[Tuple[str, str]]:
+        """End of the response: parse the last line, which has no newline"""
+        lines, self._buffer = [self._buffer], ''
+        return self._parse_lines(lines)
+
+    def _parse_lines(self, lines: List[str]) -> List[Tuple[str, str]]:
+        completed = []
+        for line in lines:
+            line = line.strip()
+            for field in self.FIELDS:
+                if line.lower().startswith(field + ':') and field not in self.fields:
+                    self.fields[field] = line.split(':', 1)[1].strip()
+                    completed.append((field, self.fields[field]))
+        return completed
+
+class GeminiError(Exception):
+    """A Gemini call failed (error status, timeout or connection error)"""
+    def __init__(self, message: str, retryable: bool = False, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.retryable = retryable
+        self.retry_after = retry_after
+
+class GeminiUnavailable(GeminiError):
+    """Gemini wasn't called because the circuit breaker is open"""
+
+class CircuitBreaker:
+    """
+    Fails calls fast while an upstream is down. Closed: calls go through, and
+    failure_threshold consecutive failures open the breaker. Open: calls are
+    rejected until reset_timeout has passed. Half open: a single trial call goes
+    through; its success closes the breaker, its failure opens it again.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold: int = GEMINI_BREAKER_FAILURE_THRESHOLD,
+                 reset_timeout: float = GEMINI_BREAKER_RESET_TIMEOUT):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.consecutive_failures = 0
+            self.opened_at = 0.0
+            self._trial_running = False
+            self.times_opened = 0
+            self.rejected = 0
+
+    def allow(self) -> bool:
+        """Whether a call may go to the upstream now; callers must then record its outcome"""
+        with self._lock:
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                self._trial_running = False
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.HALF_OPEN and not self._trial_running:
+                self._trial_running = True
+                return True
+            self.rejected += 1
+            return False
+
+    def record_success(self):
+        with self._lock:
+            if self.state != self.CLOSED:
+                logger.info("Gemini circuit breaker closed")
+            self.state = self.CLOSED
+            self.consecutive_failures = 0
+            self._trial_running = False
+
+    def record_neutral(self):
+        """An outcome saying nothing about the upstream's health (rate limited): ends a half-open trial"""
+        with self._lock:
+            self._trial_running = False
 
+    def record_failure(self):
+        with self._lock:
+            self.consecutive_failures += 1
+            if self.state == self.HALF_OPEN or (
+                    self.state == self.CLOSED and self.consecutive_failures >= self.failure_threshold):
+                logger.warning(f"Gemini circuit breaker opened after {self.consecutive_failures} "
+                               f"consecutive failures")
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+                self._trial_running = False
+                self.times_opened += 1
+
+    def retry_after(self) -> float:
+        """Seconds until the breaker lets a trial call through (0 unless open)"""
+        with self._lock:
+            if self.state != self.OPEN:
+                return 0.0
+            return max(0.0, self.reset_timeout - (time.monotonic() - self.opened_at))
+
+    def metrics(self) -> Dict:
+        retry_after = self.retry_after()
+        with self._lock:
+            return {
+                'state': self.state,
+                'consecutive_failures': self.consecutive_failures,
+                'times_opened': self.times_opened,
+                'rejected': self.rejected,
+                'retry_after': round(retry_after, 1)
+            }
+
+# Shared by all translators: API keys differ, the upstream is the same
+gemini_breaker = CircuitBreaker()
+
+_gemini_session: Optional[requests.Session] = None
+_gemini_translators: 'OrderedDict[str, GeminiTranslator]' = OrderedDict()
+_gemini_lock = threading.Lock()
+
+def get_gemini_session() -> requests.Session:
+    """Process-wide HTTP session, so calls to Gemini reuse keep-alive connections"""
+    global _gemini_session
+    with _gemini_lock:
+        if _gemini_session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=GEMINI_POOL_SIZE)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            session.headers.update({"Content-Type": "application/json"})
+            _gemini_session = session
+        return _gemini_session
+
+def get_gemini_translator(api_key: str) -> 'GeminiTranslator':
+    """Get the translator for an API key, reusing it across requests"""
+    with _gemini_lock:
+        translator = _gemini_translators.get(api_key)
+        if translator is not None:
+            _gemini_translators.move_to_end(api_key)
+            return translator
+
+    translator = GeminiTranslator(api_key)
+    with _gemini_lock:
+        _gemini_translators[api_key] = translator
+        while len(_gemini_translators) > GEMINI_TRANSLATOR_CACHE_SIZE:
+            _gemini_translators.popitem(last=False)
+    return translator
+
+class GeminiTranslator:
+    # Bump whenever the prompt changes, so cached responses to the old prompt aren't used
+    PROMPT_VERSION = 'levantine-v1'
+
+    def __init__(self, api_key: str, session: Optional[requests.Session] = None,
+                 breaker: Optional[CircuitBreaker] = None):
+        self.api_key = api_key
+        self.base_url = GEMINI_API_URL
+        self.stream_url = GEMINI_STREAM_API_URL
+        self.session = session or get_gemini_session()
+        self.breaker = breaker or gemini_breaker
+        self.timeout = (GEMINI_CONNECT_TIMEOUT, GEMINI_READ_TIMEOUT)
+        self.deadline = GEMINI_DEADLINE
+        self.max_attempts = GEMINI_MAX_ATTEMPTS
+    
+    def translate(self, text: str, context: str = "", deadline: Optional[float] = None) -> Tuple[str, str]:
+        """Translate using Gemini API; raises GeminiError if the call fails"""
+        try:
+            response_text = self._generate(self.build_prompt(text, context), deadline)
+        except GeminiError as e:
+            logger.error(f"Gemini API error: {e}")
+            raise
+        return self._parse_translation(response_text)
+
+    def build_prompt(self, text: str, context: Optional[str] = "") -> str:
+        """Prompt for translating a single phrase"""
+        return f"""
+Translate "{text}" to colloquial Levantine Arabic (Lebanese/Syrian/Palestinian/Jordanian), not MSA{f', context: "{context}"' if context else ''}.
+
+{LEVANTINE_GUIDELINES}
 IMPORTANT: Respond ONLY with this exact format:
 Arabic: [your Arabic translation with full diacritics]
 Transliteration: [your chat-alphabet transliteration]
@@ -384,49 +285,480 @@ Transliteration: biddi akul halla2
 
 Your translation for "{text}"{f' with context "{context}"' if context else ''}:
 """
+
+    def translate_stream(self, text: str, context: str = "") -> Iterator[Tuple[str, str]]:
+        """
+        Translate with the streaming API, yielding ('arabic', ...) and then
+        ('transliteration', ...) as soon as each line of the response is complete.
+        Raises GeminiError if the call fails.
+        """
+        parser = TranslationLineParser()
+        try:
+            for chunk in self._generate_stream(self.build_prompt(text, context)):
+                yield from parser.feed(chunk)
+        except GeminiError as e:
+            logger.error(f"Gemini API error: {e}")
+            raise
+        yield from parser.close()
+
+    def translate_batch(self, items: List[Tuple[str, Optional[str]]],
+                        deadline: Optional[float] = None) -> List[Union[Tuple[str, str], GeminiError]]:
+        """
+        Translate many (text, context) items with one prompt per GEMINI_BATCH_SIZE items,
+        up to GEMINI_BATCH_CONCURRENCY prompts at a time.
+        Items missing from (or malformed in) the batch response are retried one by one,
+        unless that is most of the batch: then they fail, rather than costing a call
+        each. All calls share one deadline (a time.monotonic() value, self.deadline seconds
+        from now by default). Returns, in input order, (arabic, transliteration) per
+        item or the GeminiError its call failed with, so a failure late in the batch
+        doesn't lose the items already translated.
+        """
+        if deadline is None:
+            deadline = time.monotonic() + self.deadline
+        chunks = [items[offset:offset + GEMINI_BATCH_SIZE] for offset in range(0, len(items), GEMINI_BATCH_SIZE)]
+        if len(chunks) == 1:
+            return self._translate_chunk(chunks[0], deadline)
+
+        with ThreadPoolExecutor(max_workers=min(GEMINI_BATCH_CONCURRENCY, len(chunks)),
+                                thread_name_prefix='gemini-batch') as executor:
+            chunk_results = executor.map(lambda chunk: self._translate_chunk(chunk, deadline), chunks)
+            return [result for results in chunk_results for result in results]
+
+    def _translate_chunk(self, chunk: List[Tuple[str, Optional[str]]],
+                         deadline: float) -> List[Union[Tuple[str, str], GeminiError]]:
+        """One batch prompt of translate_batch, plus the retries of its missing items"""
+        parsed = {}
+        if len(chunk) > 1:
+            try:
+                parsed = self.parse_batch_response(
+                    self._generate(self.build_batch_prompt(chunk), deadline), len(chunk))
+            except GeminiError as e:
+                logger.error(f"Gemini API error: {e}")
+                return [e] * len(chunk)
+
+        if len(chunk) > 1 and len(parsed) * 2 < len(chunk):
+            error = GeminiError(f"only {len(parsed)} of {len(chunk)} items in the batch response",
+                                retryable=True)
+            logger.error(f"Gemini API error: {error}")
+            parsed = {i: parsed.get(i, error) for i in range(len(chunk))}
+
+        results = []
+        for i, item in enumerate(chunk):
+            if i in parsed:
+                results.append(parsed[i])
+                continue
+            if len(chunk) > 1:
+                logger.info(f"Item {i + 1} missing from Gemini batch response, retrying it alone")
+            try:
+                results.append(self.translate(*item, deadline=deadline))
+            except GeminiError as e:
+                results.append(e)
+        return results
+
+    def build_batch_prompt(self, items: List[Tuple[str, Optional[str]]]) -> str:
+        """Prompt asking for a numbered [n] block per item"""
+        phrases = '\n'.join(
+            f"{number}. {json.dumps(text, ensure_ascii=False)}"
+            + (f" (context: {json.dumps(context, ensure_ascii=False)})" if context else '')
+            for number, (text, context) in enumerate(items, 1)
+        )
+        return f"""
+Translate each of the following numbered English phrases to colloquial Levantine Arabic (Lebanese/Syrian/Palestinian/Jordanian), not MSA.
+
+{LEVANTINE_GUIDELINES}
+Phrases:
+{phrases}
+
+IMPORTANT: Respond ONLY with one block per phrase, using the phrase's number, in this exact format:
+[number]
+Arabic: [your Arabic translation with full diacritics]
+Transliteration: [your chat-alphabet transliteration]
+
+Example format:
+[1]
+Arabic: بِدّي آكُل هَلَّأ
+Transliteration: biddi akul halla2
+[2]
+Arabic: وين البيت؟
+Transliteration: wen el beit?
+
+Your translations for all {len(items)} phrases:
+"""
+
+    @staticmethod
+    def parse_batch_response(response_text: str, count: int) -> Dict[int, Tuple[str, str]]:
+        """
+        Map a batch response back to its items, as {item index: (arabic, transliteration)}.
+        Strict: a block is only accepted if its number is in range and unique, and it
+        has exactly one non-empty Arabic and one non-empty Transliteration line.
+        """
+        blocks: Dict[int, List[Tuple[str, str]]] = {}
+        duplicates = set()
+        current = None
+        for line in response_text.split('\n'):
+            line = line.strip().strip('*').strip()
+            if not line:
+                continue
+            header = BATCH_HEADER_PATTERN.match(line)
+            if header:
+                current = int(header.group(1)) - 1
+                if current in blocks:
+                    duplicates.add(current)
+                blocks[current] = []
+                continue
+            if current is None or ':' not in line:
+                continue
+            label, value = line.split(':', 1)
+            label = label.strip().lower()
+            if label in ('arabic', 'transliteration'):
+                blocks[current].append((label, value.strip()))
+
+        parsed = {}
+        for index, fields in blocks.items():
+            if not 0 <= index < count or index in duplicates:
+                continue
+            values = dict(fields)
+            if len(fields) == 2 and values.get('arabic') and values.get('transliteration'):
+                parsed[index] = (values['arabic'], values['transliteration'])
+        return parsed
+
+    def _generate(self, prompt: str, deadline: Optional[float] = None) -> str:
+        """
+        Send a prompt to Gemini and return the response text. Timeouts, connection
+        errors, 429 and 5xx responses are retried with jittered exponential backoff,
+        all before the deadline (self.deadline seconds from now unless given).
+        Raises GeminiError once the call has failed for good, and GeminiUnavailable
+        without calling Gemini while the breaker is open.
+        """
+        if deadline is None:
+            deadline = time.monotonic() + self.deadline
+        connect_timeout, read_timeout = self.timeout
+
+        for attempt in range(1, self.max_attempts + 1):
+            remaining = self._remaining(deadline, time.monotonic())
+            self._check_breaker()
+            try:
+                response = self.session.post(
+                    f"{self.base_url}?key={self.api_key}",
+                    json=self._payload(prompt),
+                    timeout=(min(connect_timeout, remaining), min(read_timeout, remaining))
+                )
+            except Exception as e:
+                error = self._request_failed(e, isinstance(e, (requests.ConnectionError, requests.Timeout)))
+            else:
+                if response.status_code == 200:
+                    self.breaker.record_success()
+                    try:
+                        return self._response_text(response.json())
+                    except ValueError as e:
+                        raise GeminiError(f"malformed response: {e!r}")
+                error = self._status_error(response.status_code, response.headers.get('Retry-After'))
+
+            delay = self._retry_delay(error, attempt, deadline)
+            if delay is None:
+                raise error
+            time.sleep(delay)
+
+    def _generate_stream(self, prompt: str) -> Iterator[str]:
+        """
+        Like _generate, but with streamGenerateContent: yields the response text in
+        pieces as Gemini produces them. Failed attempts are retried as in _generate
+        until the stream has started; an interrupted stream raises GeminiError.
+        """
+        deadline = time.monotonic() + self.deadline
+        connect_timeout, read_timeout = self.timeout
+
+        for attempt in range(1, self.max_attempts + 1):
+            remaining = self._remaining(deadline, time.monotonic())
+            self._check_breaker()
+            try:
+                response = self.session.post(
+                    f"{self.stream_url}?alt=sse&key={self.api_key}",
+                    json=self._payload(prompt),
+                    timeout=(min(connect_timeout, remaining), min(read_timeout, remaining)),
+                    stream=True
+                )
+            except Exception as e:
+                error = self._request_failed(e, isinstance(e, (requests.ConnectionError, requests.Timeout)))
+            else:
+                if response.status_code == 200:
+                    self.breaker.record_success()
+                    break
+                error = self._status_error(response.status_code, response.headers.get('Retry-After'))
+                response.close()
+
+            delay = self._retry_delay(error, attempt, deadline)
+            if delay is None:
+                raise error
+            time.sleep(delay)
+
+        with response:
+            try:
+                for event in self._iter_sse_events(response):
+                    if time.monotonic() > deadline:
+                        raise GeminiError("deadline exceeded while streaming", retryable=True)
+                    yield self._chunk_text(event)
+            except requests.RequestException as e:
+                raise GeminiError(f"stream interrupted: {type(e).__name__}: {e}", retryable=True)
+
+    @staticmethod
+    def _iter_sse_events(response: requests.Response) -> Iterator[Dict]:
+        """JSON payloads of the data: lines of a server-sent events response, as they arrive"""
+        buffer = b''
+        # chunk_size=None yields data as it arrives instead of waiting for fixed-size blocks
+        for data in response.iter_content(chunk_size=None):
+            buffer += data
+            *lines, buffer = buffer.split(b'\n')
+            for line in lines:
+                if line.startswith(b'data:'):
+                    try:
+                        yield json.loads(line[5:])
+                    except ValueError as e:
+                        raise GeminiError(f"malformed stream event: {e!r}")
+
+    @staticmethod
+    def _chunk_text(event: Dict) -> str:
+        """Text of one streamed chunk; the last chunk may carry only finishReason/usage data"""
+        try:
+            return ''.join(part.get('text', '') for part in event['candidates'][0]['content']['parts'])
+        except (KeyError, IndexError, TypeError, AttributeError):
+            return ''
+
+    # Shared by _generate and the asyncio translator in async_hybrid_translation_service.py
+
+    @staticmethod
+    def _payload(prompt: str) -> Dict:
+        return {
+            "contents": [{
+                "parts": [{"text": prompt}]
+            }]
+        }
+
+    @staticmethod
+    def _response_text(result: Dict) -> str:
+        try:
+            return result['candidates'][0]['content']['parts'][0]['text']
+        except (KeyError, IndexError, TypeError) as e:
+            raise GeminiError(f"malformed response: {e!r}")
+
+    @staticmethod
+    def _remaining(deadline: float, now: float) -> float:
+        """Seconds left for the next attempt (never negative); raises GeminiError once none are left"""
+        remaining = max(0.0, deadline - now)
+        if not remaining:
+            raise GeminiError("deadline exceeded", retryable=True)
+        return remaining
+
+    def _check_breaker(self):
+        """Raise GeminiUnavailable, rather than calling Gemini, while the breaker is open"""
+        if not self.breaker.allow():
+            raise GeminiUnavailable("circuit breaker is open", retryable=True,
+                                    retry_after=self.breaker.retry_after())
+
+    def _request_failed(self, e: Exception, retryable: bool) -> GeminiError:
+        """Error for an attempt that got no response (timeout, connection error)"""
+        self.breaker.record_failure()
+        return GeminiError(f"{type(e).__name__}: {e}", retryable=retryable)
+
+    def _status_error(self, status: int, retry_after: Optional[str]) -> GeminiError:
+        """Error for an attempt answered with an error status"""
+        # Only server errors count against the upstream; a 4xx is the caller's problem.
+        # Rate limiting says nothing about whether the upstream is healthy
+        if status >= 500:
+            self.breaker.record_failure()
+        elif status == 429:
+            self.breaker.record_neutral()
+        else:
+            self.breaker.record_success()
+        try:
+            retry_after_seconds = max(0.0, float(retry_after)) if retry_after else None
+        except ValueError:
+            retry_after_seconds = None  # The HTTP-date form
+        return GeminiError(f"status {status}", retryable=status in GEMINI_RETRYABLE_STATUSES,
+                           retry_after=retry_after_seconds)
+
+    def _retry_delay(self, error: GeminiError, attempt: int, deadline: float) -> Optional[float]:
+        """Seconds to wait before retrying a failed attempt, or None if the call has failed for good"""
+        if not error.retryable or attempt == self.max_attempts:
+            return None
+        # Full jitter, so callers failing together don't retry together
+        delay = random.uniform(0, min(GEMINI_BACKOFF_MAX, GEMINI_BACKOFF_BASE * 2 ** (attempt - 1)))
+        if error.retry_after is not None:
+            delay = max(delay, error.retry_after)
+        if time.monotonic() + delay >= deadline:
+            return None
+        logger.warning(f"Gemini call failed ({error}), retrying in {delay:.2f}s "
+                       f"(attempt {attempt + 1}/{self.max_attempts})")
+        return delay
+
+    @staticmethod
+    def _parse_translation(response_text: str) -> Tuple[str, str]:
+        """Extract the Arabic and transliteration lines from a single-item response"""
+        arabic = ""
+        transliteration = ""
+        
+        # Try to extract Arabic and transliteration
+        lines = response_text.split('\n')
+        for line in lines:
+            line = line.strip()
+            if line.lower().startswith('arabic:'):
+                arabic = line.split(':', 1)[1].strip()
+            elif line.lower().startswith('transliteration:'):
+                transliteration = line.split(':', 1)[1].strip()
         
+        return arabic, transliteration
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls with the same key: the first caller runs the
+    function, callers arriving while it runs wait and share its result.
+    """
+    class _Call:
+        __slots__ = ('done', 'result', 'error', 'waiters')
+
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+            self.waiters = 0
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: Dict = {}
+        self.executed = 0
+        self.coalesced = 0
+
+    def do(self, key, fn):
+        """Run fn() once per key at a time; returns (result, shared) where shared means another caller ran it"""
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                call.waiters += 1
+                self.coalesced += 1
+                leader = False
+            else:
+                call = self._calls[key] = self._Call()
+                self.executed += 1
+                leader = True
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
         try:
-            payload = {
-                "contents": [{
-                    "parts": [{"text": prompt}]
-                }]
+            call.result = fn()
+            return call.result, False
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def metrics(self) -> Dict:
+        with self._lock:
+            return {
+                'in_flight': len(self._calls),
+                'executed': self.executed,
+                'coalesced': self.coalesced
             }
-            
-            response = requests.post(
-                f"{self.base_url}?key={self.api_key}",
-                headers={"Content-Type": "application/json"},
-                json=payload,
-                timeout=30
-            )
-            
-            if response.status_code == 200:
-                result = response.json()
-                response_text = result['candidates'][0]['content']['parts'][0]['text']
-                
-                # Parse response
-                arabic = ""
-                transliteration = ""
-                
-                # Try to extract Arabic and transliteration
-                lines = response_text.split('\n')
-                for line in lines:
-                    line = line.strip()
-                    if line.lower().startswith('arabic:'):
-                        arabic = line.split(':', 1)[1].strip()
-                    elif line.lower().startswith('transliteration:'):
-                        transliteration = line.split(':', 1)[1].strip()
-                
-                return arabic, transliteration
+
+class GeminiResponseCache:
+    """
+    Durable cache of raw Gemini translations in the gemini_cache table.
+
+    Only the Gemini output is cached; word replacements are applied on top of
+    it for every request, so vocabulary edits take effect on cache hits too.
+    """
+    def __init__(self, db: LevantineHybridDB, ttl: float = GEMINI_CACHE_TTL,
+                 max_entries: int = GEMINI_CACHE_MAX_ENTRIES):
+        self.db = db
+        self.ttl = ttl
+        self.max_entries = max_entries
+        # Identical requests that miss the cache at the same time share one Gemini call
+        self.flights = SingleFlight()
+        self._lock = threading.Lock()
+        self._writes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+
+    def get(self, text: str, context: Optional[str],
+            prompt_version: str = GeminiTranslator.PROMPT_VERSION) -> Optional[Tuple[str, str]]:
+        """Get a cached (arabic, transliteration), or None if missing or expired"""
+        english_key, context_key = normalize_translation_key(text, context)
+        with self.db.pool.connection() as conn:
+            row = conn.execute('''
+                SELECT arabic, transliteration FROM gemini_cache
+                WHERE english_key = ? AND context_key = ? AND prompt_version = ? AND created_at >= ?
+            ''', (english_key, context_key, prompt_version, time.time() - self.ttl)).fetchone()
+
+        with self._lock:
+            if row:
+                self.hits += 1
             else:
-                logger.error(f"Gemini API error: {response.status_code}")
-                return "Translation error", "translation error"
-                
-        except Exception as e:
-            logger.error(f"Error calling Gemini API: {e}")
-            return "Translation error", "translation error"
+                self.misses += 1
+        return (row[0], row[1]) if row else None
+
+    def put(self, text: str, context: Optional[str], arabic: str, transliteration: str,
+            prompt_version: str = GeminiTranslator.PROMPT_VERSION):
+        """Cache a Gemini translation"""
+        english_key, context_key = normalize_translation_key(text, context)
+        with self.db.pool.transaction() as conn:
+            conn.execute('''
+                INSERT OR REPLACE INTO gemini_cache
+                (english_key, context_key, prompt_version, arabic, transliteration, created_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', (english_key, context_key, prompt_version, arabic, transliteration, time.time()))
+
+        with self._lock:
+            self._writes += 1
+            evict = self._writes % GEMINI_CACHE_EVICT_EVERY == 0
+        if evict:
+            self.evict()
+
+    def evict(self):
+        """Delete expired entries, then the oldest ones beyond max_entries"""
+        with self.db.pool.transaction() as conn:
+            deleted = conn.execute('DELETE FROM gemini_cache WHERE created_at < ?',
+                                   (time.time() - self.ttl,)).rowcount
+            count = conn.execute('SELECT COUNT(*) FROM gemini_cache').fetchone()[0]
+            if count > self.max_entries:
+                deleted += conn.execute('''
+                    DELETE FROM gemini_cache WHERE rowid IN (
+                        SELECT rowid FROM gemini_cache ORDER BY created_at LIMIT ?
+                    )
+                ''', (count - self.max_entries,)).rowcount
+        with self._lock:
+            self.evicted += deleted
+
+    def translate(self, translator: GeminiTranslator, text: str, context: Optional[str]) -> Tuple[str, str, bool]:
+        """Translate through the cache; returns (arabic, transliteration, cache_hit)"""
+        cached = self.get(text, context, translator.PROMPT_VERSION)
+        if cached:
+            return cached[0], cached[1], True
+
+        def call_gemini():
+            arabic, transliteration = translator.translate(text, context)
+            if arabic:
+                self.put(text, context, arabic, transliteration, translator.PROMPT_VERSION)
+            return arabic, transliteration
+
+        # The API key is part of the key so an invalid key's error is never shared
+        flight_key = (translator.api_key, translator.PROMPT_VERSION) + normalize_translation_key(text, context)
+        (arabic, transliteration), _ = self.flights.do(flight_key, call_gemini)
+        return arabic, transliteration, False
+
+    def metrics(self) -> Dict:
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evicted': self.evicted}
 
 # Initialize components
-db = LevantineHybridDB()
+db = LevantineHybridDB(os.environ.get('HYBRID_DB_PATH', 'levantine_hybrid.db'))
+gemini_cache = GeminiResponseCache(db)
 
 # Initialize with your custom vocabulary (including taabeh for ball)
 def initialize_custom_vocabulary():
@@ -466,45 +798,281 @@ def translate_text():
         return jsonify({"error": "Missing english_text to translate"}), 400
     if not gemini_api_key:
         return jsonify({"error": "Missing gemini_api_key"}), 400
+    try:
+        memory_mode, memory_threshold = translation_memory_options(data)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
 
     try:
-        # Step 1: Get translation from Gemini
-        gemini = GeminiTranslator(gemini_api_key)
-        gemini_arabic, gemini_transliteration = gemini.translate(english_text, context)
-        
-        # Step 2: Apply custom word replacements
-        final_arabic, final_transliteration, replacements_made = db.apply_word_replacements(
-            gemini_arabic, gemini_transliteration
-        )
-        
-        # Step 3: Save for review (optional - can be disabled if you don't want to review everything)
-        save_for_review = data.get('save_for_review', True)
-        if save_for_review:
-            db.save_translation_for_review(
-                english_text, context, gemini_arabic, gemini_transliteration,
-                final_arabic, final_transliteration, replacements_made
-            )
-        
-        response = {
-            'english': english_text,
-            'arabic': final_arabic,
-            'transliteration': final_transliteration,
-            'context': context,
-            'gemini_original': {
-                'arabic': gemini_arabic,
-                'transliteration': gemini_transliteration
-            },
-            'replacements_made': replacements_made,
-            'has_replacements': len(replacements_made) > 0,
-            'model_version': 'hybrid-gemini-custom-v1'
-        }
+        # Reviewed translations are returned as they are, without calling Gemini
+        memory = db.lookup_translation_memory(english_text, context, memory_mode, memory_threshold)
+        if memory:
+            return jsonify(translation_memory_response(english_text, context, memory))
+
+        # Step 1: Get translation from Gemini (or from the cache of earlier Gemini responses)
+        gemini = get_gemini_translator(gemini_api_key)
+        gemini_arabic, gemini_transliteration, cache_hit = gemini_cache.translate(gemini, english_text, context)
         
+        # Steps 2 and 3: word replacements, saving for review
+        response = finish_translation(english_text, context, gemini_arabic, gemini_transliteration,
+                                      cache_hit, data.get('save_for_review', True))
         return jsonify(response)
         
+    except GeminiError as e:
+        return gemini_error_response(e)
     except Exception as e:
         logger.error(f"Translation error: {e}")
         return jsonify({'error': f'Translation failed: {str(e)}'}), 500
 
+@app.route('/translate_batch', methods=['POST'])
+def translate_batch():
+    """
+    Translate many phrases at once (e.g. a deck import), packing them into
+    batch Gemini prompts. Body: {"items": [{"english_text": ..., "context": ...}, ...],
+    "gemini_api_key": ..., "save_for_review": true}, plus /translate's translation
+    memory options. Responds with one /translate response per item, in order; an
+    item whose Gemini call failed gets {"english", "context", "error", "retryable"}
+    instead (the whole request fails only if every item did).
+    """
+    data = request.get_json()
+    if not data:
+        return jsonify({"error": "Invalid JSON payload"}), 400
+
+    items = data.get('items')
+    gemini_api_key = data.get('gemini_api_key')
+    if not isinstance(items, list) or not items:
+        return jsonify({"error": "Missing items to translate"}), 400
+    if len(items) > MAX_BATCH_REQUEST_ITEMS:
+        return jsonify({"error": f"Too many items, at most {MAX_BATCH_REQUEST_ITEMS} per request"}), 400
+    if not gemini_api_key:
+        return jsonify({"error": "Missing gemini_api_key"}), 400
+
+    phrases = []
+    for position, item in enumerate(items):
+        if isinstance(item, str):
+            item = {'english_text': item}
+        if not isinstance(item, dict) or not item.get('english_text'):
+            return jsonify({"error": f"Item {position} is missing english_text"}), 400
+        phrases.append((item['english_text'], item.get('context')))
+    try:
+        memory_mode, memory_threshold = translation_memory_options(data)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    try:
+        gemini = get_gemini_translator(gemini_api_key)
+
+        # Items in translation memory or the cache don't need Gemini; identical items
+        # are only translated once
+        memory_results = {}
+        gemini_results = {}
+        misses: Dict[Tuple[str, str], Tuple[str, Optional[str]]] = {}
+        for english_text, context in phrases:
+            key = normalize_translation_key(english_text, context)
+            if key in memory_results or key in gemini_results or key in misses:
+                continue
+            memory = db.lookup_translation_memory(english_text, context, memory_mode, memory_threshold)
+            if memory:
+                memory_results[key] = memory
+                continue
+            cached = gemini_cache.get(english_text, context, gemini.PROMPT_VERSION)
+            if cached:
+                gemini_results[key] = (cached[0], cached[1], True)
+            else:
+                misses[key] = (english_text, context)
+
+        gemini_errors = {}
+        if misses:
+            translations = gemini.translate_batch(list(misses.values()))
+            if not memory_results and not gemini_results and all(
+                    isinstance(translation, GeminiError) for translation in translations):
+                raise translations[0]
+            for (key, (english_text, context)), translation in zip(misses.items(), translations):
+                if isinstance(translation, GeminiError):
+                    gemini_errors[key] = translation
+                    continue
+                arabic, transliteration = translation
+                if arabic:
+                    gemini_cache.put(english_text, context, arabic, transliteration, gemini.PROMPT_VERSION)
+                gemini_results[key] = (arabic, transliteration, False)
+
+        save_for_review = data.get('save_for_review', True)
+        responses = []
+        for english_text, context in phrases:
+            key = normalize_translation_key(english_text, context)
+            if key in memory_results:
+                responses.append(translation_memory_response(english_text, context, memory_results[key]))
+            elif key in gemini_errors:
+                error = gemini_errors[key]
+                responses.append({'english': english_text, 'context': context,
+                                  'error': f'Gemini unavailable: {error}', 'retryable': error.retryable})
+            else:
+                responses.append(finish_translation(english_text, context, *gemini_results[key], save_for_review))
+        return jsonify({
+            'translations': responses,
+            'count': len(responses),
+            'gemini_items': len(misses),
+            'errors': sum('error' in response for response in responses)
+        })
+
+    except GeminiError as e:
+        return gemini_error_response(e)
+    except Exception as e:
+        logger.error(f"Batch translation error: {e}")
+        return jsonify({'error': f'Translation failed: {str(e)}'}), 500
+
+@app.route('/translate_stream', methods=['POST'])
+def translate_stream():
+    """
+    /translate as server-sent events, using Gemini's streaming API. Same request
+    body as /translate. Events:
+      arabic           as soon as Gemini has produced the Arabic line, with word
+                       replacements applied
+      transliteration  when the transliteration line arrives
+      done             the full /translate response
+      error            if the translation failed (ends the stream)
+    """
+    data = request.get_json(silent=True)
+    if not data:
+        return jsonify({"error": "Invalid JSON payload"}), 400
+
+    english_text = data.get('english_text')
+    context = data.get('context')
+    gemini_api_key = data.get('gemini_api_key')
+    save_for_review = data.get('save_for_review', True)
+
+    if not english_text:
+        return jsonify({"error": "Missing english_text to translate"}), 400
+    if not gemini_api_key:
+        return jsonify({"error": "Missing gemini_api_key"}), 400
+    try:
+        memory_mode, memory_threshold = translation_memory_options(data)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    def events():
+        arabic_sent = False
+        try:
+            memory = db.lookup_translation_memory(english_text, context, memory_mode, memory_threshold)
+            if memory:
+                response = translation_memory_response(english_text, context, memory)
+            else:
+                gemini = get_gemini_translator(gemini_api_key)
+                cached = gemini_cache.get(english_text, context, gemini.PROMPT_VERSION)
+                if cached:
+                    response = finish_translation(english_text, context, cached[0], cached[1], True, save_for_review)
+                else:
+                    fields = {}
+                    for field, value in gemini.translate_stream(english_text, context):
+                        fields[field] = value
+                        if field == 'arabic':
+                            # Usage is counted once, by finish_translation below
+                            final_arabic, _, replacements_made = db.apply_word_replacements(value, '', count_usage=False)
+                            yield sse_event('arabic', {'arabic': final_arabic, 'gemini_arabic': value,
+                                                       'replacements_made': replacements_made})
+                            arabic_sent = True
+                    gemini_arabic = fields.get('arabic', '')
+                    gemini_transliteration = fields.get('transliteration', '')
+                    if gemini_arabic:
+                        gemini_cache.put(english_text, context, gemini_arabic, gemini_transliteration,
+                                         gemini.PROMPT_VERSION)
+                    response = finish_translation(english_text, context, gemini_arabic, gemini_transliteration,
+                                                  False, save_for_review)
+
+            original = response['gemini_original'] or {}
+            if not arabic_sent:
+                yield sse_event('arabic', {'arabic': response['arabic'], 'gemini_arabic': original.get('arabic'),
+                                           'replacements_made': response['replacements_made']})
+            yield sse_event('transliteration', {'transliteration': response['transliteration'],
+                                                'gemini_transliteration': original.get('transliteration')})
+            yield sse_event('done', response)
+
+        except GeminiError as e:
+            yield sse_event('error', {'error': f'Gemini unavailable: {e}', 'retryable': e.retryable})
+        except Exception as e:
+            logger.error(f"Streaming translation error: {e}")
+            yield sse_event('error', {'error': f'Translation failed: {str(e)}'})
+
+    return Response(stream_with_context(events()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+def sse_event(event: str, payload: Dict) -> str:
+    """A server-sent event with a JSON payload"""
+    return f"event: {event}\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+def gemini_error_response(error: GeminiError):
+    """
+    Error response for a failed Gemini call: 503 with Retry-After when retrying
+    later may help (upstream down or rate limited), 502 otherwise (e.g. a bad API key)
+    """
+    response = jsonify({'error': f'Gemini unavailable: {error}', 'retryable': error.retryable})
+    response.status_code = 503 if error.retryable else 502
+    if error.retryable:
+        response.headers['Retry-After'] = str(max(1, int(error.retry_after or 1)))
+    return response
+
+def translation_memory_options(data: Dict) -> Tuple[str, float]:
+    """The translation_memory mode and similarity_threshold of a request; raises ValueError if invalid"""
+    mode = data.get('translation_memory', TRANSLATION_MEMORY_MODE)
+    if mode not in TRANSLATION_MEMORY_MODES:
+        raise ValueError(f"translation_memory must be one of: {', '.join(TRANSLATION_MEMORY_MODES)}")
+    threshold = data.get('similarity_threshold', TRANSLATION_MEMORY_THRESHOLD)
+    if isinstance(threshold, bool) or not isinstance(threshold, (int, float)) or not 0 < threshold <= 1:
+        raise ValueError("similarity_threshold must be a number between 0 and 1")
+    return mode, float(threshold)
+
+def translation_memory_response(english_text: str, context: Optional[str], memory: Dict) -> Dict:
+    """/translate response for a translation memory hit (an already reviewed translation)"""
+    return {
+        'english': english_text,
+        'arabic': memory['arabic'],
+        'transliteration': memory['transliteration'],
+        'context': context,
+        'gemini_original': None,
+        'replacements_made': [],
+        'has_replacements': False,
+        'cache_hit': False,
+        'source': 'translation_memory',
+        'translation_memory': {
+            'id': memory['id'],
+            'english': memory['english'],
+            'match': memory['match'],
+            'similarity': memory['similarity']
+        },
+        'model_version': 'hybrid-gemini-custom-v1'
+    }
+
+def finish_translation(english_text: str, context: Optional[str], gemini_arabic: str,
+                       gemini_transliteration: str, cache_hit: bool, save_for_review: bool) -> Dict:
+    """Apply word replacements to a Gemini translation, queue it for review and build the response"""
+    final_arabic, final_transliteration, replacements_made = db.apply_word_replacements(
+        gemini_arabic, gemini_transliteration
+    )
+    
+    # Save for review (optional - can be disabled if you don't want to review everything)
+    if save_for_review:
+        # Written by a background thread, so the response doesn't wait for the insert
+        db.queue_translation_for_review(
+            english_text, context, gemini_arabic, gemini_transliteration,
+            final_arabic, final_transliteration, replacements_made
+        )
+    
+    return {
+        'english': english_text,
+        'arabic': final_arabic,
+        'transliteration': final_transliteration,
+        'context': context,
+        'gemini_original': {
+            'arabic': gemini_arabic,
+            'transliteration': gemini_transliteration
+        },
+        'replacements_made': replacements_made,
+        'has_replacements': len(replacements_made) > 0,
+        'cache_hit': cache_hit,
+        'source': 'gemini',
+        'model_version': 'hybrid-gemini-custom-v1'
+    }
+
 @app.route('/add_word_replacement', methods=['POST'])
 def add_word_replacement():
     """Add a new word replacement"""
@@ -516,7 +1084,7 @@ def add_word_replacement():
             return jsonify({'error': f'Missing field: {field}'}), 400
     
     try:
-        db.add_word_replacement(
+        updated = db.add_word_replacement(
             original_arabic=data['original_arabic'],
             original_transliteration=data['original_transliteration'],
             replacement_arabic=data['replacement_arabic'],
@@ -525,22 +1093,62 @@ def add_word_replacement():
             reason=data.get('reason', '')
         )
         
-        return jsonify({'message': 'Word replacement added successfully'})
+        if updated:
+            # Same word as an existing entry, ignoring diacritics
+            return jsonify({'message': f'Existing word replacement {updated} updated',
+                            'original_arabic': updated, 'updated': True})
+        return jsonify({'message': 'Word replacement added successfully',
+                        'original_arabic': data['original_arabic'], 'updated': False})
         
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         logger.error(f"Error adding word replacement: {e}")
         return jsonify({'error': str(e)}), 500
 
+def encode_review_cursor(review: Dict) -> str:
+    """Opaque cursor pointing after a pending review (newest-first order, see get_pending_reviews)"""
+    key = json.dumps([review['created_at'] or '', review['id']])
+    return base64.urlsafe_b64encode(key.encode('utf-8')).decode('ascii')
+
+def decode_review_cursor(cursor: str) -> Tuple[str, int]:
+    """Decode a cursor produced by encode_review_cursor; raises ValueError if malformed"""
+    try:
+        created_at, review_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except (binascii.Error, UnicodeError, TypeError, ValueError) as e:
+        raise ValueError(f"Invalid cursor: {cursor}") from e
+    if not isinstance(created_at, str) or not isinstance(review_id, int):
+        raise ValueError(f"Invalid cursor: {cursor}")
+    return created_at, review_id
+
 @app.route('/pending_reviews', methods=['GET'])
 def get_pending_reviews():
-    """Get translations pending review"""
-    limit = request.args.get('limit', 50, type=int)
+    """
+    Get translations pending review, newest first, one page at a time.
+    Pass the returned next_cursor as ?cursor= to get the following page.
+    """
+    try:
+        limit = int(request.args.get('limit', 50))
+    except ValueError:
+        limit = 0
+    if not 1 <= limit <= MAX_REVIEW_PAGE_SIZE:
+        return jsonify({'error': f'limit must be an integer between 1 and {MAX_REVIEW_PAGE_SIZE}'}), 400
+    before = None
+    if request.args.get('cursor'):
+        try:
+            before = decode_review_cursor(request.args['cursor'])
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
     
     try:
-        pending = db.get_pending_reviews(limit)
+        # One extra row tells us whether there is a next page
+        pending = db.get_pending_reviews(limit + 1, before)
+        next_cursor = encode_review_cursor(pending[limit - 1]) if len(pending) > limit else None
+        pending = pending[:limit]
         return jsonify({
             'pending_reviews': pending,
-            'count': len(pending)
+            'count': len(pending),
+            'next_cursor': next_cursor
         })
     except Exception as e:
         logger.error(f"Error getting pending reviews: {e}")
@@ -574,11 +1182,131 @@ def decline_translation(translation_id):
         logger.error(f"Error declining translation: {e}")
         return jsonify({'error': str(e)}), 500
 
+@app.route('/approve_translations', methods=['POST'])
+def approve_translations():
+    """Approve many translations at once, see bulk_review"""
+    return bulk_review('approved')
+
+@app.route('/decline_translations', methods=['POST'])
+def decline_translations():
+    """Decline many translations at once, see bulk_review"""
+    return bulk_review('declined')
+
+def bulk_review(status: str):
+    """
+    Body: {"ids": [1, 2, ...]} or {"filter": {"status": "pending", "no_replacements": true,
+    "created_before": "2025-06-01 00:00:00"}}, plus optional reviewer and notes.
+    Responds with the outcome for every id. A filter reviews at most MAX_BULK_REVIEW_IDS
+    rows per request; has_more tells the client to send it again. The filter's status
+    (default pending) can't be the status being set.
+    """
+    data = request.get_json() or {}
+    reviewer = data.get('reviewer', 'admin')
+    notes = data.get('notes', '')
+    ids = data.get('ids')
+    filters = data.get('filter')
+
+    if (ids is None) == (filters is None):
+        return jsonify({'error': 'Provide either ids or filter'}), 400
+    if ids is not None:
+        if not isinstance(ids, list) or not all(isinstance(i, int) and not isinstance(i, bool) for i in ids):
+            return jsonify({'error': 'ids must be a list of integers'}), 400
+        if len(ids) > MAX_BULK_REVIEW_IDS:
+            return jsonify({'error': f'At most {MAX_BULK_REVIEW_IDS} ids per request'}), 400
+    elif not isinstance(filters, dict):
+        return jsonify({'error': 'filter must be an object'}), 400
+    elif filters.get('status', 'pending') == status:
+        return jsonify({'error': f'filter status must differ from {status}'}), 400
+
+    try:
+        outcomes = db.review_translations(status, ids, filters, reviewer, notes, limit=MAX_BULK_REVIEW_IDS)
+        counts = Counter(outcome['outcome'] for outcome in outcomes)
+        return jsonify({
+            'results': outcomes,
+            'counts': dict(counts),
+            # Every row a filter selects changes status, so a full page may mean more rows
+            'has_more': filters is not None and counts.get(status, 0) >= MAX_BULK_REVIEW_IDS,
+            'message': f"{counts.get(status, 0)} translations {status}"
+        })
+    except Exception as e:
+        logger.error(f"Error reviewing translations: {e}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/export/approved_translations', methods=['GET'])
+def export_approved_translations():
+    """
+    Stream approved translations as training data.
+    Query: format=jsonl|csv (default jsonl), since_id=<watermark of the previous export>,
+    dedup=true|false. The X-Export-Watermark header is the since_id for the next export.
+    """
+    export_format = request.args.get('format', 'jsonl')
+    if export_format not in ('jsonl', 'csv'):
+        return jsonify({'error': 'format must be jsonl or csv'}), 400
+    since_id = request.args.get('since_id', 0, type=int)
+    dedup = request.args.get('dedup', 'true').lower() != 'false'
+
+    try:
+        watermark = db.get_export_watermark()
+    except Exception as e:
+        logger.error(f"Error exporting approved translations: {e}")
+        return jsonify({'error': str(e)}), 500
+
+    rows = db.iter_approved_translations(since_id, watermark, dedup)
+    mimetype = 'application/x-ndjson' if export_format == 'jsonl' else 'text/csv'
+    return Response(
+        stream_with_context(format_export(rows, export_format)),
+        mimetype=mimetype,
+        headers={
+            'X-Export-Watermark': str(max(watermark, since_id)),
+            'Content-Disposition': f'attachment; filename=approved_translations_{since_id}_{watermark}.{export_format}'
+        }
+    )
+
+@app.route('/archived_translations', methods=['GET'])
+def get_archived_translations():
+    """
+    Reviewed translations moved out by the retention job (archive_translation_history.py).
+    Without month: the archived months. With month=YYYY-MM: that month's rows in id order,
+    filtered by status=approved|declined and q=<english substring>; pass the returned
+    next_after_id as ?after_id= to get the following page.
+    """
+    month = request.args.get('month')
+    try:
+        if not month:
+            return jsonify({'archives': db.get_history_archives()})
+
+        limit = request.args.get('limit', 50, type=int)
+        if not 1 <= limit <= MAX_REVIEW_PAGE_SIZE:
+            return jsonify({'error': f'limit must be between 1 and {MAX_REVIEW_PAGE_SIZE}'}), 400
+        status = request.args.get('status')
+        if status not in (None, 'approved', 'declined'):
+            return jsonify({'error': 'status must be approved or declined'}), 400
+
+        # One extra row tells us whether there is a next page
+        rows = db.query_history_archive(month, status, request.args.get('q'),
+                                        request.args.get('after_id', 0, type=int), limit + 1)
+        if rows is None:
+            return jsonify({'error': f'No archive for month {month}'}), 404
+        next_after_id = rows[limit - 1]['id'] if len(rows) > limit else None
+        rows = rows[:limit]
+        return jsonify({
+            'month': month,
+            'translations': rows,
+            'count': len(rows),
+            'next_after_id': next_after_id
+        })
+    except Exception as e:
+        logger.error(f"Error reading archived translations: {e}")
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/word_replacements', methods=['GET'])
 def get_word_replacements():
-    """Get all word replacements"""
+    """Get all word replacements, or with ?arabic=<text> those that apply to the text"""
     try:
-        replacements = db.get_word_replacements()
+        if request.args.get('arabic'):
+            replacements = db.find_word_replacements(request.args['arabic'])
+        else:
+            replacements = db.get_word_replacements()
         return jsonify({
             'word_replacements': replacements,
             'count': len(replacements)
@@ -587,23 +1315,23 @@ def get_word_replacements():
         logger.error(f"Error getting word replacements: {e}")
         return jsonify({'error': str(e)}), 500
 
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Get runtime metrics of the service"""
+    return jsonify({
+        'history_writer': db.history_writer.metrics(),
+        'gemini_cache': gemini_cache.metrics(),
+        'gemini_coalescing': gemini_cache.flights.metrics(),
+        'gemini_breaker': gemini_breaker.metrics(),
+        'translation_memory': dict(db.memory_lookups),
+        'sqlite': db.pool.metrics()
+    })
+
 @app.route('/stats', methods=['GET'])
 def get_stats():
     """Get service statistics"""
     try:
-        word_replacements = db.get_word_replacements()
-        approved_count = db.get_approved_translations_count()
-        pending_count = len(db.get_pending_reviews())
-        
-        return jsonify({
-            'word_replacements_count': len(word_replacements),
-            'approved_translations': approved_count,
-            'pending_reviews': pending_count,
-            'total_usage': sum(r['usage_count'] for r in word_replacements.values()),
-            'most_used_replacement': max(word_replacements.items(), 
-                                       key=lambda x: x[1]['usage_count'], 
-                                       default=(None, {'usage_count': 0}))
-        })
+        return jsonify(db.get_stats())
     except Exception as e:
         logger.error(f"Error getting stats: {e}")
         return jsonify({'error': str(e)}), 500
@@ -0,0 +1,277 @@
+"""
+End-to-end load test for hybrid_translation_service.py.
+
+Starts fake_gemini_server.py and the service (with a throwaway database) in
+subprocesses, then drives /translate, /pending_reviews and /approve_translation
+from concurrent clients in a weighted mix. Reports throughput, latency
+percentiles per endpoint and SQLite lock contention (from the service's /metrics).
+
+With --server async, /translate goes to async_hybrid_translation_service.py
+instead, and the review endpoints to the Flask service on the same database.
+
+Pass --service-url to load an already running service instead; it must be
+configured with GEMINI_API_URL pointing at a fake server, or it will use real quota.
+
+Usage:
+    python load_test_hybrid.py [--concurrency 16] [--duration 30]
+                               [--mix translate=70,pending_reviews=20,approve_translation=10]
+                               [--latency-ms 800] [--error-rate 0.02] [--server flask|async]
+"""
+import argparse
+import math
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter, defaultdict, deque
+
+import requests
+
+# Same request as test_translate_endpoint.py, varied so some requests miss the Gemini cache
+BASE_PHRASES = ["ball", "I want a ball", "where is the house", "the boy kicked the ball",
+                "how are you", "we are going to the market", "I don't know", "what do you want to eat"]
+CONTEXTS = ["sports", "", "greeting", "food"]
+
+SERVICE_BOOTSTRAP = """
+import logging, sys
+import hybrid_translation_service as service
+logging.getLogger('werkzeug').setLevel(logging.WARNING)
+service.app.run(host='127.0.0.1', port=int(sys.argv[1]), threaded=True)
+"""
+ASYNC_SERVICE_BOOTSTRAP = """
+import logging, sys
+from aiohttp import web
+import async_hybrid_translation_service as service
+logging.getLogger('aiohttp.access').setLevel(logging.WARNING)
+web.run_app(service.create_app(), host='127.0.0.1', port=int(sys.argv[1]), print=None)
+"""
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def wait_until_up(url: str, timeout: float = 30.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if requests.get(url, timeout=1).status_code == 200:
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"{url} did not come up within {timeout:.0f}s")
+
+def start_stack(args, workdir: str):
+    """
+    Start the fake Gemini server and the service(s); returns
+    (service_url, translate_url, fake_stats_url, processes)
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    log = open(os.path.join(workdir, 'load_test.log'), 'w')
+
+    fake = subprocess.Popen(
+        [sys.executable, os.path.join(here, 'fake_gemini_server.py'), '--port', '0',
+         '--latency-ms', str(args.latency_ms), '--latency-dist', args.latency_dist,
+         '--error-rate', str(args.error_rate), '--hang-rate', str(args.hang_rate)],
+        stdout=subprocess.PIPE, stderr=log, text=True
+    )
+    gemini_url = fake.stdout.readline().strip().rsplit(' ', 1)[-1]
+    fake_base = gemini_url.split('/v1beta/', 1)[0]
+
+    env = dict(os.environ, GEMINI_API_URL=gemini_url, PYTHONPATH=here,
+               HYBRID_DB_PATH=os.path.join(workdir, 'load_test_hybrid.db'))
+    processes = [fake]
+    urls = []
+    for bootstrap in [SERVICE_BOOTSTRAP] + ([ASYNC_SERVICE_BOOTSTRAP] if args.server == 'async' else []):
+        port = free_port()
+        processes.append(subprocess.Popen([sys.executable, '-c', bootstrap, str(port)],
+                                          cwd=workdir, env=env, stdout=log, stderr=log))
+        urls.append(f"http://127.0.0.1:{port}")
+        # One at a time, so they don't race to create the database
+        wait_until_up(urls[-1] + '/')
+    return urls[0], urls[-1], fake_base + '/stats', processes
+
+class Recorder:
+    """Latencies and outcomes per operation, shared by the client threads"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.statuses = defaultdict(Counter)
+        self.locked_errors = 0
+
+    def record(self, op: str, status, seconds: float, body: str = ''):
+        with self._lock:
+            self.latencies[op].append(seconds)
+            self.statuses[op][status] += 1
+            if status == 500 and 'locked' in body:
+                self.locked_errors += 1
+
+def percentile(sorted_values, fraction: float) -> float:
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    index = max(0, min(len(sorted_values) - 1, math.ceil(fraction * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+class LoadClient:
+    """One simulated client: a keep-alive session issuing weighted random operations"""
+    def __init__(self, base_url: str, translate_url: str, args, recorder: Recorder, pending: deque,
+                 pending_lock: threading.Lock, seen: set):
+        self.base_url = base_url
+        self.translate_url = translate_url
+        self.args = args
+        self.recorder = recorder
+        self.pending = pending
+        self.pending_lock = pending_lock
+        self.seen = seen
+        self.session = requests.Session()
+        self.ops, self.weights = zip(*args.mix.items())
+
+    def run(self, deadline: float):
+        while time.monotonic() < deadline:
+            op = random.choices(self.ops, self.weights)[0]
+            if op == 'approve_translation':
+                with self.pending_lock:
+                    translation_id = self.pending.popleft() if self.pending else None
+                if translation_id is None:
+                    op = 'pending_reviews'
+                else:
+                    self._call('approve_translation', 'POST', f'/approve_translation/{translation_id}',
+                               json={'reviewer': 'load-test', 'notes': 'load test'})
+                    continue
+            if op == 'translate':
+                phrase = f"{random.choice(BASE_PHRASES)} {random.randrange(self.args.phrases)}"
+                self._call('translate', 'POST', '/translate', base_url=self.translate_url, json={
+                    'english_text': phrase,
+                    'context': random.choice(CONTEXTS),
+                    'gemini_api_key': self.args.gemini_api_key
+                })
+            else:
+                response = self._call('pending_reviews', 'GET', '/pending_reviews', params={'limit': 50})
+                if response is not None and response.status_code == 200:
+                    ids = [review['id'] for review in response.json()['pending_reviews']]
+                    with self.pending_lock:
+                        for translation_id in ids:
+                            if translation_id not in self.seen:
+                                self.seen.add(translation_id)
+                                self.pending.append(translation_id)
+
+    def _call(self, op: str, method: str, path: str, base_url: str = None, **kwargs):
+        start = time.perf_counter()
+        try:
+            response = self.session.request(method, (base_url or self.base_url) + path,
+                                            timeout=self.args.client_timeout, **kwargs)
+        except requests.RequestException as e:
+            self.recorder.record(op, type(e).__name__, time.perf_counter() - start)
+            return None
+        self.recorder.record(op, response.status_code, time.perf_counter() - start,
+                             response.text if response.status_code >= 500 else '')
+        return response
+
+def get_json(url: str) -> dict:
+    try:
+        return requests.get(url, timeout=5).json()
+    except (requests.RequestException, ValueError):
+        return {}
+
+def parse_mix(value: str) -> dict:
+    mix = {}
+    for part in value.split(','):
+        op, _, weight = part.partition('=')
+        if op not in ('translate', 'pending_reviews', 'approve_translation'):
+            raise argparse.ArgumentTypeError(f"Unknown operation: {op}")
+        mix[op] = float(weight or 1)
+    return mix
+
+def report(recorder: Recorder, elapsed: float, metrics: dict, fake_stats: dict):
+    total = sum(len(values) for values in recorder.latencies.values())
+    print(f"\n{total} requests in {elapsed:.1f}s: {total / elapsed:.1f} req/s")
+    print(f"{'endpoint':20} {'count':>7} {'req/s':>7} {'errors':>7} {'p50 ms':>8} {'p90 ms':>8} "
+          f"{'p99 ms':>8} {'max ms':>8}")
+    for op in sorted(recorder.latencies):
+        values = sorted(recorder.latencies[op])
+        errors = sum(count for status, count in recorder.statuses[op].items() if status != 200)
+        print(f"{op:20} {len(values):7} {len(values) / elapsed:7.1f} {errors:7} "
+              + ' '.join(f"{percentile(values, p) * 1000:8.1f}" for p in (0.5, 0.9, 0.99, 1.0)))
+    for op in sorted(recorder.statuses):
+        failures = {status: count for status, count in recorder.statuses[op].items() if status != 200}
+        if failures:
+            print(f"  {op} failures: {failures}")
+
+    for url, (before, after) in metrics.items():
+        sqlite_before, sqlite_after = before.get('sqlite', {}), after.get('sqlite', {})
+        print(f"\n{url}")
+        if sqlite_after:
+            transactions = sqlite_after['transactions'] - sqlite_before.get('transactions', 0)
+            seconds = sqlite_after['transaction_seconds_total'] - sqlite_before.get('transaction_seconds_total', 0)
+            print(f"  SQLite lock errors: {sqlite_after['lock_errors'] - sqlite_before.get('lock_errors', 0)}")
+            print(f"  transactions:       {transactions}, avg {seconds * 1000 / max(transactions, 1):.2f} ms, "
+                  f"max {sqlite_after['max_transaction_ms']:.1f} ms")
+        if after.get('history_writer'):
+            print(f"  history writer:     {after['history_writer']}")
+        if after.get('gemini_breaker'):
+            print(f"  Gemini breaker:     {after['gemini_breaker']}")
+    print(f"\n\"database is locked\" errors surfaced to clients: {recorder.locked_errors}")
+    if fake_stats:
+        print(f"Fake Gemini calls:    {fake_stats}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--service-url', help='Load an already running service instead of starting one')
+    parser.add_argument('--server', choices=['flask', 'async'], default='flask',
+                        help='Which implementation serves /translate')
+    parser.add_argument('--concurrency', type=int, default=16, help='Concurrent clients')
+    parser.add_argument('--duration', type=float, default=30, help='Seconds to run for')
+    parser.add_argument('--mix', type=parse_mix, default='translate=70,pending_reviews=20,approve_translation=10',
+                        help='Weighted mix of operations')
+    parser.add_argument('--phrases', type=int, default=200,
+                        help='Variants per base phrase; fewer means more Gemini cache hits')
+    parser.add_argument('--gemini-api-key', default='load-test-key')
+    parser.add_argument('--client-timeout', type=float, default=30, help='Client request timeout, like the frontend')
+    parser.add_argument('--latency-ms', type=float, default=800, help='Fake Gemini median latency')
+    parser.add_argument('--latency-dist', default='lognormal', help='Fake Gemini latency distribution')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fake Gemini error rate')
+    parser.add_argument('--hang-rate', type=float, default=0.0, help='Fake Gemini share of hanging calls')
+    args = parser.parse_args()
+
+    processes = []
+    fake_stats_url = None
+    workdir = tempfile.mkdtemp(prefix='hybrid_load_')
+    try:
+        if args.service_url:
+            service_url = translate_url = args.service_url.rstrip('/')
+        else:
+            service_url, translate_url, fake_stats_url, processes = start_stack(args, workdir)
+            print(f"Service at {service_url}, /translate at {translate_url}, logs and database in {workdir}")
+
+        recorder = Recorder()
+        pending, pending_lock, seen = deque(), threading.Lock(), set()
+        urls = sorted({service_url, translate_url})
+        before = {url: get_json(url + '/metrics') for url in urls}
+        start = time.monotonic()
+        deadline = start + args.duration
+        threads = [
+            threading.Thread(target=LoadClient(service_url, translate_url, args, recorder, pending, pending_lock,
+                                               seen).run, args=(deadline,))
+            for _ in range(args.concurrency)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.monotonic() - start
+
+        metrics = {url: (before[url], get_json(url + '/metrics')) for url in urls}
+        report(recorder, elapsed, metrics, get_json(fake_stats_url) if fake_stats_url else {})
+    finally:
+        for process in processes:
+            process.terminate()
+            process.wait()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,168 @@
+"""
+Tests for custom_training.py (training pair selection, the training job runner and
+model versions on disk).
+
+The runner starts a real training process, with a stand-in for the fine-tuning
+entry point, so neither torch nor transformers is needed.
+
+Run with: python -m pytest test_custom_training.py  (or python test_custom_training.py)
+"""
+import os
+import sqlite3
+import tempfile
+import time
+
+import custom_training
+from custom_training import (
+    LevantineTranslationDB, TrainingJobRunner, model_version_dir, read_current_version, write_current_version
+)
+
+def fake_training_job(model_path, base_version, version, training_data, epochs, batch_size, events):
+    """Stands in for run_training_job: two steps, then a 'model' directory, unless a pair says FAIL"""
+    if any(pair['english'] == 'FAIL' for pair in training_data):
+        events.put(('finished', {'error': 'training diverged'}))
+        return
+    os.makedirs(model_version_dir(model_path, version))
+    for step in (1, 2):
+        events.put(('progress', {'step': step, 'total_steps': 2, 'loss': 1.0 / step}))
+    events.put(('finished', {'training_loss': 0.5, 'training_time': 0.1}))
+
+def make_runner(pairs=12):
+    directory = tempfile.mkdtemp()
+    db = LevantineTranslationDB(os.path.join(directory, 'training.db'))
+    for number in range(pairs):
+        db.add_translation_pair(f'word {number}', f'كلمة {number}', quality_score=0.8)
+    served = {'version': None, 'swaps': 0}
+
+    def swap(model):
+        served['version'] = model
+        served['swaps'] += 1
+
+    runner = TrainingJobRunner(db, os.path.join(directory, 'model'), target=fake_training_job,
+                               load_model=lambda version: version, swap_model=swap,
+                               served_version=lambda: served['version'])
+    return runner, db, served
+
+def wait_for(runner, job_id, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        job = runner.get(job_id)
+        if job['status'] in ('completed', 'failed'):
+            return job
+        time.sleep(0.05)
+    raise AssertionError(f'job {job_id} did not finish: {runner.get(job_id)}')
+
+def test_training_jobs_run_in_a_process_and_are_served():
+    runner, db, served = make_runner()
+    job = wait_for(runner, runner.submit('incremental')['id'])
+
+    # Nothing was trained here yet, so the first job trains on everything
+    assert job['status'] == 'completed', job['error']
+    assert (job['mode'], job['new_pairs'], job['replay_pairs'], job['watermark']) == ('full', 12, 0, 12)
+    assert (job['step'], job['total_steps'], job['progress'], job['eta_seconds']) == (2, 2, 1.0, 0)
+    assert job['loss'] == 0.5 and job['finished_at']
+    version = job['model_version']
+    assert served == {'version': version, 'swaps': 1}
+    assert os.path.isdir(model_version_dir(runner.model_path, version))
+    assert db.get_training_watermark(version) == 12
+
+    # The next job continues from the served version on the pairs added since
+    db.add_translation_pair('new word', 'كلمة جديدة', quality_score=0.8)
+    db.add_translation_pair('other word', 'كلمة تانية', quality_score=0.8)
+    job = wait_for(runner, runner.submit('incremental')['id'])
+    assert job['status'] == 'completed', job['error']
+    assert (job['mode'], job['base_version'], job['new_pairs'], job['watermark']) == ('incremental', version, 2, 14)
+    # Two new pairs are topped up with replayed ones to the minimum batch
+    assert job['replay_pairs'] == custom_training.TRAINING_MIN_INCREMENTAL_PAIRS - 2
+    assert served['version'] == job['model_version'] and served['swaps'] == 2
+    assert [(j['id'], j['status']) for j in runner.list()][0] == (job['id'], 'completed')
+    assert len(runner.list()) == 2
+
+def test_incremental_training_data_selection():
+    _, db, _ = make_runner(pairs=20)
+    db.add_translation_pair('low quality', 'ضعيف', quality_score=0.1)
+
+    new, replay, watermark = db.get_incremental_training_data(15, min_quality=0.5, replay_ratio=0.5, min_pairs=0)
+    assert [pair['id'] for pair in new] == [16, 17, 18, 19, 20] and watermark == 21
+    # ceil(5 * 0.5) older pairs, each at most once and never one of the new ones
+    replay_ids = [pair['id'] for pair in replay]
+    assert len(replay_ids) == 3 == len(set(replay_ids)) and max(replay_ids) <= 15
+
+    # A single new pair still gets a replayed one
+    _, replay, _ = db.get_incremental_training_data(19, min_quality=0.5, replay_ratio=0.5, min_pairs=0)
+    assert len(replay) == 1
+    # Small batches are topped up to min_pairs, as far as there are older pairs
+    new, replay, _ = db.get_incremental_training_data(15, min_quality=0.5, replay_ratio=0.5, min_pairs=12)
+    assert len(new) + len(replay) == 12
+    new, replay, _ = db.get_incremental_training_data(2, min_quality=0.5, replay_ratio=0.5, min_pairs=30)
+    assert len(new) == 18 and len(replay) == 2
+    # replay_ratio 0 replays nothing, and there is nothing to replay without new pairs
+    assert db.get_incremental_training_data(15, min_quality=0.5, replay_ratio=0.0)[1] == []
+    assert db.get_incremental_training_data(21, min_quality=0.5, replay_ratio=0.5)[:2] == ([], [])
+
+    # The watermark is recorded per trained version; unknown versions have none
+    db.record_training('v1', None, 'full', watermark, 20, 0, 0.5, 1.0)
+    assert db.get_training_watermark('v1') == 21
+    assert db.get_training_watermark('v0') is None and db.get_training_watermark(None) is None
+
+def test_watermark_passes_pairs_below_min_quality():
+    _, db, _ = make_runner(pairs=3)
+    db.add_translation_pair('draft', 'مسودة', quality_score=0.2)
+    new, _, watermark = db.get_incremental_training_data(3, min_quality=0.5, replay_ratio=0)
+    assert new == [] and watermark == 4
+    assert db.count_training_pairs(0.0, since_id=3) - db.count_training_pairs(0.5, since_id=3) == 1
+
+    # Raised later, it is only picked up again by full training
+    conn = sqlite3.connect(db.db_path)
+    with conn:
+        conn.execute('UPDATE translation_pairs SET quality_score = 0.9 WHERE id = 4')
+    conn.close()
+    assert db.get_incremental_training_data(watermark, min_quality=0.5)[0] == []
+    assert [pair['id'] for pair in db.get_incremental_training_data(0, min_quality=0.5)[0]] == [1, 2, 3, 4]
+
+def test_failed_jobs_leave_the_served_model_alone():
+    runner, db, served = make_runner()
+    db.add_translation_pair('FAIL', 'فشل', quality_score=0.8)
+    job = wait_for(runner, runner.submit('full')['id'])
+
+    assert job['status'] == 'failed' and job['error'] == 'training diverged'
+    assert served == {'version': None, 'swaps': 0}
+    assert not os.path.exists(os.path.join(runner.model_path, 'versions'))
+
+def test_progress_and_eta():
+    fields = TrainingJobRunner._progress_fields({'step': 1, 'total_steps': 4, 'loss': 2.0}, 10.0)
+    assert fields == {'step': 1, 'total_steps': 4, 'elapsed_seconds': 10.0, 'progress': 0.25,
+                      'eta_seconds': 30.0, 'loss': 2.0}
+    # No ETA before the first step, nor without a step count
+    assert 'eta_seconds' not in TrainingJobRunner._progress_fields({'step': 0, 'total_steps': 4}, 1.0)
+    assert 'progress' not in TrainingJobRunner._progress_fields({'step': 3, 'total_steps': None}, 1.0)
+
+def test_old_model_versions_are_pruned():
+    runner, _, _ = make_runner(pairs=0)
+    versions = [f'2026010{day}-000000-job{day}' for day in range(1, 7)]
+    for version in versions:
+        os.makedirs(model_version_dir(runner.model_path, version))
+
+    # The served version is kept even though it is the oldest
+    runner._remove_old_versions(versions[0])
+    kept = sorted(os.listdir(os.path.join(runner.model_path, 'versions')))
+    assert kept == [versions[0]] + versions[-(custom_training.MODEL_VERSIONS_TO_KEEP - 1):]
+
+def test_current_version_pointer():
+    model_path = tempfile.mkdtemp()
+    assert read_current_version(model_path) is None
+
+    write_current_version(model_path, '20260101-000000-a')
+    write_current_version(model_path, '20260102-000000-b')
+    assert read_current_version(model_path) == '20260102-000000-b'
+    assert os.listdir(model_path) == ['CURRENT']
+
+    with open(os.path.join(model_path, 'CURRENT'), 'w'):
+        pass
+    assert read_current_version(model_path) is None
+
+if __name__ == '__main__':
+    for name, test in list(globals().items()):
+        if name.startswith('test_') and callable(test):
+            test()
+            print(f"{name}: ok")
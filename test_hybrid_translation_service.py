@@ -0,0 +1,949 @@
+"""
+Tests for the Gemini side of hybrid_translation_service.py (HTTP client, retries and
+circuit breaker, response cache, request coalescing, batch prompts).
+
+Runs against a local stub server standing in for the Gemini generateContent
+endpoint, so no API key or network access is needed.
+
+Run with: python -m pytest test_hybrid_translation_service.py  (or python test_hybrid_translation_service.py)
+"""
+import json
+import os
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+class StubGeminiHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # Keep-alive
+
+    def do_POST(self):
+        server = self.server
+        with server.lock:
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+        try:
+            self._respond()
+        finally:
+            with server.lock:
+                server.in_flight -= 1
+
+    def _respond(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        server = self.server
+        with server.lock:
+            server.requests.append((self.path, json.loads(body)))
+            server.client_ports.add(self.client_address[1])
+
+        if server.delay:
+            time.sleep(server.delay)
+        if server.status != 200:
+            self._send(server.status, {'error': {'message': 'stub error'}})
+            return
+        prompt = json.loads(body)['contents'][0]['parts'][0]['text']
+        if server.single_status != 200 and 'Phrases:\n' not in prompt:
+            self._send(server.single_status, {'error': {'message': 'stub error'}})
+            return
+        if ':streamGenerateContent' in self.path:
+            # The Arabic line, then the transliteration after a pause
+            self._send_stream(["Arabic: بِدّي كُرة\nTrans", "literation: biddi kura"], server.stream_gap)
+            return
+        if 'Phrases:\n' in prompt:
+            # Batch prompt: answer every numbered phrase except those containing DROP
+            phrases = prompt.split('Phrases:\n', 1)[1].split('\n\n', 1)[0].split('\n')
+            text = ''.join(
+                f"[{number}]\nArabic: كُرة {number}\nTransliteration: kura {number}\n"
+                for number, phrase in enumerate(phrases, 1) if 'DROP' not in phrase
+            )
+        else:
+            text = "Arabic: بِدّي كُرة\nTransliteration: biddi kura"
+        self._send(200, {'candidates': [{'content': {'parts': [{'text': text}]}}]})
+
+    def _send(self, status, payload):
+        data = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_stream(self, texts, gap):
+        """Server-sent events, one per text, using chunked transfer encoding"""
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        for number, text in enumerate(texts):
+            if number:
+                time.sleep(gap)
+            event = {'candidates': [{'content': {'parts': [{'text': text}]}}]}
+            data = f"data: {json.dumps(event)}\r\n\r\n".encode('utf-8')
+            self.wfile.write(f"{len(data):x}\r\n".encode('ascii') + data + b"\r\n")
+            self.wfile.flush()
+        self.wfile.write(b"0\r\n\r\n")
+
+    def log_message(self, format, *args):
+        pass
+
+stub = ThreadingHTTPServer(('127.0.0.1', 0), StubGeminiHandler)
+stub.daemon_threads = True
+stub.lock = threading.Lock()
+stub.requests = []
+stub.client_ports = set()
+stub.in_flight = stub.max_in_flight = 0
+stub.status = 200
+stub.single_status = 200  # Status for single-item prompts only
+stub.delay = 0
+stub.stream_gap = 0
+threading.Thread(target=stub.serve_forever, daemon=True).start()
+
+# Configure the service before importing it
+os.environ['GEMINI_API_URL'] = f"http://127.0.0.1:{stub.server_address[1]}/v1beta/models/stub:generateContent"
+os.environ['HYBRID_DB_PATH'] = os.path.join(tempfile.mkdtemp(), 'test_hybrid.db')
+
+import hybrid_translation_service as service
+import pytest
+
+# Keep retry backoff short in tests
+service.GEMINI_BACKOFF_BASE = 0.01
+
+def reset_stub():
+    with stub.lock:
+        stub.requests.clear()
+        stub.client_ports.clear()
+        stub.max_in_flight = 0
+    stub.status = 200
+    stub.single_status = 200
+    stub.delay = 0
+    stub.stream_gap = 0
+    service.gemini_breaker.reset()
+
+def test_translate_parses_stub_response():
+    reset_stub()
+    translator = service.GeminiTranslator('key-parse')
+    arabic, transliteration = translator.translate('I want a ball', 'sports')
+
+    assert (arabic, transliteration) == ('بِدّي كُرة', 'biddi kura')
+    path, payload = stub.requests[0]
+    assert path.endswith(':generateContent?key=key-parse')
+    assert 'I want a ball' in payload['contents'][0]['parts'][0]['text']
+
+def test_connections_are_reused():
+    reset_stub()
+    translator = service.get_gemini_translator('key-reuse')
+    for _ in range(5):
+        translator.translate('hello')
+
+    assert len(stub.requests) == 5
+    assert len(stub.client_ports) == 1
+
+def test_translators_are_reused_per_api_key():
+    first = service.get_gemini_translator('key-a')
+    assert service.get_gemini_translator('key-a') is first
+    other = service.get_gemini_translator('key-b')
+    assert other is not first
+    assert other.session is first.session
+
+def test_server_errors_are_retried_then_raised():
+    reset_stub()
+    stub.status = 500
+    translator = service.GeminiTranslator('key-error', breaker=service.CircuitBreaker(failure_threshold=100))
+
+    with pytest.raises(service.GeminiError) as error:
+        translator.translate('hello')
+    assert error.value.retryable
+    assert len(stub.requests) == translator.max_attempts
+
+def test_client_errors_are_not_retried():
+    reset_stub()
+    stub.status = 400
+    translator = service.GeminiTranslator('key-bad')
+
+    with pytest.raises(service.GeminiError) as error:
+        translator.translate('hello')
+    assert not error.value.retryable
+    assert len(stub.requests) == 1
+    assert translator.breaker.state == service.CircuitBreaker.CLOSED
+
+def test_read_timeout_is_separate_from_connect_timeout():
+    reset_stub()
+    stub.delay = 0.5
+    translator = service.GeminiTranslator('key-timeout')
+    translator.timeout = (service.GEMINI_CONNECT_TIMEOUT, 0.1)
+    translator.max_attempts = 1
+
+    start = time.monotonic()
+    with pytest.raises(service.GeminiError):
+        translator.translate('hello')
+    assert time.monotonic() - start < 0.5
+
+def test_deadline_bounds_the_whole_call():
+    reset_stub()
+    stub.delay = 0.5
+    translator = service.GeminiTranslator('key-deadline', breaker=service.CircuitBreaker(failure_threshold=100))
+    translator.deadline = 0.3
+
+    start = time.monotonic()
+    with pytest.raises(service.GeminiError):
+        translator.translate('hello')
+    assert time.monotonic() - start < 0.5
+
+def test_circuit_breaker_fails_fast_and_recovers():
+    reset_stub()
+    stub.status = 503
+    breaker = service.CircuitBreaker(failure_threshold=2, reset_timeout=0.2)
+    translator = service.GeminiTranslator('key-breaker', breaker=breaker)
+    translator.max_attempts = 1
+
+    for _ in range(2):
+        with pytest.raises(service.GeminiError):
+            translator.translate('hello')
+    assert breaker.state == service.CircuitBreaker.OPEN
+
+    # Open: rejected without calling Gemini
+    with pytest.raises(service.GeminiUnavailable):
+        translator.translate('hello')
+    assert len(stub.requests) == 2
+
+    # After the reset timeout a trial call goes through and closes the breaker
+    stub.status = 200
+    time.sleep(0.25)
+    assert translator.translate('hello') == ('بِدّي كُرة', 'biddi kura')
+    assert breaker.metrics()['state'] == service.CircuitBreaker.CLOSED
+
+def test_translate_endpoint_returns_503_while_breaker_is_open():
+    reset_stub()
+    for _ in range(service.gemini_breaker.failure_threshold):
+        service.gemini_breaker.record_failure()
+    client = service.app.test_client()
+    response = client.post('/translate', json={
+        'english_text': 'breaker open',
+        'gemini_api_key': 'key-endpoint',
+        'save_for_review': False
+    })
+
+    assert response.status_code == 503
+    assert int(response.headers['Retry-After']) >= 1
+    assert not stub.requests
+    assert client.get('/metrics').get_json()['gemini_breaker']['state'] == 'open'
+    service.gemini_breaker.reset()
+
+def test_translate_endpoint_uses_stub():
+    reset_stub()
+    client = service.app.test_client()
+    response = client.post('/translate', json={
+        'english_text': 'I want a ball',
+        'gemini_api_key': 'key-endpoint',
+        'save_for_review': False
+    })
+
+    assert response.status_code == 200
+    data = response.get_json()
+    assert data['gemini_original']['arabic'] == 'بِدّي كُرة'
+    assert data['arabic'] == 'بِدّي طابة'
+    assert data['transliteration'] == 'biddi taabeh'
+
+def test_cached_responses_skip_gemini_but_apply_replacements():
+    reset_stub()
+    client = service.app.test_client()
+    request = {'english_text': 'Where is the ball', 'gemini_api_key': 'key-cache', 'save_for_review': False}
+
+    first = client.post('/translate', json=request).get_json()
+    request['english_text'] = '  where is THE ball '
+    second = client.post('/translate', json=request).get_json()
+
+    assert len(stub.requests) == 1
+    assert (first['cache_hit'], second['cache_hit']) == (False, True)
+    assert second['arabic'] == first['arabic'] == 'بِدّي طابة'
+
+def test_concurrent_identical_requests_share_one_gemini_call():
+    reset_stub()
+    stub.delay = 0.3
+    cache = service.GeminiResponseCache(service.db)
+    translator = service.get_gemini_translator('key-coalesce')
+    results = []
+
+    def translate():
+        results.append(cache.translate(translator, 'Red ball', 'sports'))
+
+    threads = [threading.Thread(target=translate) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(stub.requests) == 1
+    assert [result[:2] for result in results] == [('بِدّي كُرة', 'biddi kura')] * 5
+    assert cache.flights.metrics()['coalesced'] == 4
+
+def test_batch_endpoint_packs_items_and_retries_dropped_ones():
+    reset_stub()
+    client = service.app.test_client()
+    response = client.post('/translate_batch', json={
+        'items': [{'english_text': 'one'}, 'two', {'english_text': 'DROP me'}, 'ONE '],
+        'gemini_api_key': 'key-batch',
+        'save_for_review': False
+    })
+
+    assert response.status_code == 200
+    data = response.get_json()
+    # One batch prompt for the three distinct phrases, plus a single retry for the dropped one
+    assert len(stub.requests) == 2
+    assert data['gemini_items'] == 3
+    assert [t['gemini_original']['arabic'] for t in data['translations']] == [
+        'كُرة 1', 'كُرة 2', 'بِدّي كُرة', 'كُرة 1'
+    ]
+    assert data['translations'][0]['arabic'] == 'طابة 1'
+
+def test_batch_keeps_translated_items_when_retries_fail():
+    reset_stub()
+    stub.single_status = 400
+    translator = service.GeminiTranslator('key-partial')
+    results = translator.translate_batch([('one', None), ('DROP me', None), ('three', None)])
+    assert results[0] == ('كُرة 1', 'kura 1') and results[2] == ('كُرة 3', 'kura 3')
+    assert isinstance(results[1], service.GeminiError)
+
+    response = service.app.test_client().post('/translate_batch', json={
+        'items': ['one', 'DROP me too'], 'gemini_api_key': 'key-partial', 'save_for_review': False
+    })
+    data = response.get_json()
+    assert response.status_code == 200 and data['errors'] == 1
+    assert data['translations'][0]['arabic'] and 'error' in data['translations'][1]
+
+def test_batch_fails_items_instead_of_retrying_most_of_a_chunk():
+    reset_stub()
+    translator = service.GeminiTranslator('key-mostly-dropped')
+    results = translator.translate_batch([('DROP a', None), ('DROP b', None), ('c', None)])
+    assert len(stub.requests) == 1
+    assert results[2] == ('كُرة 3', 'kura 3')
+    assert all(isinstance(result, service.GeminiError) and result.retryable for result in results[:2])
+
+def test_batch_calls_share_one_deadline():
+    reset_stub()
+    stub.delay = 0.2
+    translator = service.GeminiTranslator('key-batch-deadline', breaker=service.CircuitBreaker(failure_threshold=100))
+    translator.deadline = 0.3
+
+    start = time.monotonic()
+    results = translator.translate_batch([('DROP a', None), ('b', None), ('c', None)])
+    # The batch call used most of the deadline, so the retry times out instead of
+    # getting a deadline of its own
+    assert time.monotonic() - start < 0.4
+    assert results[1:] == [('كُرة 2', 'kura 2'), ('كُرة 3', 'kura 3')]
+    assert isinstance(results[0], service.GeminiError)
+
+def test_full_batch_request_fits_the_deadline_at_gemini_latency():
+    reset_stub()
+    stub.delay = 1.0  # Per Gemini call, like a real 25-phrase prompt
+    translator = service.GeminiTranslator('key-batch-latency')
+    items = [(f'phrase {number}', None) for number in range(service.MAX_BATCH_REQUEST_ITEMS)]
+    while stub.in_flight:  # Calls earlier tests gave up on
+        time.sleep(0.05)
+
+    start = time.monotonic()
+    results = translator.translate_batch(items, deadline=time.monotonic() + 6)
+    # 20 prompts in rounds of GEMINI_BATCH_CONCURRENCY, not one after another
+    assert time.monotonic() - start < 6
+    assert not [result for result in results if isinstance(result, service.GeminiError)]
+    assert results[0] == ('كُرة 1', 'kura 1') and results[-1] == ('كُرة 25', 'kura 25')
+    assert len(stub.requests) == -(-len(items) // service.GEMINI_BATCH_SIZE)
+    assert stub.max_in_flight == service.GEMINI_BATCH_CONCURRENCY
+
+def test_rate_limits_leave_the_breaker_alone():
+    reset_stub()
+    stub.status = 429
+    breaker = service.CircuitBreaker(failure_threshold=2)
+    breaker.record_failure()
+    translator = service.GeminiTranslator('key-429', breaker=breaker)
+    translator.max_attempts = 1
+
+    with pytest.raises(service.GeminiError) as error:
+        translator.translate('hello')
+    assert error.value.retryable
+    assert breaker.consecutive_failures == 1 and breaker.state == service.CircuitBreaker.CLOSED
+
+def test_async_translate_endpoint_matches_flask():
+    aiohttp_test_utils = pytest.importorskip('aiohttp.test_utils')
+    import asyncio
+    import async_hybrid_translation_service as async_service
+
+    payload = {'english_text': 'async ball', 'context': 'sports', 'gemini_api_key': 'key-async',
+               'save_for_review': False}
+
+    async def run():
+        async with aiohttp_test_utils.TestClient(aiohttp_test_utils.TestServer(async_service.create_app())) as client:
+            # Concurrent identical requests share one Gemini call
+            stub.delay = 0.2
+            responses = await asyncio.gather(*(client.post('/translate', json=payload) for _ in range(5)))
+            stub.delay = 0
+            bodies = [await response.json() for response in responses]
+            missing = await client.post('/translate', json={'gemini_api_key': 'key-async'})
+            return [r.status for r in responses], bodies, missing.status
+
+    reset_stub()
+    statuses, bodies, missing_status = asyncio.run(run())
+    assert statuses == [200] * 5
+    assert missing_status == 400
+    assert len(stub.requests) == 1
+
+    # Same response as the Flask endpoint (which now hits the cache)
+    expected = service.app.test_client().post('/translate', json=payload).get_json()
+    assert expected['cache_hit']
+    assert bodies[0] == dict(expected, cache_hit=False)
+
+def test_translation_memory_answers_before_gemini():
+    reset_stub()
+    db = service.db
+    db.save_translations_for_review([db._review_row('Where is the stadium?', 'sports', 'وين', 'wen',
+                                                    'وين الملعب؟', 'wen el mal3ab?', [])])
+    pending = [r for r in db.get_pending_reviews(50) if r['english'] == 'Where is the stadium?']
+    db.approve_translation(pending[0]['id'])
+    client = service.app.test_client()
+
+    def translate(text, **options):
+        return client.post('/translate', json=dict({
+            'english_text': text, 'context': 'sports', 'gemini_api_key': 'key-memory', 'save_for_review': False
+        }, **options)).get_json()
+
+    exact = translate('  where is  the STADIUM? ')
+    assert exact['source'] == 'translation_memory'
+    assert exact['arabic'] == 'وين الملعب؟'
+    assert exact['translation_memory']['match'] == 'exact'
+    # Keys are normalized like the Gemini cache's: non-ASCII letters are lowercased too
+    db.save_translations_for_review([db._review_row('ÉCLAIR  please', 'sports', 'ع', '3', 'إكلير', 'eclair', [])])
+    db.approve_translation([r for r in db.get_pending_reviews(50) if r['english'] == 'ÉCLAIR  please'][0]['id'])
+    assert translate('éclair please')['source'] == 'translation_memory'
+
+    # Near-identical input: only in fuzzy mode, and only above the threshold
+    assert translate('Where is the stadium', translation_memory='fuzzy')['translation_memory']['match'] == 'fuzzy'
+    assert not stub.requests
+    assert translate('Where is the stadium')['source'] == 'gemini'
+    assert translate('Where is the stadium now', translation_memory='fuzzy',
+                     similarity_threshold=0.99)['source'] == 'gemini'
+    assert translate('Where is the stadium?', translation_memory='off')['source'] == 'gemini'
+    assert len(stub.requests) == 3
+
+    # Approved translations are only reused in the same context
+    other_context = client.post('/translate', json={'english_text': 'Where is the stadium?',
+                                                    'gemini_api_key': 'key-memory', 'save_for_review': False})
+    assert other_context.get_json()['source'] == 'gemini'
+
+def test_line_parser_returns_fields_as_lines_complete():
+    parser = service.TranslationLineParser()
+    assert parser.feed("Ara") == []
+    assert parser.feed("bic: بِدّي كُرة\nTransliteration: bi") == [('arabic', 'بِدّي كُرة')]
+    assert parser.feed("ddi kura") == []
+    assert parser.close() == [('transliteration', 'biddi kura')]
+
+def test_stream_endpoint_sends_arabic_before_transliteration():
+    reset_stub()
+    stub.stream_gap = 0.5
+    client = service.app.test_client()
+    start = time.monotonic()
+    response = client.post('/translate_stream', buffered=False, json={
+        'english_text': 'I want a ball, streamed',
+        'gemini_api_key': 'key-stream',
+        'save_for_review': False
+    })
+    events = []
+    for chunk in response.response:
+        for block in chunk.decode('utf-8').strip().split('\n\n'):
+            name, data = block.split('\n', 1)
+            events.append((name[len('event: '):], json.loads(data[len('data: '):]), time.monotonic() - start))
+    response.close()
+
+    assert [name for name, _, _ in events] == ['arabic', 'transliteration', 'done']
+    arabic, transliteration, done = events
+    # Word replacements are applied to the Arabic line before the transliteration arrives
+    assert arabic[1]['arabic'] == 'بِدّي طابة'
+    assert arabic[2] < 0.4 <= transliteration[2]
+    assert transliteration[1]['transliteration'] == 'biddi taabeh'
+    assert done[1]['source'] == 'gemini' and not done[1]['cache_hit']
+    assert stub.requests[0][0].split('?')[0].endswith(':streamGenerateContent')
+
+def test_fake_gemini_server_responses_parse():
+    from fake_gemini_server import fake_response_text
+
+    translator = service.GeminiTranslator('key-fake')
+    single = fake_response_text('Translate "I want a ball" to colloquial Levantine Arabic')
+    assert translator._parse_translation(single) == ('بِدّي كُرة 4', 'biddi kura 4')
+    batch = translator.build_batch_prompt([('ball', 'sports'), ('house', None), ('car', None)])
+    assert sorted(translator.parse_batch_response(fake_response_text(batch), 3)) == [0, 1, 2]
+
+def test_word_replacements_are_keyed_without_diacritics():
+    db = service.db
+    client = service.app.test_client()
+    entry = {'original_arabic': 'سَيّارة', 'original_transliteration': 'sayyara',
+             'replacement_arabic': 'عربية', 'replacement_transliteration': '3arabiyye'}
+    assert not client.post('/add_word_replacement', json=entry).get_json()['updated']
+    # The same word without diacritics updates the existing entry instead of adding another
+    response = client.post('/add_word_replacement', json=dict(entry, original_arabic='سيارة', reason='spoken'))
+    assert response.get_json()['updated'] and response.get_json()['original_arabic'] == 'سَيّارة'
+    replacements = db.get_word_replacements()
+    assert 'سيارة' not in replacements
+    assert replacements['سَيّارة']['match_key'] == 'سيارة' and replacements['سَيّارة']['reason'] == 'spoken'
+
+    found = client.get('/word_replacements', query_string={'arabic': 'وين السيّارة؟ بِدّي كُرة'}).get_json()
+    assert sorted(found['word_replacements']) == ['كُرة']
+    found = client.get('/word_replacements', query_string={'arabic': 'سيّارة جديدة'}).get_json()
+    assert list(found['word_replacements']) == ['سَيّارة']
+    assert db.apply_word_replacements('سيارة جديدة', 'sayyara jdide', count_usage=False)[0] == 'عربية جديدة'
+    assert client.post('/add_word_replacement', json=dict(entry, original_arabic=' ')).status_code == 400
+
+def test_retention_moves_old_reviews_to_queryable_archives():
+    db = service.db
+    db.save_translations_for_review([
+        db._review_row(f'archive me {number}', None, 'ع', '3', 'ع', '3', []) for number in range(5)
+    ])
+    ids = sorted(r['id'] for r in db.get_pending_reviews(500) if r['english'].startswith('archive me'))
+    db.review_translations('approved', ids[:2])
+    db.review_translations('declined', ids[2:4])
+    # ids[4] stays pending; ids[0..3] were reviewed long ago, in two different months
+    with db.pool.transaction() as conn:
+        conn.execute("UPDATE translation_history SET reviewed_at = '2024-03-20 10:00:00', "
+                     "created_at = '2024-03-01 10:00:00' WHERE id IN (?, ?)", (ids[0], ids[2]))
+        conn.execute("UPDATE translation_history SET reviewed_at = '2024-04-20 10:00:00', "
+                     "created_at = '2024-04-01 10:00:00' WHERE id IN (?, ?)", (ids[1], ids[3]))
+    stats_before = db.get_stats()
+
+    assert db.archive_reviewed_history(30, 'jsonl.gz', batch_size=1) == {'2024-03': 2, '2024-04': 2}
+    assert db.archive_reviewed_history(30, 'sqlite') == {}
+    assert [r['id'] for r in db.get_pending_reviews(500) if r['english'].startswith('archive me')] == [ids[4]]
+    stats = db.get_stats()
+    assert stats['approved_reviews'] == stats_before['approved_reviews']
+    assert stats['declined_reviews'] == stats_before['declined_reviews']
+    assert stats['archived_reviews'] == 4
+    assert db.incremental_vacuum() >= 0
+
+    client = service.app.test_client()
+    months = client.get('/archived_translations').get_json()['archives']
+    assert [(m['month'], m['format'], m['approved'], m['declined']) for m in months] == [
+        ('2024-03', 'jsonl.gz', 1, 1), ('2024-04', 'jsonl.gz', 1, 1)]
+    page = client.get('/archived_translations?month=2024-03&limit=1').get_json()
+    assert [r['id'] for r in page['translations']] == [ids[0]] and page['translations'][0]['status'] == 'approved'
+    page = client.get(f"/archived_translations?month=2024-03&after_id={page['next_after_id']}").get_json()
+    assert [r['id'] for r in page['translations']] == [ids[2]] and page['next_after_id'] is None
+    declined = client.get('/archived_translations?month=2024-04&status=declined&q=ME 3').get_json()
+    assert [r['english'] for r in declined['translations']] == ['archive me 3']
+    assert client.get('/archived_translations?month=2023-01').status_code == 404
+
+def test_sqlite_archives_open_under_any_directory_name():
+    import hybrid_db
+    archive = hybrid_db.TranslationHistoryArchive(os.path.join(tempfile.mkdtemp(), 'archives?v=1#old 100%'))
+    row = (7, 'ball', None, 'كرة', 'kura', 'طابة', 'taabe', '[]', 'approved', 'admin', '',
+           '2024-03-01 10:00:00', '2024-03-02 10:00:00')
+    path = archive.write('2024-03', 'sqlite', [row])
+    assert [record['id'] for record in archive.query(path, 'sqlite')] == [7]
+
+def test_retention_skips_rows_reviewed_again_while_archiving():
+    db = service.db
+    db.save_translations_for_review([
+        db._review_row(f'late review {number}', None, 'ع', '3', 'ع', '3', []) for number in range(2)
+    ])
+    ids = sorted(r['id'] for r in db.get_pending_reviews(500) if r['english'].startswith('late review'))
+    db.review_translations('declined', ids)
+    with db.pool.transaction() as conn:
+        conn.execute("UPDATE translation_history SET reviewed_at = '2024-05-20 10:00:00', created_at = NULL "
+                     "WHERE id IN (?, ?)", ids)
+
+    write = db.archive.write
+    def write_then_review(month, archive_format, rows):
+        path = write(month, archive_format, rows)
+        db.review_translations('approved', [ids[1]])  # A reviewer changes their mind meanwhile
+        return path
+    db.archive.write = write_then_review
+    try:
+        # Without created_at the row is archived by the month it was reviewed in
+        assert db.archive_reviewed_history(30, 'sqlite') == {'2024-05': 1}
+    finally:
+        db.archive.write = write
+    remaining = [r for r in db.iter_approved_translations(dedup=False) if r['english'] == 'late review 1']
+    assert len(remaining) == 1
+
+def test_read_only_database_is_read_as_it_is():
+    import sqlite3
+    import hybrid_db
+    path = os.path.join(tempfile.mkdtemp(), 'legacy.db')
+    conn = sqlite3.connect(path)
+    with conn:
+        conn.execute('CREATE TABLE approved_translations (id INTEGER PRIMARY KEY, english_text TEXT, arabic_text TEXT, '
+                     'transliteration TEXT, context TEXT, quality_score REAL, source TEXT, created_at TIMESTAMP)')
+        conn.execute("INSERT INTO approved_translations VALUES (1, 'ball', 'طابة', 'taabe', NULL, 1.0, 'approved', NULL)")
+    conn.close()
+    threads = threading.active_count()
+
+    db = hybrid_db.LevantineHybridDB(path, read_only=True)
+    assert [row['english'] for row in db.iter_approved_translations()] == ['ball']
+    db.close()
+    assert threading.active_count() == threads
+    conn = sqlite3.connect(path)
+    assert conn.execute('PRAGMA user_version').fetchone()[0] == 0
+    assert conn.execute('PRAGMA journal_mode').fetchone()[0] == 'delete'
+    conn.close()
+
+def wait_until(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, 'timed out'
+        time.sleep(0.02)
+
+def test_usage_counts_are_buffered_and_flushed():
+    import sqlite3
+    import hybrid_db
+    path = os.path.join(tempfile.mkdtemp(), 'usage.db')
+    threshold, hybrid_db.USAGE_FLUSH_THRESHOLD = hybrid_db.USAGE_FLUSH_THRESHOLD, 5
+    try:
+        db = hybrid_db.LevantineHybridDB(path)
+        db.add_word_replacement('كرة', 'kura', 'طابة', 'taabe')
+
+        def stored():
+            with db.pool.connection() as conn:
+                return conn.execute("SELECT usage_count FROM word_replacements").fetchone()[0]
+
+        for _ in range(4):
+            db.apply_word_replacements('كرة', 'kura')
+        time.sleep(0.2)
+        assert stored() == 0  # Below the threshold, still buffered
+        db.apply_word_replacements('كرة', 'kura')
+        wait_until(lambda: stored() == 5)  # The background flusher wrote them
+
+        db.apply_word_replacements('كرة', 'kura')
+        db.close()
+        conn = sqlite3.connect(path)
+        assert conn.execute("SELECT usage_count FROM word_replacements").fetchone()[0] == 6
+        conn.close()
+    finally:
+        hybrid_db.USAGE_FLUSH_THRESHOLD = threshold
+
+def test_usage_counts_stay_exact_while_flushing_concurrently():
+    import hybrid_db
+    db = hybrid_db.LevantineHybridDB(os.path.join(tempfile.mkdtemp(), 'usage.db'), background=False)
+    db.add_word_replacement('كرة', 'kura', 'طابة', 'taabe')
+    db.add_word_replacement('بيت', 'bayt', 'دار', 'dar')
+    done = threading.Event()
+
+    def flush():
+        while not done.is_set():
+            db.flush_usage_counts()
+
+    def increment():
+        for number in range(500):
+            db.increment_usage_count('كرة' if number % 2 else 'بيت')
+
+    flusher = threading.Thread(target=flush)
+    flusher.start()
+    workers = [threading.Thread(target=increment) for _ in range(8)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    done.set()
+    flusher.join()
+
+    stats = db.get_stats()  # Flushes what is left
+    assert stats['total_usage'] == 4000
+    assert {word: entry['usage_count'] for word, entry in db.get_word_replacements().items()} == {
+        'كرة': 2000, 'بيت': 2000}
+    db.close()
+
+def test_history_writer_persists_queued_rows_and_flushes_on_close():
+    import sqlite3
+    import hybrid_db
+    path = os.path.join(tempfile.mkdtemp(), 'history.db')
+    db = hybrid_db.LevantineHybridDB(path)
+    for number in range(30):
+        assert db.queue_translation_for_review(f'queued {number}', None, 'ع', '3', 'ع', '3', [])
+    wait_until(lambda: db.history_writer.metrics()['written'] == 30)
+    assert db.history_writer.metrics()['queue_depth'] == 0
+    assert len(db.get_pending_reviews(500)) == 30
+
+    # Rows still queued when the database is closed are written, not lost
+    for number in range(500):
+        db.queue_translation_for_review(f'at close {number}', None, 'ع', '3', 'ع', '3', [])
+    db.close()
+    conn = sqlite3.connect(path)
+    assert conn.execute('SELECT COUNT(*) FROM translation_history').fetchone()[0] == 530
+    conn.close()
+
+def test_history_writer_counts_drops_when_the_queue_is_full():
+    import hybrid_db
+
+    class BlockedDB:
+        """Stands in for the database; writes wait until released"""
+        def __init__(self):
+            self.release = threading.Event()
+            self.rows = []
+
+        def save_translations_for_review(self, rows):
+            self.release.wait()
+            self.rows.extend(rows)
+
+    db = BlockedDB()
+    writer = hybrid_db.TranslationHistoryWriter(db, max_queue=2, batch_size=10)
+    assert writer.submit(('first',))
+    wait_until(lambda: writer.metrics()['queue_depth'] == 0)  # Taken by the (blocked) writer thread
+    assert writer.submit(('second',)) and writer.submit(('third',))
+    assert not writer.submit(('dropped',))
+    assert writer.metrics()['dropped'] == 1 and writer.metrics()['queue_depth'] == 2
+
+    db.release.set()
+    writer.close()
+    metrics = writer.metrics()
+    assert db.rows == [('first',), ('second',), ('third',)]
+    assert (metrics['written'], metrics['batches'], metrics['dropped']) == (3, 2, 1)
+
+def test_export_of_approved_translations():
+    import csv
+    import io
+    import subprocess
+    import sys
+    import hybrid_db
+    db = service.db
+    client = service.app.test_client()
+
+    def approve(*rows):
+        db.save_translations_for_review([db._review_row(english, context, arabic, 'tr', arabic, 'tr', [])
+                                         for english, context, arabic in rows])
+        db.review_translations('approved', [r['id'] for r in db.get_pending_reviews(500)
+                                            if r['english'].startswith('export ')])
+
+    since_id = db.get_export_watermark()
+    approve(('export greeting', 'casual', 'مرحبا، "يا" صاحبي, كيفك'),
+            ('export ball', 'sports', 'طابة'), ('export ball', 'sports', 'طابة'))
+
+    response = client.get('/export/approved_translations', query_string={'since_id': since_id})
+    watermark = int(response.headers['X-Export-Watermark'])
+    rows = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    assert watermark == db.get_export_watermark() == since_id + 3
+    # The repeated pair is exported once
+    assert [(row['english'], row['context']) for row in rows] == [('export greeting', 'casual'),
+                                                                  ('export ball', 'sports')]
+    assert rows[0]['arabic'] == 'مرحبا، "يا" صاحبي, كيفك' and list(rows[0]) == list(hybrid_db.EXPORT_FIELDS)
+    response = client.get('/export/approved_translations', query_string={'since_id': since_id, 'dedup': 'false'})
+    assert len(response.get_data(as_text=True).splitlines()) == 3
+
+    response = client.get('/export/approved_translations', query_string={'since_id': since_id, 'format': 'csv'})
+    text = response.get_data(as_text=True)
+    assert response.mimetype == 'text/csv' and text.splitlines()[0] == ','.join(hybrid_db.EXPORT_FIELDS)
+    assert '"مرحبا، ""يا"" صاحبي, كيفك"' in text
+    assert [row['arabic'] for row in csv.DictReader(io.StringIO(text))] == ['مرحبا، "يا" صاحبي, كيفك', 'طابة']
+
+    # Exporting from the watermark returns only what was approved since
+    assert client.get('/export/approved_translations', query_string={'since_id': watermark}).get_data() == b''
+    assert client.get('/export/approved_translations?format=xml').status_code == 400
+
+    # The CLI keeps the watermark in a file between runs
+    directory = tempfile.mkdtemp()
+    watermark_file = os.path.join(directory, 'watermark')
+    with open(watermark_file, 'w') as f:
+        f.write(str(since_id))
+
+    def export(export_format):
+        output = os.path.join(directory, f'export.{export_format}')
+        subprocess.run([sys.executable, 'export_training_data.py', '--db', db.db_path, '--format', export_format,
+                        '--watermark-file', watermark_file, '--output', output],
+                       check=True, capture_output=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+        with open(output, encoding='utf-8') as f:
+            return f.read()
+
+    assert [json.loads(line)['english'] for line in export('jsonl').splitlines()] == ['export greeting', 'export ball']
+    assert open(watermark_file).read() == str(watermark)
+    assert export('csv').splitlines() == [','.join(hybrid_db.EXPORT_FIELDS)]
+    approve(('export house', None, 'بيت'))
+    assert [row['english'] for row in csv.DictReader(io.StringIO(export('csv')))] == ['export house']
+    assert open(watermark_file).read() == str(watermark + 1)
+
+def test_stats_counters_match_tables_after_replace_from_other_connections():
+    import sqlite3
+    db = service.db
+    db.save_translations_for_review([db._review_row('replace me', None, 'ع', '3', 'ع', '3', [])])
+    row_id = [r['id'] for r in db.get_pending_reviews(500) if r['english'] == 'replace me'][0]
+    # A connection without the pool's pragmas (recursive_triggers is off by default)
+    conn = sqlite3.connect(db.db_path)
+    with conn:
+        conn.execute("INSERT OR REPLACE INTO translation_history (id, english_text, gemini_arabic, "
+                     "gemini_transliteration, final_arabic, final_transliteration, status) "
+                     "VALUES (?, 'replace me', 'ع', '3', 'ع', '3', 'declined')", (row_id,))
+        conn.execute("INSERT OR REPLACE INTO word_replacements (original_arabic, original_transliteration, "
+                     "replacement_arabic, replacement_transliteration, usage_count) "
+                     "VALUES ('كُرة', 'kura', 'طابة', 'taabe', 7)")
+        counts = conn.execute('''
+            SELECT (SELECT COUNT(*) FROM translation_history WHERE status = 'pending'),
+                   (SELECT COUNT(*) FROM translation_history WHERE status = 'declined'),
+                   (SELECT COUNT(*) FROM word_replacements),
+                   (SELECT SUM(usage_count) FROM word_replacements)
+        ''').fetchone()
+    conn.close()
+    with db.pool.connection() as conn:
+        stats = conn.execute('''
+            SELECT pending_reviews, declined_reviews, word_replacements_count, total_usage FROM hybrid_stats
+        ''').fetchone()
+    assert stats == counts
+
+def test_stats_endpoint_matches_table_counts():
+    db = service.db
+    client = service.app.test_client()
+
+    def check():
+        stats = client.get('/stats').get_json()  # Flushes buffered usage counts first
+        with db.pool.connection() as conn:
+            counts = conn.execute('''
+                SELECT (SELECT COUNT(*) FROM translation_history WHERE status = 'pending'),
+                       (SELECT COUNT(*) FROM translation_history WHERE status = 'approved')
+                         + (SELECT COALESCE(SUM(approved), 0) FROM history_archives),
+                       (SELECT COUNT(*) FROM translation_history WHERE status = 'declined')
+                         + (SELECT COALESCE(SUM(declined), 0) FROM history_archives),
+                       (SELECT COUNT(*) FROM approved_translations),
+                       (SELECT COUNT(*) FROM word_replacements),
+                       (SELECT COALESCE(SUM(usage_count), 0) FROM word_replacements)
+            ''').fetchone()
+        assert (stats['pending_reviews'], stats['approved_reviews'], stats['declined_reviews'],
+                stats['approved_translations'], stats['word_replacements_count'], stats['total_usage']) == counts
+
+    db.save_translations_for_review([db._review_row(f'stats {number}', None, 'ع', '3', 'ع', '3', [])
+                                     for number in range(6)])
+    ids = sorted(r['id'] for r in db.get_pending_reviews(500) if r['english'].startswith('stats '))
+    check()
+    db.review_translations('approved', ids[:3])
+    db.review_translations('declined', ids[3:5])
+    check()
+    db.review_translations('declined', ids[:1])  # Approved, then declined
+    db.review_translations('approved', ids[3:4])  # Declined, then approved
+    check()
+    db.add_word_replacement('برتقان', 'burtuan', 'ليمون', 'laymoun')
+    db.apply_word_replacements('برتقان', 'burtuan')
+    check()
+    with db.pool.transaction() as conn:
+        conn.execute('DELETE FROM translation_history WHERE id IN (?, ?, ?)', (ids[1], ids[4], ids[5]))
+        conn.execute('DELETE FROM approved_translations WHERE history_id = ?', (ids[2],))
+        conn.execute("DELETE FROM word_replacements WHERE original_arabic = 'برتقان'")
+    check()
+
+def test_replacement_index_sees_changes_from_other_processes():
+    import sqlite3
+    db = service.db
+    assert db.apply_word_replacements('شباك مفتوح', 'shubbak maftou7', count_usage=False)[2] == []
+    # Another process (the async service, another worker) adds a replacement
+    conn = sqlite3.connect(db.db_path)
+    with conn:
+        conn.execute("INSERT INTO word_replacements (original_arabic, original_transliteration, replacement_arabic, "
+                     "replacement_transliteration, match_key) VALUES ('شباك', 'shubbak', 'شبّاك', 'shibbaak', 'شباك')")
+    conn.close()
+    assert db.apply_word_replacements('شباك مفتوح', 'shubbak maftou7', count_usage=False)[:2] == (
+        'شبّاك مفتوح', 'shibbaak maftou7')
+    # Usage count updates don't invalidate the index
+    version = db.get_replacements_version()
+    db.increment_usage_count('شباك')
+    db.flush_usage_counts()
+    assert db.get_replacements_version() == version
+
+def test_replacements_without_match_key_are_still_matched():
+    import sqlite3
+    db = service.db
+    conn = sqlite3.connect(db.db_path)
+    with conn:
+        # Written without match_key, as by code from before the column existed
+        conn.execute("INSERT INTO word_replacements (original_arabic, original_transliteration, replacement_arabic, "
+                     "replacement_transliteration) VALUES ('كِنْبة', 'kanabe', 'كنباية', 'kanabaaye')")
+    conn.close()
+    assert db.apply_word_replacements('الكنبة كنبة', 'kanabe', count_usage=False)[2] == ['كِنْبة → كنباية']
+    found = service.app.test_client().get('/word_replacements', query_string={'arabic': 'كنبة'}).get_json()
+    assert list(found['word_replacements']) == ['كِنْبة']
+
+def test_declining_an_approved_translation_removes_it_from_training_data():
+    db = service.db
+    client = service.app.test_client()
+    db.save_translations_for_review([
+        db._review_row(f'bulk review {number}', None, 'ع', '3', 'ع', '3', []) for number in range(3)
+    ])
+    ids = sorted(r['id'] for r in db.get_pending_reviews(500) if r['english'].startswith('bulk review'))
+
+    def copies():
+        return [row['id'] for row in db.iter_approved_translations(dedup=False)
+                if row['english'].startswith('bulk review')]
+
+    response = client.post('/approve_translations', json={'ids': ids}).get_json()
+    assert response['counts'] == {'approved': 3} and len(copies()) == 3
+    assert client.post(f'/approve_translation/{ids[0]}', json={}).status_code == 200
+    assert len(copies()) == 3  # Approving again doesn't add another copy
+    client.post(f'/decline_translation/{ids[0]}', json={})
+    response = client.post('/decline_translations', json={'ids': ids[1:]}).get_json()
+    assert response['counts'] == {'declined': 2} and copies() == []
+    assert client.post('/approve_translations', json={'ids': [True]}).status_code == 400
+
+    # Filters review at most the limit, oldest first
+    db.save_translations_for_review([db._review_row('bulk limit', None, 'ع', '3', 'ع', '3', [])] * 3)
+    outcomes = db.review_translations('declined', filters={'status': 'pending'}, limit=2)
+    pending = [r['id'] for r in db.get_pending_reviews(500)]
+    assert len(outcomes) == 2 and all(outcome['id'] < min(pending) for outcome in outcomes)
+
+def test_pending_reviews_cursor_pagination():
+    db = service.db
+    client = service.app.test_client()
+    db.save_translations_for_review([
+        db._review_row(f'review page {number}', None, 'ع', '3', 'ع', '3', []) for number in range(7)
+    ])
+    with db.pool.transaction() as conn:
+        # Rows written by hand can lack created_at
+        conn.execute("UPDATE translation_history SET created_at = NULL WHERE english_text IN "
+                     "('review page 2', 'review page 5')")
+        expected = [row[0] for row in conn.execute(
+            "SELECT id FROM translation_history WHERE status = 'pending' ORDER BY created_at IS NULL, "
+            "created_at DESC, id DESC")]
+
+    ids, cursor, pages = [], None, 0
+    while True:
+        query = {'limit': 3} | ({'cursor': cursor} if cursor else {})
+        response = client.get('/pending_reviews', query_string=query)
+        assert response.status_code == 200, response.get_json()
+        page = response.get_json()
+        assert page['count'] == len(page['pending_reviews']) <= 3
+        ids += [review['id'] for review in page['pending_reviews']]
+        pages += 1
+        cursor = page['next_cursor']
+        if cursor is None:
+            break
+    assert ids == expected and pages == -(-len(expected) // 3)
+
+    for query in ('limit=0', 'limit=501', 'limit=ten', 'limit=2.5', 'cursor=%%%', 'cursor=WzEsMl0='):
+        assert client.get(f'/pending_reviews?{query}').status_code == 400, query
+
+def test_bulk_review_filters_end_and_key_approved_copies():
+    db = service.db
+    client = service.app.test_client()
+    db.save_translations_for_review([
+        db._review_row(f'  Bulk  ÉCOLE {number} ', 'At  SCHOOL', 'ع', '3', 'ع', '3', []) for number in range(5)
+    ])
+    limit, service.MAX_BULK_REVIEW_IDS = service.MAX_BULK_REVIEW_IDS, 2
+    try:
+        # A filter on the target status would select the same rows forever
+        response = client.post('/approve_translations', json={'filter': {'status': 'approved'}})
+        assert response.status_code == 400
+        with pytest.raises(ValueError):
+            db.review_translations('declined', filters={'status': 'declined'})
+
+        for _ in range(100):
+            response = client.post('/decline_translations', json={'filter': {}}).get_json()
+            if not response['has_more']:
+                break
+        assert not response['has_more'] and db.get_pending_reviews(500) == []
+        for _ in range(100):
+            response = client.post('/approve_translations', json={'filter': {'status': 'declined'}}).get_json()
+            assert set(response['counts']) <= {'approved'}
+            if not response['has_more']:
+                break
+        assert not response['has_more']
+    finally:
+        service.MAX_BULK_REVIEW_IDS = limit
+
+    # Memory keys of approved copies are computed in SQL the same way as in Python
+    with db.pool.connection() as conn:
+        keys = conn.execute("SELECT english_key, context_key FROM approved_translations "
+                            "WHERE english_text LIKE '  Bulk  ÉCOLE %' ORDER BY id").fetchall()
+    assert keys == [service.normalize_translation_key(f'Bulk ÉCOLE {number}', 'at school') for number in range(5)]
+
+if __name__ == '__main__':
+    for name, test in list(globals().items()):
+        if name.startswith('test_') and callable(test):
+            test()
+            print(f"{name}: ok")
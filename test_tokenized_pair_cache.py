@@ -0,0 +1,97 @@
+"""
+Tests for tokenized_pair_cache.py, with a character-level stand-in for the
+Hugging Face tokenizer (no transformers needed).
+
+Run with: python -m pytest test_tokenized_pair_cache.py  (or python test_tokenized_pair_cache.py)
+"""
+import os
+import tempfile
+
+import pytest
+
+pytest.importorskip('datasets')
+
+import tokenized_pair_cache
+from tokenized_pair_cache import TASK_PREFIX, TRAINING_MAX_LENGTH, TokenizedPairCache
+
+class CharTokenizer:
+    """One token per character; counts the texts it tokenizes"""
+    all_special_tokens = ['</s>']
+
+    def __init__(self, alphabet='abcdefghijklmnopqrstuvwxyz '):
+        self.alphabet = alphabet
+        self.tokenized = 0
+
+    def get_vocab(self):
+        return {char: number for number, char in enumerate(self.alphabet)}
+
+    def _ids(self, text, max_length):
+        return [ord(char) for char in text][:max_length]
+
+    def __call__(self, texts, text_target, max_length, truncation):
+        self.tokenized += len(texts)
+        input_ids = [self._ids(text, max_length) for text in texts]
+        return {'input_ids': input_ids, 'attention_mask': [[1] * len(ids) for ids in input_ids],
+                'labels': [self._ids(text, max_length) for text in text_target]}
+
+def pairs(ids):
+    return [{'id': pair_id, 'english': f'word {pair_id}', 'arabic': f'كلمة {pair_id}'} for pair_id in ids]
+
+def test_pairs_are_tokenized_once_and_returned_in_order():
+    directory = tempfile.mkdtemp()
+    tokenizer = CharTokenizer()
+    dataset = TokenizedPairCache(directory, tokenizer).dataset(pairs([3, 1, 2]))
+
+    assert dataset['pair_id'] == [3, 1, 2] and tokenizer.tokenized == 3
+    assert dataset[0]['input_ids'] == [ord(char) for char in f'{TASK_PREFIX}word 3']
+    assert dataset[0]['labels'] == [ord(char) for char in 'كلمة 3']
+    assert dataset[0]['length'] == len(dataset[0]['input_ids'])
+
+    # Another cache over the same directory only tokenizes the pairs it hasn't seen
+    dataset = TokenizedPairCache(directory, tokenizer).dataset(pairs([4, 2, 5, 1]))
+    assert dataset['pair_id'] == [4, 2, 5, 1] and tokenizer.tokenized == 5
+    assert dataset[1]['labels'] == [ord(char) for char in 'كلمة 2']
+
+def test_shards_and_interrupted_writes():
+    shard_size, tokenized_pair_cache.TOKENIZED_SHARD_SIZE = tokenized_pair_cache.TOKENIZED_SHARD_SIZE, 2
+    try:
+        check_shards(tempfile.mkdtemp())
+    finally:
+        tokenized_pair_cache.TOKENIZED_SHARD_SIZE = shard_size
+
+def check_shards(directory):
+    cache = TokenizedPairCache(directory, CharTokenizer())
+    cache.dataset(pairs(range(1, 6)))
+    assert sorted(os.listdir(cache.directory)) == ['shard-00000', 'shard-00001', 'shard-00002']
+
+    # A shard left half-written by a crash is never read
+    os.makedirs(os.path.join(cache.directory, 'shard-00003.tmp'))
+    tokenizer = CharTokenizer()
+    dataset = TokenizedPairCache(directory, tokenizer).dataset(pairs([5, 6, 1]))
+    assert dataset['pair_id'] == [5, 6, 1] and tokenizer.tokenized == 1
+    assert 'shard-00003' in os.listdir(cache.directory)
+
+def test_cache_is_kept_per_tokenizer():
+    directory = tempfile.mkdtemp()
+    first = TokenizedPairCache(directory, CharTokenizer())
+    assert TokenizedPairCache(directory, CharTokenizer()).directory == first.directory
+    assert TokenizedPairCache(directory, CharTokenizer(alphabet='abc')).directory != first.directory
+
+    tokenizer = CharTokenizer(alphabet='abc')
+    first.dataset(pairs([1]))
+    TokenizedPairCache(directory, tokenizer).dataset(pairs([1]))
+    assert tokenizer.tokenized == 1
+
+def test_inputs_are_truncated_and_empty_input_is_rejected():
+    long_pair = {'id': 1, 'english': 'a' * (2 * TRAINING_MAX_LENGTH), 'arabic': 'ب' * (2 * TRAINING_MAX_LENGTH)}
+    dataset = TokenizedPairCache(tempfile.mkdtemp(), CharTokenizer()).dataset([long_pair])
+    assert len(dataset[0]['input_ids']) == len(dataset[0]['labels']) == TRAINING_MAX_LENGTH
+
+    with pytest.raises(ValueError):
+        TokenizedPairCache(tempfile.mkdtemp(), CharTokenizer()).dataset([])
+
+if __name__ == '__main__':
+    for name, test in list(globals().items()):
+        if name.startswith('test_') and callable(test):
+            test()
+            print(f"{name}: ok")
@@ -0,0 +1,136 @@
+"""
+Tests for word_replacement_service.py (vocabulary file parsing, hot reload and
+the paginated GET /vocabulary endpoint).
+
+Run with: python -m pytest test_word_replacement_service.py  (or python test_word_replacement_service.py)
+"""
+import json
+import os
+import tempfile
+import threading
+
+# Configure the service before importing it
+os.environ['VOCABULARY_FILE'] = os.path.join(tempfile.mkdtemp(), 'test_vocabulary.json')
+
+import word_replacement_service as service
+
+def write_vocabulary(entries) -> str:
+    path = os.path.join(tempfile.mkdtemp(), 'vocabulary.json')
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(entries, f, ensure_ascii=False)
+    return path
+
+def entry(new_arabic, **extra):
+    return {'original_transliteration': 'x', 'new_arabic': new_arabic, 'new_transliteration': 'y', **extra}
+
+def test_entries_with_unknown_keys_are_converted():
+    path = write_vocabulary({
+        'كُرة': entry('طابة', context='sports'),
+        'سيارة': entry('سيارة', added_by='linguist', tags=['cars']),
+    })
+    replacer = service.LevantineVocabularyReplacer(path)
+
+    assert all(isinstance(e, service.VocabularyEntry) for e in replacer.vocabulary_map.values())
+    assert replacer.vocabulary_map['سيارة'].new_arabic == 'سيارة'
+    assert replacer.get_vocabulary_stats()['total_words'] == 2
+    # Unknown keys are dropped
+    assert replacer.vocabulary_dict()['سيارة'] == {**entry('سيارة'), 'context': '', 'notes': '', 'usage_count': 0}
+
+def test_malformed_entries_are_rejected():
+    path = write_vocabulary({'كُرة': entry('طابة'), 'سيارة': {'notes': 'no replacement'}})
+    replacer = service.LevantineVocabularyReplacer(path)
+    assert replacer.vocabulary_map == {}
+
+def test_out_of_band_edits_are_reloaded():
+    path = write_vocabulary({'كُرة': entry('طابة')})
+    replacer = service.LevantineVocabularyReplacer(path)
+    assert not replacer.reload_if_changed()
+
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump({'كُرة': entry('طابة'), 'سيارة': entry('سيّارة', original_transliteration='sayyara')},
+                  f, ensure_ascii=False)
+    assert replacer.reload_if_changed()
+    arabic, transliteration, replacements = replacer.replace_words('سيارة', 'sayyara')
+    assert arabic == 'سيّارة' and replacements
+
+    # A half-written file keeps the current vocabulary
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('{"كُرة": ')
+    assert not replacer.reload_if_changed()
+    assert len(replacer.vocabulary_map) == 2
+
+def test_importing_does_not_start_the_watcher():
+    assert service.vocab_replacer._watcher is None
+
+def test_readers_snapshot_while_writers_change_the_vocabulary():
+    path = write_vocabulary({f'كلمة{i:03}': entry(f'ك{i}') for i in range(200)})
+    replacer = service.LevantineVocabularyReplacer(path)
+    replacer.save_vocabulary = lambda: None  # Keep the writer fast
+    stop = threading.Event()
+
+    def write():
+        number = 0
+        while not stop.is_set():
+            replacer.add_replacement(f'جديد{number}', 'x', 'ج', 'y')
+            replacer.remove_replacement(f'جديد{number}')
+            number += 1
+
+    writer = threading.Thread(target=write)
+    writer.start()
+    try:
+        for _ in range(50):
+            assert len(replacer.vocabulary_dict()) >= 200
+            assert replacer.get_vocabulary_stats()['total_words'] >= 200
+            keys = [key for key, _ in replacer.iter_vocabulary(chunk_size=7)]
+            assert keys == sorted(keys) and len([k for k in keys if k.startswith('كلمة')]) == 200
+    finally:
+        stop.set()
+        writer.join()
+
+def test_vocabulary_cursor_pagination():
+    path = write_vocabulary({f'كلمة{i:02}': entry(f'ك{i}') for i in range(25)})
+    original, service.vocab_replacer = service.vocab_replacer, service.LevantineVocabularyReplacer(path)
+    try:
+        check_vocabulary_pages(service.app.test_client())
+    finally:
+        service.vocab_replacer = original
+
+def check_vocabulary_pages(client):
+
+    keys, cursor, pages = [], None, 0
+    while True:
+        query = {'limit': 10, 'fields': 'new_arabic'} | ({'cursor': cursor} if cursor else {})
+        page = client.get('/vocabulary', query_string=query).get_json()
+        assert all(e == {'new_arabic': e['new_arabic']} for e in page['vocabulary'].values())
+        assert ('stats' in page) == (cursor is None)
+        keys += page['vocabulary']
+        pages += 1
+        cursor = page['next_cursor']
+        if cursor is None:
+            break
+    assert pages == 3 and keys == sorted(f'كلمة{i:02}' for i in range(25))
+
+    # NDJSON pages end with a next_cursor record
+    keys, cursor = [], None
+    while True:
+        query = {'format': 'ndjson', 'limit': 10} | ({'cursor': cursor} if cursor else {})
+        body = client.get('/vocabulary', query_string=query).get_data(as_text=True)
+        lines = [json.loads(line) for line in body.splitlines()]
+        keys += [line['original_arabic'] for line in lines[:-1]]
+        cursor = lines[-1]['next_cursor']
+        if cursor is None:
+            break
+    assert keys == sorted(f'كلمة{i:02}' for i in range(25))
+
+    lines = client.get('/vocabulary?format=ndjson').get_data(as_text=True).splitlines()
+    assert len(lines) == 26 and json.loads(lines[-1]) == {'next_cursor': None}
+
+    for query in ('limit=ten', 'limit=0', 'limit=1001', 'limit=2.5', 'cursor=%%%', 'fields=bogus'):
+        assert client.get(f'/vocabulary?{query}').status_code == 400, query
+        assert client.get(f'/vocabulary?format=ndjson&{query}').status_code == 400, query
+
+if __name__ == '__main__':
+    for name, test in list(globals().items()):
+        if name.startswith('test_') and callable(test):
+            test()
+            print(f"{name}: ok")
@@ -0,0 +1,90 @@
+"""
+Tokenized training pairs for the custom translation service.
+
+Needs datasets (Arrow) but not torch or transformers: any tokenizer with the
+Hugging Face call signature can be passed in.
+"""
+import hashlib
+import json
+import logging
+import os
+import shutil
+from typing import Dict, List
+
+from datasets import Dataset, concatenate_datasets, load_from_disk
+
+logger = logging.getLogger(__name__)
+
+# Model input for an English text is TASK_PREFIX + text; inputs and targets are cut to TRAINING_MAX_LENGTH tokens
+TASK_PREFIX = "translate English to Levantine Arabic: "
+TRAINING_MAX_LENGTH = 128
+# Pairs tokenized per cache shard, which bounds memory while filling the cache
+TOKENIZED_SHARD_SIZE = 10000
+
+def tokenize_pairs(tokenizer, pairs: List[Dict]) -> Dict[str, List]:
+    """Tokenize training pairs without padding; length is used to group batches by length"""
+    encoded = tokenizer(
+        [f"{TASK_PREFIX}{pair['english']}" for pair in pairs],
+        text_target=[pair['arabic'] for pair in pairs],
+        max_length=TRAINING_MAX_LENGTH,
+        truncation=True
+    )
+    return {
+        'pair_id': [pair.get('id') for pair in pairs],
+        'input_ids': encoded['input_ids'],
+        'attention_mask': encoded['attention_mask'],
+        'labels': encoded['labels'],
+        'length': [len(input_ids) for input_ids in encoded['input_ids']]
+    }
+
+class TokenizedPairCache:
+    """
+    Tokenized training pairs on disk, in Arrow shards that are memory-mapped when read
+    rather than loaded into RAM. Kept per tokenizer (see tokenizer_hash) and keyed by
+    pair id: pairs are never edited (corrections are added as new pairs), so a pair id
+    always tokenizes the same way. Written by one training process at a time.
+    """
+    def __init__(self, directory: str, tokenizer):
+        self.tokenizer = tokenizer
+        self.directory = os.path.join(directory, self.tokenizer_hash(tokenizer))
+
+    @staticmethod
+    def tokenizer_hash(tokenizer) -> str:
+        """Changes whenever the same pair could tokenize differently"""
+        key = [type(tokenizer).__name__, TASK_PREFIX, TRAINING_MAX_LENGTH, tokenizer.all_special_tokens,
+               sorted(tokenizer.get_vocab().items())]
+        return hashlib.sha256(json.dumps(key, ensure_ascii=False).encode('utf-8')).hexdigest()[:16]
+
+    def _load_shards(self) -> List[Dataset]:
+        if not os.path.isdir(self.directory):
+            return []
+        return [load_from_disk(os.path.join(self.directory, name))
+                for name in sorted(os.listdir(self.directory))
+                if name.startswith('shard-') and not name.endswith('.tmp')]
+
+    def dataset(self, pairs: List[Dict]) -> Dataset:
+        """The pairs tokenized, in order; pairs that aren't cached yet are tokenized and added"""
+        if not pairs:
+            raise ValueError("No training pairs")
+        shards = self._load_shards()
+        cached = set()
+        for shard in shards:
+            cached.update(shard['pair_id'])
+        missing = [pair for pair in pairs if pair['id'] not in cached]
+
+        if missing:
+            os.makedirs(self.directory, exist_ok=True)
+            logger.info(f"Tokenizing {len(missing)} new training pairs ({len(pairs) - len(missing)} cached)")
+        for start in range(0, len(missing), TOKENIZED_SHARD_SIZE):
+            path = os.path.join(self.directory, f"shard-{len(shards):05d}")
+            # Written under a temporary name, so an interrupted write is never read as a shard
+            shard = Dataset.from_dict(tokenize_pairs(self.tokenizer, missing[start:start + TOKENIZED_SHARD_SIZE]))
+            shutil.rmtree(path + '.tmp', ignore_errors=True)
+            shard.save_to_disk(path + '.tmp')
+            os.replace(path + '.tmp', path)
+            shards.append(load_from_disk(path))
+
+        tokenized = concatenate_datasets(shards) if len(shards) > 1 else shards[0]
+        # select() only records row indices; the rows stay in the memory-mapped shards
+        rows = {pair_id: row for row, pair_id in enumerate(tokenized['pair_id'])}
+        return tokenized.select([rows[pair['id']] for pair in pairs])
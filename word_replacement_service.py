@@ -1,53 +1,266 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response, stream_with_context
 from flask_cors import CORS
+import base64
+import binascii
+import bisect
 import json
 import os
 import re
-from typing import Dict, List, Tuple
+import sys
+import threading
+import time
+from typing import Dict, Iterator, List, Optional, Pattern, Tuple
 
 app = Flask(__name__)
 CORS(app)  # Allow CORS for all routes
 
+# Fields of a vocabulary entry that can be requested with ?fields=
+VOCABULARY_FIELDS = (
+    "original_transliteration",
+    "new_arabic",
+    "new_transliteration",
+    "context",
+    "notes",
+    "usage_count",
+)
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+# Seconds between checks of the vocabulary file for out-of-band edits
+VOCABULARY_POLL_INTERVAL = float(os.environ.get('VOCABULARY_POLL_INTERVAL', '2.0'))
+
+class VocabularyEntry:
+    """
+    A single vocabulary replacement.
+
+    Uses __slots__ instead of a per-entry dict, and interns the context and notes
+    strings, which repeat across many entries ("sports, games", ...).
+    """
+    __slots__ = VOCABULARY_FIELDS
+
+    def __init__(self, original_transliteration: str, new_arabic: str, new_transliteration: str,
+                 context: str = "", notes: str = "", usage_count: int = 0):
+        self.original_transliteration = original_transliteration
+        self.new_arabic = new_arabic
+        self.new_transliteration = new_transliteration
+        self.context = sys.intern(context or "")
+        self.notes = sys.intern(notes or "")
+        self.usage_count = usage_count
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> 'VocabularyEntry':
+        """Build an entry from its JSON representation"""
+        return cls(
+            original_transliteration=data.get("original_transliteration", ""),
+            new_arabic=data.get("new_arabic", ""),
+            new_transliteration=data.get("new_transliteration", ""),
+            context=data.get("context", ""),
+            notes=data.get("notes", ""),
+            usage_count=data.get("usage_count", 0)
+        )
+
+    @classmethod
+    def json_object_hook(cls, obj: Dict):
+        """
+        json.load object_hook that converts entries while parsing, so the
+        per-entry dicts never all exist at the same time.
+        Every object with a new_arabic key is an entry; keys other than
+        VOCABULARY_FIELDS are dropped (and so not written back on the next save).
+        """
+        if "new_arabic" in obj:
+            return cls.from_dict(obj)
+        return obj
+
+    def to_dict(self, fields: Optional[List[str]] = None) -> Dict:
+        """JSON representation of the entry, optionally restricted to some fields"""
+        return {field: getattr(self, field) for field in (fields or VOCABULARY_FIELDS)}
+
 class LevantineVocabularyReplacer:
     def __init__(self, vocabulary_file='levantine_vocabulary.json'):
         self.vocabulary_file = vocabulary_file
+        # Serializes writers (add/remove, saves, reloads); readers that iterate the
+        # vocabulary take it only to snapshot the entries (replace_words never does)
+        self._lock = threading.RLock()
+        # (inode, mtime, size) of the file as we last read or wrote it
+        self._file_signature = self._current_file_signature()
         self.vocabulary_map = self.load_vocabulary()
+        # Compiled transliteration patterns, keyed by original transliteration
+        self._translit_patterns = self._build_translit_patterns(self.vocabulary_map)
+        # Sorted keys for cursor pagination, rebuilt lazily after the key set changes
+        self._sorted_keys: Optional[List[str]] = None
+        self._watcher: Optional[threading.Thread] = None
         
-    def load_vocabulary(self) -> Dict[str, Dict[str, str]]:
+    def load_vocabulary(self) -> Dict[str, VocabularyEntry]:
         """Load vocabulary replacements from JSON file"""
         if os.path.exists(self.vocabulary_file):
             try:
-                with open(self.vocabulary_file, 'r', encoding='utf-8') as f:
-                    return json.load(f)
+                return self._read_vocabulary_file()
             except Exception as e:
                 print(f"Error loading vocabulary file: {e}")
                 return {}
         return {}
+
+    def _read_vocabulary_file(self) -> Dict[str, VocabularyEntry]:
+        """Parse the vocabulary file; raises on a missing or malformed file"""
+        with open(self.vocabulary_file, 'r', encoding='utf-8') as f:
+            vocabulary_map = json.load(f, object_hook=VocabularyEntry.json_object_hook)
+        if not isinstance(vocabulary_map, dict):
+            raise ValueError("Vocabulary file must contain a JSON object")
+        for key, entry in vocabulary_map.items():
+            if not isinstance(entry, VocabularyEntry):
+                raise ValueError(f"Malformed vocabulary entry for {key!r}")
+        return vocabulary_map
+
+    def _current_file_signature(self) -> Optional[Tuple[int, int, int]]:
+        """Identify the current version of the vocabulary file without reading it"""
+        try:
+            st = os.stat(self.vocabulary_file)
+        except OSError:
+            return None
+        return (st.st_ino, st.st_mtime_ns, st.st_size)
     
     def save_vocabulary(self):
         """Save vocabulary replacements to JSON file"""
-        try:
-            with open(self.vocabulary_file, 'w', encoding='utf-8') as f:
-                json.dump(self.vocabulary_map, f, ensure_ascii=False, indent=2)
-            print(f"Vocabulary saved to {self.vocabulary_file}")
-        except Exception as e:
-            print(f"Error saving vocabulary file: {e}")
+        with self._lock:
+            try:
+                # Write to a temporary file and rename it over the original, so the
+                # watcher (or a linguist's editor) never sees a half-written file
+                tmp_file = f"{self.vocabulary_file}.tmp"
+                with open(tmp_file, 'w', encoding='utf-8') as f:
+                    json.dump(self.vocabulary_dict(), f, ensure_ascii=False, indent=2)
+                os.replace(tmp_file, self.vocabulary_file)
+                self._file_signature = self._current_file_signature()
+                print(f"Vocabulary saved to {self.vocabulary_file}")
+            except Exception as e:
+                print(f"Error saving vocabulary file: {e}")
     
     def add_replacement(self, original_arabic: str, original_transliteration: str, 
                        new_arabic: str, new_transliteration: str, 
                        context: str = "", notes: str = ""):
         """Add a new word replacement to the vocabulary"""
-        # Use original Arabic as the key
-        self.vocabulary_map[original_arabic] = {
-            "original_transliteration": original_transliteration,
-            "new_arabic": new_arabic,
-            "new_transliteration": new_transliteration,
-            "context": context,
-            "notes": notes,
-            "usage_count": 0
-        }
-        self.save_vocabulary()
-        
+        with self._lock:
+            # Pick up out-of-band edits first so saving doesn't overwrite them
+            self.reload_if_changed()
+            # Use original Arabic as the key
+            self.vocabulary_map[original_arabic] = VocabularyEntry(
+                original_transliteration=original_transliteration,
+                new_arabic=new_arabic,
+                new_transliteration=new_transliteration,
+                context=context,
+                notes=notes
+            )
+            self._compile_translit_pattern(original_transliteration, self._translit_patterns)
+            self._sorted_keys = None
+            self.save_vocabulary()
+
+    def remove_replacement(self, original_arabic: str) -> bool:
+        """Remove a word replacement; returns False if the word is unknown"""
+        with self._lock:
+            self.reload_if_changed()
+            if original_arabic not in self.vocabulary_map:
+                return False
+            del self.vocabulary_map[original_arabic]
+            self._sorted_keys = None
+            self.save_vocabulary()
+            return True
+
+    def reload_if_changed(self) -> bool:
+        """
+        Reload the vocabulary if the file was changed by someone else.
+        The new vocabulary and its match index are built before being swapped in,
+        so concurrent replace_words calls keep using the previous version meanwhile.
+        Returns True if a new vocabulary was swapped in.
+        """
+        signature = self._current_file_signature()
+        if signature is None or signature == self._file_signature:
+            return False
+
+        with self._lock:
+            signature = self._current_file_signature()
+            if signature is None or signature == self._file_signature:
+                return False
+            try:
+                vocabulary_map = self._read_vocabulary_file()
+            except Exception as e:
+                # Probably saved mid-edit; keep serving the current vocabulary until the next change
+                print(f"Error reloading vocabulary file, keeping current vocabulary: {e}")
+                self._file_signature = signature
+                return False
+
+            translit_patterns = self._build_translit_patterns(vocabulary_map, self._translit_patterns)
+            self._translit_patterns = translit_patterns
+            self.vocabulary_map = vocabulary_map
+            self._sorted_keys = None
+            self._file_signature = signature
+            print(f"Reloaded {len(vocabulary_map)} vocabulary entries from {self.vocabulary_file}")
+            return True
+
+    def start_watching(self, interval: float = VOCABULARY_POLL_INTERVAL):
+        """Poll the vocabulary file in a background thread and reload it when it changes"""
+        if self._watcher is not None:
+            return
+
+        def watch():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.reload_if_changed()
+                except Exception as e:
+                    print(f"Error watching vocabulary file: {e}")
+
+        self._watcher = threading.Thread(target=watch, name='vocabulary-watcher', daemon=True)
+        self._watcher.start()
+
+    def _build_translit_patterns(self, vocabulary_map: Dict[str, VocabularyEntry],
+                                 previous: Optional[Dict[str, Pattern]] = None) -> Dict[str, Pattern]:
+        """Compile the transliteration pattern of every entry, reusing already compiled ones"""
+        patterns = {}
+        for entry in vocabulary_map.values():
+            translit = entry.original_transliteration
+            if previous and translit in previous:
+                patterns[translit] = previous[translit]
+            else:
+                self._compile_translit_pattern(translit, patterns)
+        return patterns
+
+    def _compile_translit_pattern(self, translit: str, patterns: Dict[str, Pattern]) -> Pattern:
+        """Get or compile the case-insensitive whole-word pattern for a transliteration"""
+        pattern = patterns.get(translit)
+        if pattern is None:
+            pattern = re.compile(r'\b' + re.escape(translit) + r'\b', re.IGNORECASE)
+            patterns[translit] = pattern
+        return pattern
+
+    def _snapshot(self) -> List[Tuple[str, VocabularyEntry]]:
+        """The current (original_arabic, entry) pairs, safe to iterate while writers change the map"""
+        with self._lock:
+            return list(self.vocabulary_map.items())
+
+    def vocabulary_dict(self) -> Dict[str, Dict]:
+        """The whole vocabulary in its JSON representation"""
+        return {key: entry.to_dict() for key, entry in self._snapshot()}
+
+    def iter_vocabulary(self, after: Optional[str] = None, fields: Optional[List[str]] = None,
+                        chunk_size: int = MAX_PAGE_SIZE) -> Iterator[Tuple[str, Dict]]:
+        """
+        Yield (original_arabic, entry) pairs in key order, starting after the given key.
+        If fields is given, each entry only contains those fields.
+        Entries are snapshotted chunk_size at a time, so a long stream never holds
+        the lock and never copies the whole vocabulary.
+        """
+        while True:
+            with self._lock:
+                if self._sorted_keys is None:
+                    self._sorted_keys = sorted(self.vocabulary_map)
+                keys = self._sorted_keys
+                start = bisect.bisect_right(keys, after) if after is not None else 0
+                chunk = [(key, self.vocabulary_map[key]) for key in keys[start:start + chunk_size]]
+
+            for key, entry in chunk:
+                yield key, entry.to_dict(fields)
+            if len(chunk) < chunk_size:
+                return
+            after = chunk[-1][0]
+
     def replace_words(self, arabic_text: str, transliteration_text: str) -> Tuple[str, str, List[str]]:
         """
         Replace words in both Arabic and transliteration text
@@ -56,32 +269,34 @@ class LevantineVocabularyReplacer:
         replacements_made = []
         new_arabic = arabic_text
         new_transliteration = transliteration_text
+        # Snapshot both, a reload may swap them in while we're iterating
+        vocabulary_map = self.vocabulary_map
+        translit_patterns = self._translit_patterns
         
-        for original_arabic, replacement_data in self.vocabulary_map.items():
+        for original_arabic, replacement_data in list(vocabulary_map.items()):
             # Replace in Arabic text (exact word match with word boundaries)
             if self._contains_arabic_word(new_arabic, original_arabic):
-                new_arabic = self._replace_arabic_word(new_arabic, original_arabic, replacement_data["new_arabic"])
+                new_arabic = self._replace_arabic_word(new_arabic, original_arabic, replacement_data.new_arabic)
                 
                 # Replace corresponding transliteration
-                original_translit = replacement_data["original_transliteration"]
-                new_translit = replacement_data["new_transliteration"]
+                original_translit = replacement_data.original_transliteration
+                new_translit = replacement_data.new_transliteration
                 
                 # Case-insensitive replacement for transliteration
-                new_transliteration = re.sub(
-                    r'\b' + re.escape(original_translit) + r'\b', 
-                    new_translit, 
-                    new_transliteration, 
-                    flags=re.IGNORECASE
-                )
+                pattern = self._compile_translit_pattern(original_translit, translit_patterns)
+                new_transliteration = pattern.sub(new_translit, new_transliteration)
                 
-                replacements_made.append(f"{original_arabic} → {replacement_data['new_arabic']}")
+                replacements_made.append(f"{original_arabic} → {replacement_data.new_arabic}")
                 
                 # Increment usage count
-                self.vocabulary_map[original_arabic]["usage_count"] += 1
+                replacement_data.usage_count += 1
         
-        # Save updated usage counts
+        # Save updated usage counts, unless the file was edited out-of-band since
+        # we read it: then the edit wins and it is reloaded instead
         if replacements_made:
-            self.save_vocabulary()
+            with self._lock:
+                if not self.reload_if_changed() and vocabulary_map is self.vocabulary_map:
+                    self.save_vocabulary()
             
         return new_arabic, new_transliteration, replacements_made
     
@@ -97,31 +312,33 @@ class LevantineVocabularyReplacer:
     
     def get_vocabulary_stats(self) -> Dict:
         """Get statistics about the vocabulary"""
-        total_words = len(self.vocabulary_map)
-        total_usage = sum(item["usage_count"] for item in self.vocabulary_map.values())
-        most_used = max(self.vocabulary_map.items(), 
-                       key=lambda x: x[1]["usage_count"], 
-                       default=(None, {"usage_count": 0}))
+        items = self._snapshot()
+        total_words = len(items)
+        total_usage = sum(item.usage_count for _, item in items)
+        most_used = max(items,
+                       key=lambda x: x[1].usage_count, 
+                       default=(None, None))
         
         return {
             "total_words": total_words,
             "total_usage": total_usage,
             "most_used_word": most_used[0] if most_used[0] else None,
-            "most_used_count": most_used[1]["usage_count"]
+            "most_used_count": most_used[1].usage_count if most_used[1] else 0
         }
 
 # Initialize the vocabulary replacer
-vocab_replacer = LevantineVocabularyReplacer()
-
-# Initialize with the ball example
-vocab_replacer.add_replacement(
-    original_arabic="كُرة",
-    original_transliteration="kura", 
-    new_arabic="طابة",
-    new_transliteration="taabeh",
-    context="sports, games",
-    notes="More commonly used Levantine word for ball"
-)
+vocab_replacer = LevantineVocabularyReplacer(os.environ.get('VOCABULARY_FILE', 'levantine_vocabulary.json'))
+
+# Initialize with the ball example (only once, so we don't rewrite the file on every boot)
+if "كُرة" not in vocab_replacer.vocabulary_map:
+    vocab_replacer.add_replacement(
+        original_arabic="كُرة",
+        original_transliteration="kura", 
+        new_arabic="طابة",
+        new_transliteration="taabeh",
+        context="sports, games",
+        notes="More commonly used Levantine word for ball"
+    )
 
 @app.route('/')
 def index():
@@ -195,14 +412,95 @@ def add_replacement():
         print(f"Error adding replacement: {e}")
         return jsonify({'error': 'An error occurred while adding replacement'}), 500
 
+def encode_cursor(key: str) -> str:
+    """Encode a vocabulary key as an opaque, URL-safe cursor"""
+    return base64.urlsafe_b64encode(key.encode('utf-8')).decode('ascii')
+
+def decode_cursor(cursor: str) -> str:
+    """Decode a cursor produced by encode_cursor; raises ValueError if malformed"""
+    try:
+        return base64.b64decode(cursor.encode('ascii'), altchars=b'-_', validate=True).decode('utf-8')
+    except (binascii.Error, UnicodeError) as e:
+        raise ValueError(f"Invalid cursor: {cursor}") from e
+
 @app.route('/vocabulary', methods=['GET'])
 def get_vocabulary():
-    """Get all vocabulary replacements"""
+    """
+    Get vocabulary replacements.
+
+    Without query parameters the whole vocabulary is returned in one response.
+    Optional parameters:
+      limit   - page size (max MAX_PAGE_SIZE); enables cursor pagination
+      cursor  - next_cursor from the previous page
+      fields  - comma-separated list of entry fields to include
+      format  - 'ndjson' streams one entry per line instead of a JSON document; the
+                last line is {"next_cursor": ...} (null once the vocabulary is done)
+    """
+    args = request.args
+    fields = None
+    if args.get('fields'):
+        fields = [field.strip() for field in args['fields'].split(',') if field.strip()]
+        unknown = [field for field in fields if field not in VOCABULARY_FIELDS]
+        if unknown:
+            return jsonify({'error': f'Unknown fields: {", ".join(unknown)}'}), 400
+
+    after = None
+    if args.get('cursor'):
+        try:
+            after = decode_cursor(args['cursor'])
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+
+    limit = None
+    if args.get('limit') is not None:
+        try:
+            limit = int(args['limit'])
+        except ValueError:
+            limit = 0
+        if not 1 <= limit <= MAX_PAGE_SIZE:
+            return jsonify({'error': f'limit must be an integer between 1 and {MAX_PAGE_SIZE}'}), 400
+
+    if args.get('format') == 'ndjson':
+        def generate():
+            next_cursor = last_key = None
+            for count, (key, entry) in enumerate(vocab_replacer.iter_vocabulary(after, fields)):
+                if limit is not None and count >= limit:
+                    # There is at least one more entry after this page
+                    next_cursor = encode_cursor(last_key)
+                    break
+                yield json.dumps({'original_arabic': key, **entry}, ensure_ascii=False) + '\n'
+                last_key = key
+            yield json.dumps({'next_cursor': next_cursor}) + '\n'
+
+        return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
     try:
-        return jsonify({
-            'vocabulary': vocab_replacer.vocabulary_map,
-            'stats': vocab_replacer.get_vocabulary_stats()
-        })
+        if limit is None and after is None and fields is None:
+            # Unpaginated response, kept for existing clients
+            return jsonify({
+                'vocabulary': vocab_replacer.vocabulary_dict(),
+                'stats': vocab_replacer.get_vocabulary_stats()
+            })
+
+        page_size = limit or DEFAULT_PAGE_SIZE
+        page = {}
+        next_cursor = None
+        for key, entry in vocab_replacer.iter_vocabulary(after, fields):
+            if len(page) == page_size:
+                # There is at least one more entry after this page
+                next_cursor = encode_cursor(next(reversed(page)))
+                break
+            page[key] = entry
+
+        response = {
+            'vocabulary': page,
+            'count': len(page),
+            'next_cursor': next_cursor
+        }
+        if after is None:
+            # Stats cover the whole vocabulary, so only send them with the first page
+            response['stats'] = vocab_replacer.get_vocabulary_stats()
+        return jsonify(response)
     except Exception as e:
         print(f"Error getting vocabulary: {e}")
         return jsonify({'error': 'An error occurred while fetching vocabulary'}), 500
@@ -211,9 +509,7 @@ def get_vocabulary():
 def delete_replacement(original_word):
     """Delete a word replacement"""
     try:
-        if original_word in vocab_replacer.vocabulary_map:
-            del vocab_replacer.vocabulary_map[original_word]
-            vocab_replacer.save_vocabulary()
+        if vocab_replacer.remove_replacement(original_word):
             return jsonify({
                 'message': f'Replacement for "{original_word}" deleted successfully',
                 'vocabulary_stats': vocab_replacer.get_vocabulary_stats()
@@ -238,4 +534,6 @@ if __name__ == '__main__':
     print("Starting Levantine Vocabulary Replacement Service...")
     print("Initializing with 'kura' → 'taabeh' replacement for ball")
     print("Service will be available on http://127.0.0.1:5001")
+    # Pick up edits linguists make to the vocabulary file without a restart
+    vocab_replacer.start_watching()
     app.run(debug=True, port=5001) 
\ No newline at end of file